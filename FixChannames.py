@@ -1,5 +1,8 @@
+import re
 import logging
+from typing import Union, Type
 import neuropype.engine as ne
+from .instrumentation import instrumented
 
 
 logger = logging.getLogger(__name__)
@@ -10,25 +13,103 @@ class FixChannames(ne.Node):
     data = ne.Port(None, ne.Packet, "Data to process.", required=True,
                    editable=False, mutating=True)
 
+    # --- Properties ---
+    rule = ne.EnumPort('prefix', ['prefix', 'regex', 'mapping'], """How to
+        rename channels. prefix replaces the name prefix old_prefix by
+        new_prefix (e.g., elec1 --> ch1), regex substitutes pattern by
+        replacement (using Python's re.sub), and mapping looks up each name in
+        the mapping table. Channels that do not match are left unchanged.""",
+        verbose_name='renaming rule')
+    old_prefix = ne.StringPort('elec', """Channel name prefix to replace (if
+        rule is prefix).""")
+    new_prefix = ne.StringPort('ch', """Replacement for old_prefix (if rule is
+        prefix).""")
+    pattern = ne.StringPort('', """Regular expression to replace in channel
+        names (if rule is regex).""")
+    replacement = ne.StringPort('', """Replacement for matches of pattern (if
+        rule is regex). May refer to groups, as in \\1.""")
+    mapping = ne.Port(None, object, """Mapping from old to new channel names
+        (if rule is mapping), formatted as in, e.g., {'elec1': 'Fz', 'elec2':
+        'Cz'}.""")
+
+    # maximum number of distinct channel name lists to keep renamed names for
+    max_cached_names = 64
+
+    def __init__(self,
+                 rule: Union[str, None, Type[ne.Keep]] = ne.Keep,
+                 old_prefix: Union[str, None, Type[ne.Keep]] = ne.Keep,
+                 new_prefix: Union[str, None, Type[ne.Keep]] = ne.Keep,
+                 pattern: Union[str, None, Type[ne.Keep]] = ne.Keep,
+                 replacement: Union[str, None, Type[ne.Keep]] = ne.Keep,
+                 mapping: Union[object, None, Type[ne.Keep]] = ne.Keep,
+                 **kwargs):
+        """Create a new node. Accepts initial values for the ports."""
+        # renamed channel names, by tuple of original channel names (None if
+        # the names are unchanged)
+        self._names = {}
+        super().__init__(rule=rule, old_prefix=old_prefix, new_prefix=new_prefix, pattern=pattern,
+                         replacement=replacement, mapping=mapping, **kwargs)
+
     @classmethod
     def description(cls):
         return ne.Description(name='Rename channels.',
                               description="""
-                              analogsignals
-                              elec1 --> ch1, etc.
+                              Rename the channels of all chunks with a space
+                              axis, e.g., elec1 --> ch1, etc.
                               """,
-                              version='0.1',
+                              version='0.2',
                               license=ne.Licenses.MIT)
 
     @data.setter
+    @instrumented
     def data(self, pkt):
         if pkt is not None:
-            logger.info("Fixing channel names (elecX --> chX) ...")
-            blk = pkt.chunks['analogsignals'].block
-            new_axes = list(blk.axes)
-            sp_ix = blk.axes.index(ne.space)
-            new_chan_names = ['ch' + cn[4:] if cn[0:4] == 'elec' else cn for cn in new_axes[sp_ix].names]
-            new_axes[sp_ix] = ne.SpaceAxis(names=new_chan_names)
-            pkt.chunks['analogsignals'].block = ne.Block(data=blk.data, axes=new_axes)
+            for n, chnk in ne.enumerate_chunks(pkt, nonempty=True, with_axes=(ne.space,)):
+                blk = chnk.block
+                sp_ix = blk.axes.index(ne.space)
+                new_axis = self._renamed_axis(blk.axes[sp_ix])
+                if new_axis is not None:
+                    # swap in the renamed axis; the data array is reused as is
+                    new_axes = list(blk.axes)
+                    new_axes[sp_ix] = new_axis
+                    chnk.block = ne.Block(data=blk.data, axes=new_axes)
 
         self._data = pkt
+
+    def _renamed_axis(self, axis):
+        """Get a renamed copy of a space axis, or None if no channel is
+        renamed. The new names are computed once per distinct list of names,
+        but each chunk gets an axis of its own."""
+        names = tuple(axis.names)
+        try:
+            new_names = self._names[names]
+        except KeyError:
+            new_names = tuple(self._rename(names))
+            if new_names == names:
+                new_names = None
+            else:
+                logger.info("Fixing channel names (%s --> %s, ...) ..."
+                            % next((o, n) for o, n in zip(names, new_names) if o != n))
+            if len(self._names) >= self.max_cached_names:
+                self._names.clear()
+            self._names[names] = new_names
+        return None if new_names is None else ne.SpaceAxis(names=list(new_names))
+
+    def _rename(self, names):
+        """Apply the renaming rule to a sequence of channel names."""
+        if self.rule == 'prefix':
+            k = len(self.old_prefix)
+            return [self.new_prefix + cn[k:] if cn.startswith(self.old_prefix) else cn
+                    for cn in names]
+        elif self.rule == 'regex':
+            regex = re.compile(self.pattern)
+            return [regex.sub(self.replacement, cn) for cn in names]
+        else:
+            mapping = self.mapping or {}
+            return [mapping.get(cn, cn) for cn in names]
+
+    def on_port_assigned(self):
+        """Callback to reset internal state when a value was assigned to a
+        port (unless the port's setter has been overridden)."""
+        self._names = {}
+        self.signal_changed(True)
@@ -1,14 +1,16 @@
+import re
 import logging
-import scipy.io
 import numpy as np
 from neuropype.engine.packet import Chunk
 from neuropype.engine.block import Block
-from neuropype.engine.axes import InstanceAxis
+from neuropype.engine.axes import InstanceAxis, instance
 from neuropype.engine.constants import Licenses, Flags
 from neuropype.engine.packet import Packet
 from neuropype.engine.node import Node, Description
-from neuropype.engine.ports import Port, StringPort, EnumPort
-from neuropype.utilities.cloud import storage
+from neuropype.engine.ports import Port, StringPort, EnumPort, BoolPort, FloatPort
+from .cloud_cache import cloud_get
+from .columnar import encode_column, decode_column, CATEGORIES_PROP
+from .instrumentation import instrumented, lap
 
 
 logger = logging.getLogger(__name__)
@@ -43,6 +45,42 @@ class FixEvents(Node):
             password or access token) for the the cloud storage provider. On some
             environments (e.g., on NeuroScale), this value will be
             default-initialized to the right credentials for you.""")
+    cache_dir = StringPort("", """Local download cache directory. If set,
+            cloud-hosted files are downloaded into this directory once and
+            reused on subsequent runs (the environment variable
+            CUSTOM_NEUROPYPE_CACHE_DIR provides a default).""", expert=True)
+    categorical_columns = BoolPort(False, """Dictionary-encode the marker
+            strings. If enabled, the markers are a record array with a single
+            field Marker holding integer codes into the table of marker
+            strings (e.g., Cue-3), which is stored in the chunk's properties
+            under 'categories' ({'Marker': array of marker strings}). This
+            keeps large tables compact, but nodes that expect marker strings
+            cannot read the encoded markers.""")
+    mode = EnumPort('replace', ['replace', 'merge'], """How to combine the
+            loaded events with the packet. replace replaces the markers chunk
+            with the loaded events and removes the events chunk. merge splices
+            the loaded events into the existing markers chunk (if any) in time
+            order, keeping the existing markers and their fields (the new
+            markers get empty values in the fields other than Marker), and
+            leaves the events chunk alone.""")
+    align_clocks = BoolPort(False, """Align the clock of the loaded events to
+            the existing markers before merging. The offset is first estimated
+            as the most common time difference of the pairs of events that are
+            at most max_clock_offset apart, and then refined as the median
+            time difference of the pairs of events that match within
+            align_tolerance. The offset is stored in the chunk's properties
+            under 'clock_offset'.""")
+    align_markers = StringPort('', """Regular expression for the existing
+            markers to align to (e.g., hardware markers that are sent at the
+            target, cue and saccade times). If empty, all existing markers are
+            used.""")
+    max_clock_offset = FloatPort(10.0, None, """Largest clock offset to consider,
+            in seconds.""")
+    align_tolerance = FloatPort(0.05, None, """Largest time difference of a
+            matching pair of events after alignment, in seconds.""")
+
+    # per-trial event types, in the order in which they occur in a trial
+    event_types = ('Target', 'Cue', 'Saccade')
 
     @classmethod
     def description(cls):
@@ -53,38 +91,221 @@ class FixEvents(Node):
                            license=Licenses.MIT)
 
     @data.setter
+    @instrumented
     def data(self, packet):
         if packet is not None:
-            filename = storage.cloud_get(self.filename, host=self.cloud_host,
-                                         account=self.cloud_account,
-                                         bucket=self.cloud_bucket,
-                                         credentials=self.cloud_credentials)
+            filename = cloud_get(self.filename, host=self.cloud_host,
+                                 account=self.cloud_account,
+                                 bucket=self.cloud_bucket,
+                                 credentials=self.cloud_credentials,
+                                 cache_dir=self.cache_dir)
 
             logger.info("Replacing markers with events loaded from %s..." % filename)
-            mat = scipy.io.loadmat(filename)
-
-            ev_times = []
-            ev_strs = []
-            for tr_ix in range(mat['startTime'].size):
-                start = mat['startTime'][0][tr_ix]
-                target_onset = mat['targetOnset'][0][tr_ix]
-                cue_onset = mat['cueOnset'][0][tr_ix]
-                sac_onset = mat['sacStartTime'][0][tr_ix]
-                class_id = int(mat['newClass'][0][tr_ix])
-                ev_times.extend([start + target_onset, start + cue_onset, start + sac_onset])
-                ev_strs.extend(['Target-' + str(class_id), 'Cue-' + str(class_id), 'Saccade-' + str(class_id)])
-
-            if len(ev_times) > 0:
-                ev_times = np.asarray(ev_times) / 1000
+            mat = load_mat_vars(filename, ['startTime', 'targetOnset', 'cueOnset', 'sacStartTime', 'newClass'])
+            lap('load')
+
+            # Each trial produces a Target, Cue and Saccade event, in that order.
+            start = mat['startTime'].astype(float)
+            ev_times = (start[:, None] + np.column_stack((mat['targetOnset'], mat['cueOnset'],
+                                                          mat['sacStartTime']))).ravel()
+            # Look up the labels from a table with one row per distinct class.
+            classes, class_ix = np.unique(mat['newClass'].astype(int), return_inverse=True)
+            label_table = np.array([[ev_type + '-' + str(class_id) for ev_type in self.event_types]
+                                    for class_id in classes], dtype=str).reshape(len(classes), len(self.event_types))
+            ev_labels = (class_ix.ravel()[:, None] * len(self.event_types)
+                         + np.arange(len(self.event_types))).ravel()
+            if self.categorical_columns:
+                # encode the label table, whose codes then index the events
+                label_codes, label_cats = encode_column(label_table.ravel())
+                ev_data = np.empty(len(ev_labels), dtype=[('Marker', label_codes.dtype)])
+                ev_data['Marker'] = label_codes[ev_labels]
+                categories = {'Marker': label_cats}
+            else:
+                ev_data = label_table.ravel()[ev_labels]
+            lap('build')
+
+            if self.mode == 'merge' and 'markers' in packet.chunks:
+                packet.chunks['markers'] = self._merge(packet.chunks['markers'], ev_times / 1000,
+                                                       label_table.ravel()[ev_labels])
+                lap('merge')
+            elif len(ev_times) > 0:
+                ev_times = ev_times / 1000
                 marker_block = Block(data=np.nan * np.ones_like(ev_times),
                                      axes=(InstanceAxis(ev_times,
-                                                        data=np.asarray(ev_strs),
+                                                        data=ev_data,
                                                         instance_type='markers'),
                                            )
                                      )
                 marker_props = {Flags.has_markers: True}
+                if self.categorical_columns:
+                    marker_props[CATEGORIES_PROP] = categories
                 packet.chunks.update({'markers': Chunk(block=marker_block, props=marker_props)})
-                if 'events' in packet.chunks:
+                if 'events' in packet.chunks and self.mode == 'replace':
                     del packet.chunks['events']
 
         self._data = packet
+
+    def _merge(self, chunk, ev_times, ev_markers):
+        """Splice events (times in seconds, marker strings) into an existing
+        marker chunk; returns the merged chunk."""
+        axis = chunk.block.axes[instance]
+        old_times, old_data = np.asarray(axis.times, dtype=float), np.asarray(axis.data)
+        props = dict(chunk.props) if isinstance(chunk.props, dict) else {}
+        categories = dict(props.get(CATEGORIES_PROP, {}))
+        fields = old_data.dtype.names or ()
+        encoded = 'Marker' in categories or self.categorical_columns
+        has_markers = 'Marker' in fields or not fields
+        if has_markers:
+            old_markers = old_data['Marker'] if fields else old_data
+            if 'Marker' in categories:
+                old_markers = decode_column(old_markers, categories['Marker'])
+        else:
+            # records without a Marker field: the existing instances get a
+            # missing marker (-1 if encoded, else an empty string)
+            old_markers = np.full(len(old_data), None if encoded else '', dtype=object)
+
+        if self.align_clocks:
+            ref = old_times
+            if self.align_markers:
+                regex = re.compile(self.align_markers)
+                ref = ref[[has_markers and m is not None and regex.match(str(m)) is not None
+                           for m in old_markers]]
+            offset, n_pairs = estimate_clock_offset(ref, ev_times, self.max_clock_offset,
+                                                    self.align_tolerance)
+            logger.info("Clock offset of the events: %.4f s (from %d matching pairs)." % (offset, n_pairs))
+            ev_times = ev_times + offset
+            props['clock_offset'] = offset
+            lap('align')
+
+        # Sorted splice: the position of each event in the merged stream is the
+        # number of earlier existing markers (ties go after them) plus its rank.
+        order = np.argsort(ev_times, kind='stable')
+        ev_times, ev_markers = ev_times[order], np.asarray(ev_markers)[order]
+        if np.any(np.diff(old_times) < 0):
+            old_order = np.argsort(old_times, kind='stable')
+            old_times, old_data, old_markers = old_times[old_order], old_data[old_order], old_markers[old_order]
+        is_new = np.zeros(len(old_times) + len(ev_times), dtype=bool)
+        is_new[np.searchsorted(old_times, ev_times, side='right') + np.arange(len(ev_times))] = True
+        times = np.empty(len(is_new))
+        times[is_new], times[~is_new] = ev_times, old_times
+        markers = np.empty(len(is_new), dtype=object)
+        markers[is_new], markers[~is_new] = ev_markers, old_markers
+
+        if encoded:
+            markers, categories['Marker'] = encode_column(markers)
+        if fields or encoded:
+            # record array with the fields of the existing markers
+            descr = []
+            for name in fields:
+                field = old_data.dtype.fields[name]
+                dtype = markers.dtype if name == 'Marker' else field[0]
+                descr.append(((field[2], name) if len(field) > 2 else name, dtype))
+            if 'Marker' not in fields:
+                descr.append(('Marker', markers.dtype))
+            data = np.empty(len(is_new), dtype=descr)
+            for name in fields:
+                if name != 'Marker':
+                    data[name][~is_new] = old_data[name]
+                    data[name][is_new] = _empty_value(data.dtype[name], name in categories)
+            data['Marker'] = markers
+        else:
+            data = markers
+
+        props[Flags.has_markers] = True
+        if categories:
+            props[CATEGORIES_PROP] = categories
+        block = Block(data=np.nan * np.ones(len(times)),
+                      axes=(InstanceAxis(times, data=data, instance_type='markers'),))
+        logger.info("Merged %d events into %d existing markers." % (len(ev_times), len(old_times)))
+        return Chunk(block=block, props=props)
+
+
+def estimate_clock_offset(ref_times, times, max_offset, tolerance, max_pairs=2**24):
+    """Estimate the offset to add to times to align them with ref_times.
+
+    The coarse offset is the most common time difference (in bins of about
+    tolerance) of the pairs of events that are at most max_offset apart, which
+    are found with a sorted search; the offset is then refined as the median
+    difference of the events that have a reference event within tolerance. If
+    there are more than max_pairs such pairs, the coarse offset is taken from
+    an evenly spaced subset of the events.
+
+    Returns:
+        (offset, number of matching pairs); the offset is 0 if no pairs match.
+    """
+    ref_times, times = np.sort(np.asarray(ref_times, dtype=float)), np.sort(np.asarray(times, dtype=float))
+    if not len(ref_times) or not len(times):
+        return 0.0, 0
+    # reference events within +/- max_offset of each event
+    lo = np.searchsorted(ref_times, times - max_offset, side='left')
+    hi = np.searchsorted(ref_times, times + max_offset, side='right')
+    step = max(int(np.ceil(np.sum(hi - lo) / max_pairs)), 1)
+    sub, lo, hi = times[::step], lo[::step], hi[::step]
+    counts = hi - lo
+    starts = np.cumsum(counts) - counts
+    pair_ref = np.repeat(lo - starts, counts) + np.arange(np.sum(counts))
+    diffs = ref_times[pair_ref] - np.repeat(sub, counts)
+    res = max(tolerance, 1e-6)
+    n_bins = int(np.ceil(2 * max_offset / res)) + 1
+    hist = np.bincount(np.clip(((diffs + max_offset) / res).astype(int), 0, n_bins - 1), minlength=n_bins)
+    # tolerate differences that fall into neighboring bins
+    if n_bins > 1:
+        hist = hist[:-1] + hist[1:]
+        coarse = (np.argmax(hist) + 1) * res - max_offset
+    else:
+        coarse = 0.0
+
+    # refine with the nearest reference event of each event
+    shifted = times + coarse
+    ix = np.clip(np.searchsorted(ref_times, shifted), 1, len(ref_times) - 1) if len(ref_times) > 1 \
+        else np.zeros(len(times), int)
+    nearest = np.where(np.abs(ref_times[ix - 1] - shifted) < np.abs(ref_times[ix] - shifted),
+                       ref_times[ix - 1], ref_times[ix]) if len(ref_times) > 1 else ref_times[ix]
+    diff = nearest - shifted
+    matched = np.abs(diff) <= 2 * tolerance
+    if not np.any(matched):
+        logger.warning("No matching events found to align the clocks.")
+        return 0.0, 0
+    offset = coarse + np.median(diff[matched])
+    n_pairs = int(np.sum(np.abs(nearest - times - offset) <= tolerance))
+    return float(offset), n_pairs
+
+
+def _empty_value(dtype, encoded):
+    """Value of a field of the existing markers for the merged events."""
+    if dtype.kind == 'f':
+        return np.nan
+    if dtype.kind in 'iu':
+        return -1 if encoded else 0
+    if dtype.kind == 'b':
+        return False
+    if dtype.kind in 'US':
+        return ''
+    return None
+
+
+def load_mat_vars(filename, names):
+    """Load only the named variables from a .mat file, each as a flat array.
+
+    Files saved with -v7.3 are HDF5 containers; these are opened with h5py and
+    only the requested datasets are read. Contiguous, uncompressed datasets are
+    memory-mapped directly rather than read into memory.
+    """
+    import scipy.io
+    try:
+        mat = scipy.io.loadmat(filename, variable_names=names)
+        return {k: mat[k].ravel() for k in names}
+    except NotImplementedError:
+        # v7.3 files are not supported by scipy.io
+        pass
+    import h5py  # pip install h5py
+    result = {}
+    with h5py.File(filename, 'r') as f:
+        for k in names:
+            ds = f[k]
+            offset = ds.id.get_offset()
+            if ds.chunks is None and ds.compression is None and offset is not None:
+                result[k] = np.memmap(filename, dtype=ds.dtype, mode='r', offset=offset, shape=ds.shape).ravel()
+            else:
+                result[k] = ds[()].ravel()
+    return result
@@ -1,7 +1,11 @@
 # This is not currently used by any preprocessing scripts or notebooks.
 # I am simply storing it here until/if I ever need it again.
 
+import os
+import json
+import hashlib
 import logging
+import tempfile
 import numpy as np
 from neuropype.engine.packet import Chunk
 from neuropype.engine.block import Block
@@ -9,8 +13,10 @@ from neuropype.engine.axes import InstanceAxis, instance
 from neuropype.engine.constants import Licenses, Flags
 from neuropype.engine.packet import Packet
 from neuropype.engine.node import Node, Description
-from neuropype.engine.ports import DataPort, StringPort, EnumPort
-from neuropype.utilities.cloud import storage
+from neuropype.engine.ports import DataPort, StringPort, EnumPort, BoolPort
+from .cloud_cache import cloud_get
+from .nev import read_digital_events
+from .instrumentation import instrumented, lap
 
 
 logger = logging.getLogger(__name__)
@@ -18,10 +24,18 @@ logger = logging.getLogger(__name__)
 
 class ImportReachGrasp(Node):
     # --- Input/output ports ---
-    data = DataPort(Packet, "Raw data loaded with ImportNSX", required=True,
+    data = DataPort(Packet, "Raw data loaded with ImportNSX (or any packet, "
+                            "e.g. an empty one, if nev_filename is set)", required=True,
                     editable=False, mutating=True)
 
-    filename = StringPort("", """Name of the event dataset.
+    nev_filename = StringPort("", """Name of the Blackrock .nev file of the
+                    session. If set, the digital events are read directly from
+                    this file (memory-mapped, without loading any neural data)
+                    instead of from the events chunk of the input packet.
+                    """, is_filename=True)
+
+    filename = StringPort("", """Name of the odML metadata file of the
+                    session. Only used if load_metadata is enabled.
                     """, is_filename=True)
 
     # options for cloud-hosted files
@@ -46,6 +60,23 @@ class ImportReachGrasp(Node):
             password or access token) for the the cloud storage provider. On some
             environments (e.g., on NeuroScale), this value will be
             default-initialized to the right credentials for you.""")
+    cache_dir = StringPort("", """Local cache directory. If set, cloud-hosted
+            files are downloaded into this directory once and reused on
+            subsequent runs (the environment variable CUSTOM_NEUROPYPE_CACHE_DIR
+            provides a default), and the metadata index of the odML file is
+            stored there as well (otherwise it is stored next to the file).""",
+            expert=True)
+    load_metadata = BoolPort(False, """Load session metadata from the odML
+            file. The fields listed in odml_fields (task condition, trial IDs
+            and electrode map) are parsed from the file once and stored in a
+            small JSON index that is reused until the file is modified. The
+            metadata is attached to the output chunks' properties under
+            'session_metadata'.""")
+    trial_table = BoolPort(False, """Also output a table of trials. If
+            enabled, the node adds a 'trials' chunk with one instance per trial
+            (starting at TS-ON) holding the times of the trial events, the trial
+            type, the grip and force types, and the performance code of the
+            trial.""")
 
     @classmethod
     def description(cls):
@@ -57,25 +88,41 @@ class ImportReachGrasp(Node):
                            license=Licenses.MIT)
 
     @data.setter
+    @instrumented
     def data(self, pkt):
-        if pkt is not None and 'events' in pkt.chunks:
-            blk = pkt.chunks['events'].block
-
-            # filename = storage.cloud_get(self.filename, host=self.cloud_host,
-            #                              account=self.cloud_account,
-            #                              bucket=self.cloud_bucket,
-            #                              credentials=self.cloud_credentials)
-            # logger.info("Loading behavior data from %s..." % filename)
-            # import odml.tools
-            # odmldoc = odml.tools.xmlparser.load(filename)
-
-            ev_times = blk.axes[instance].times
+        if pkt is not None and ('events' in pkt.chunks or self.nev_filename):
+            if self.nev_filename:
+                nev_filename = cloud_get(self.nev_filename, host=self.cloud_host,
+                                         account=self.cloud_account,
+                                         bucket=self.cloud_bucket,
+                                         credentials=self.cloud_credentials,
+                                         cache_dir=self.cache_dir)
+                logger.info("Reading digital events from %s..." % nev_filename)
+                ev_times, ev_codes = read_digital_events(nev_filename)
+                ev_labels = np.full(len(ev_times), 'digital_input_port', dtype=object)
+                lap('nev')
+            else:
+                blk = pkt.chunks['events'].block
+                ev_times, ev_codes = blk.axes[instance].times, blk.data
+                ev_labels = blk.axes[instance].data
+
+            metadata = None
+            if self.load_metadata:
+                filename = cloud_get(self.filename, host=self.cloud_host,
+                                     account=self.cloud_account,
+                                     bucket=self.cloud_bucket,
+                                     credentials=self.cloud_credentials,
+                                     cache_dir=self.cache_dir)
+                logger.info("Loading behavior data from %s..." % filename)
+                metadata = load_odml_index(filename, self.odml_fields, index_dir=self.cache_dir)
+                lap('metadata')
+
             if len(ev_times) > 0:
                 # Convert instance axis data to event marker strings
-                ev_strs = blk.axes[instance].data
-                for ev_ix, ev_str in enumerate(ev_strs):
-                    if ev_str == 'digital_input_port':
-                        ev_strs[ev_ix] = self.event_labels_str[str(blk.data[ev_ix])]
+                ev_strs = np.array(ev_labels, dtype=object)
+                b_digital = ev_strs == 'digital_input_port'
+                ev_strs[b_digital] = self.map_event_codes(ev_codes[b_digital])
+                lap('label_map')
 
                 marker_block = Block(data=np.nan * np.ones_like(ev_times),
                                      axes=(InstanceAxis(ev_times,
@@ -84,12 +131,119 @@ class ImportReachGrasp(Node):
                                            )
                                      )
                 marker_props = {Flags.has_markers: True}
+                if metadata is not None:
+                    marker_props['session_metadata'] = metadata
                 pkt.chunks.update({'markers': Chunk(block=marker_block, props=marker_props)})
+
+                if self.trial_table:
+                    tr_times, tr_data = self.reconstruct_trials(ev_times[b_digital],
+                                                                ev_codes[b_digital])
+                    trial_block = Block(data=np.full((len(tr_times),), np.nan),
+                                        axes=(InstanceAxis(tr_times, data=tr_data),))
+                    trial_props = {Flags.is_event_stream: True}
+                    if metadata is not None:
+                        trial_props['session_metadata'] = metadata
+                    pkt.chunks.update({'trials': Chunk(block=trial_block, props=trial_props)})
+                    lap('trial_table')
+
                 if 'events' in pkt.chunks:
                     del pkt.chunks['events']
 
         self._data = pkt
 
+    @classmethod
+    def map_event_codes(cls, codes):
+        """Map an array of digital event codes to their text labels. Codes
+        without a known label are mapped to 'UNKNOWN'."""
+        codes = np.asarray(codes).ravel()
+        label_ids = np.zeros(codes.shape, dtype=cls.event_code_lut.dtype)
+        b_valid = (codes >= 0) & (codes < len(cls.event_code_lut))
+        label_ids[b_valid] = cls.event_code_lut[codes[b_valid].astype(int)]
+        if not np.all(label_ids):
+            logger.warning("Unknown digital event codes: %s" % np.unique(codes[label_ids == 0]))
+        return cls.event_label_table[label_ids]
+
+    @classmethod
+    def reconstruct_trials(cls, times, codes):
+        """Reconstruct the trials of a session from its digital events.
+
+        A trial spans the events from one TS-ON up to the next. Within a trial,
+        the first and second WS-ON/CUE-OFF events are WS-ON and CUE-OFF, the
+        first and second CUE/GO events are CUE-ON and GO-ON, and the last STOP
+        (or TS-OFF/STOP) event ends the trial. The performance code is the
+        bitmask of the trial_const_sequence_codes events that occurred, or 0
+        (incomplete) for trials that never stopped.
+
+        Returns the trial start times and a record array with one row per trial.
+        """
+        times = np.asarray(times, dtype=float).ravel()
+        codes = np.asarray(codes).ravel().astype(int)
+        b_start = codes == int(cls.event_labels_codes['TS-ON'][0])
+        start_ix = np.flatnonzero(b_start)
+        n_trials = len(start_ix)
+        # Trial of each event (-1 before the first TS-ON).
+        ev_trial = np.cumsum(b_start) - 1
+        b_in_trial = ev_trial >= 0
+
+        def _occurrence(codes_str):
+            # Per event: trial, and number of the occurrence of any of the codes within its trial.
+            b_match = np.isin(codes, [int(_) for _ in codes_str]) & b_in_trial
+            count = np.cumsum(b_match)
+            before_trial = np.concatenate(([0], (count - b_match)[start_ix]))
+            occ = np.where(b_match, count - before_trial[ev_trial + 1], 0)
+            return b_match, occ
+
+        def _scatter(b_sel, values, fill):
+            out = np.full(n_trials, fill, dtype=np.asarray(values).dtype)
+            out[ev_trial[b_sel]] = values[b_sel]
+            return out
+
+        b_ws, occ_ws = _occurrence(cls.event_labels_codes['WS-ON/CUE-OFF'])
+        b_cue, occ_cue = _occurrence(cls.event_labels_codes['CUE/GO'])
+        b_sr, occ_sr = _occurrence(cls.event_labels_codes['SR'])
+        b_rw, occ_rw = _occurrence(cls.event_labels_codes['RW-ON'])
+        b_stop, occ_stop = _occurrence(cls.event_labels_codes['STOP'] + cls.event_labels_codes['TS-OFF/STOP'])
+        n_stop = np.bincount(ev_trial[b_stop] + 1, minlength=n_trials + 1)
+
+        seq_ix = {
+            'WS-ON': b_ws & (occ_ws == 1),
+            'CUE-ON': b_cue & (occ_cue == 1),
+            'CUE-OFF': b_ws & (occ_ws == 2),
+            'GO-ON': b_cue & (occ_cue == 2),
+            'SR': b_sr & (occ_sr == 1),
+            'RW-ON': b_rw & (occ_rw == 1),
+            'STOP': b_stop & (occ_stop == n_stop[ev_trial + 1]),
+        }
+        seq_times = {k: _scatter(b, times, np.nan) for k, b in seq_ix.items()}
+
+        perf = np.full(n_trials, 1 << cls.trial_const_sequence_codes['TS-ON'], dtype=int)
+        for k, t in seq_times.items():
+            perf[~np.isnan(t)] |= 1 << cls.trial_const_sequence_codes[k]
+        perf[np.isnan(seq_times['STOP'])] = cls.performance_codes['incomplete_trial']
+
+        # Trial type from the CUE-ON and GO-ON LED codes, e.g. 'SG' + 'HF' -> 'SGHF'.
+        # (all CUE/GO labels are of the form 'XX-ON', so we keep the first two characters)
+        cue_type = np.full(n_trials, '', dtype='<U2')
+        cue_type[ev_trial[seq_ix['CUE-ON']]] = cls.map_event_codes(codes[seq_ix['CUE-ON']]).astype('<U2')
+        go_type = np.full(n_trials, '', dtype='<U2')
+        go_type[ev_trial[seq_ix['GO-ON']]] = cls.map_event_codes(codes[seq_ix['GO-ON']]).astype('<U2')
+        trial_type = np.char.add(cue_type, go_type)
+        b_grip_first = np.isin(cue_type, ['SG', 'PG'])
+        grip_type = np.where(b_grip_first, cue_type, go_type)
+        force_type = np.where(b_grip_first, go_type, cue_type)
+
+        perf_str = np.full(256, 'unknown', dtype=object)
+        perf_str[list(cls.performance_str.keys())] = list(cls.performance_str.values())
+
+        tr_data = np.rec.fromarrays(
+            [np.arange(n_trials), seq_times['STOP'], seq_times['WS-ON'], seq_times['CUE-ON'],
+             seq_times['CUE-OFF'], seq_times['GO-ON'], seq_times['SR'], seq_times['RW-ON'],
+             trial_type.astype(object), grip_type.astype(object), force_type.astype(object),
+             perf, perf_str[perf]],
+            names=['TrialID', 'StopTime', 'WSTime', 'CueOnTime', 'CueOffTime', 'GoTime', 'SRTime',
+                   'RewardTime', 'TrialType', 'GripType', 'ForceType', 'PerformanceCode', 'Performance'])
+        return times[start_ix], tr_data
+
     """
         Attributes:
             condition_str (dict):
@@ -157,6 +311,17 @@ class ImportReachGrasp(Node):
                 example, performance_str['correct_trial'] == 255
         """
 
+    # Metadata fields to read from the odML file: name -> (section path,
+    # property name). A '*' in the section path matches any section, and
+    # yields one entry per matching section. Adjust these if a session's odML
+    # file uses a different layout.
+    odml_fields = {
+        'TaskCondition': ('Recording/TaskSettings', 'TaskCondition'),
+        'TrialIDs': ('Recording/TaskSettings', 'TrialIDs'),
+        'ElectrodeIDs': ('UtahArray/Array/*', 'ID'),
+        'ElectrodeConnectorIDs': ('UtahArray/Array/*', 'ConnectorAlignedID'),
+    }
+
     # Create a dictionary of conditions (i.e., the trial types presented in a
     # given recording session)
     condition_str = {
@@ -298,6 +463,14 @@ class ImportReachGrasp(Node):
         event_labels_codes['SR (+SGLF/LFSG)']
     del k, l, v
 
+    # Dense lookup table over the 16-bit digital event code space: entry c is
+    # the index into event_label_table of the label for code c, or 0 (unknown)
+    _labels, _label_ids = np.unique(list(event_labels_str.values()), return_inverse=True)
+    event_label_table = np.concatenate((['UNKNOWN'], _labels)).astype(object)
+    event_code_lut = np.zeros(2**16, dtype=np.uint8)
+    event_code_lut[np.array(list(event_labels_str.keys()), dtype=int)] = _label_ids.ravel() + 1
+    del _labels, _label_ids
+
     # Create dictionaries for constant trial sequences (in all monkeys)
     # (bit position (value) set if trial event (key) occurred)
     trial_const_sequence_codes = {
@@ -325,3 +498,113 @@ class ImportReachGrasp(Node):
         'correct_trial': 255}
     performance_str = dict((v, k) for k, v in performance_codes.items())
 
+
+def load_odml_index(filename, fields, index_dir=''):
+    """Get the given metadata fields of an odML file, using a JSON index file.
+
+    The index is stored next to the file as <filename>.index.json, or, in
+    index_dir (if given), as <filename>.<hash of its full path>.index.json, so
+    that the indices of sessions with the same file name do not collide. It is
+    discarded when the odML file's path, modification time or size changes.
+    Fields that are not yet in the index (or whose location has changed) are
+    parsed from the file and added to the index.
+    """
+    st = os.stat(filename)
+    source = os.path.abspath(filename)
+    if index_dir:
+        path_hash = hashlib.sha1(source.encode('utf-8')).hexdigest()[:16]
+        index_file = os.path.join(index_dir, '%s.%s.index.json' % (os.path.basename(filename), path_hash))
+    else:
+        index_file = source + '.index.json'
+    stamp = [st.st_mtime_ns, st.st_size]
+    index = {'source': source, 'stamp': stamp, 'locations': {}, 'fields': {}}
+    try:
+        with open(index_file, 'r') as f:
+            stored = json.load(f)
+        if stored.get('source') == source and stored.get('stamp') == stamp:
+            index = stored
+    except (OSError, ValueError):
+        pass
+    missing = {k: v for k, v in fields.items() if index['locations'].get(k) != list(v)}
+    if missing:
+        logger.info("Indexing odML metadata fields %s of %s..." % (sorted(missing), filename))
+        index['fields'].update(_parse_odml(filename, missing))
+        index['locations'].update({k: list(v) for k, v in missing.items()})
+        try:
+            os.makedirs(os.path.dirname(index_file), exist_ok=True)
+            fd, tmp_name = tempfile.mkstemp(dir=os.path.dirname(index_file), suffix='.tmp')
+            with os.fdopen(fd, 'w') as f:
+                json.dump(index, f)
+            os.replace(tmp_name, index_file)
+        except OSError as e:
+            logger.warning("Could not write odML index %s (%s)." % (index_file, e))
+    return {k: index['fields'][k] for k in fields}
+
+
+def _parse_odml(filename, fields):
+    """Read the given fields (name -> (section path, property name)) from an
+    odML XML file. The file is streamed, elements are discarded as soon as they
+    have been looked at, and parsing stops once all fields have been found."""
+    import xml.etree.ElementTree as ET
+    patterns = {k: (path.split('/'), prop) for k, (path, prop) in fields.items()}
+    result = {k: ([] if '*' in path else None) for k, (path, prop) in patterns.items()}
+    pending = set(fields)
+    sections = []   # names of the enclosing sections
+    tags = []       # tags of the enclosing elements
+    for event, elem in ET.iterparse(filename, events=('start', 'end')):
+        if event == 'start':
+            tags.append(elem.tag)
+            if elem.tag == 'section':
+                sections.append(None)
+            continue
+        tags.pop()
+        if elem.tag == 'name' and tags and tags[-1] == 'section':
+            sections[-1] = (elem.text or '').strip()
+        elif elem.tag == 'property' and tags and tags[-1] == 'section':
+            prop_name = (elem.findtext('name') or '').strip()
+            for k in list(pending):
+                path, prop = patterns[k]
+                if prop == prop_name and _odml_path_matches(sections, path):
+                    values = _odml_values(elem)
+                    value = values[0] if len(values) == 1 else values
+                    if isinstance(result[k], list):
+                        result[k].append(value)
+                    else:
+                        result[k] = value
+                        pending.discard(k)
+            elem.clear()
+        elif elem.tag == 'section':
+            # a wildcard field is complete once the parent of its sections ends
+            for k in list(pending):
+                path, prop = patterns[k]
+                if '*' in path and sections == path[:path.index('*')]:
+                    pending.discard(k)
+            sections.pop()
+            elem.clear()
+        if not pending:
+            break
+    return result
+
+
+def _odml_path_matches(sections, path):
+    return len(sections) == len(path) and all(p in ('*', s) for s, p in zip(sections, path))
+
+
+def _odml_values(prop):
+    """Get the values of an odML property element as a list. Handles both the
+    one-<value>-per-entry layout (with the <type> inside <value>) of odML 1.0
+    and the '[a, b, ...]' layout of newer versions."""
+    dtype = prop.findtext('type')
+    texts = []
+    for v in prop.iter('value'):
+        dtype = v.findtext('type') or dtype
+        text = (v.text or '').strip()
+        if text.startswith('[') and text.endswith(']'):
+            texts.extend(t.strip() for t in text[1:-1].split(',') if t.strip())
+        elif text:
+            texts.append(text)
+    convert = {'int': int, 'float': float}.get((dtype or '').strip(), str)
+    try:
+        return [convert(t) for t in texts]
+    except ValueError:
+        return texts
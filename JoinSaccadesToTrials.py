@@ -0,0 +1,167 @@
+import logging
+import numpy as np
+from neuropype.engine import *
+from .columnar import CATEGORIES_PROP
+from .instrumentation import instrumented, lap
+
+logger = logging.getLogger(__name__)
+
+
+class JoinSaccadesToTrials(Node):
+    # --- Input/output ports ---
+    data = Port(None, Packet, "Data to process.", required=True,
+                editable=False, mutating=True)
+
+    # --- Properties ---
+    marker_chunk = StringPort('markers', """Name of the chunk with the trial
+            markers, as produced by GetUnityTaskEvents.""")
+    saccade_chunk = StringPort('', """Name of the chunk with the eye movement
+            events, as produced by NSLRHMM. If empty, the first event chunk with
+            EndTime and Amp fields is used.""")
+    go_marker = StringPort('Go', """Marker at which the saccade latency is
+            measured.""")
+    saccade_marker = StringPort('Saccade', """Marker of the saccade events.""")
+    min_latency = FloatPort(0.0, None, """Minimum latency of the saccade, in
+            seconds. Saccades that start earlier after the go marker (e.g.,
+            anticipatory saccades) are skipped.""")
+    max_latency = FloatPort(1.0, None, """Maximum latency of the saccade, in
+            seconds. If no saccade starts within this time after the go marker,
+            the saccade fields of the trial are NaN.""")
+    min_amplitude = FloatPort(0.0, None, """Minimum amplitude of the saccade, in
+            degrees. Smaller saccades (e.g., microsaccades) are skipped.""")
+    update_reaction_time = BoolPort(True, """Replace the ReactionTime of the
+            trials with the saccade latency. GetUnityTaskEvents computes the
+            reaction time from the first input event of the response period; if
+            enabled, trials with a saccade get its latency instead (trials
+            without one keep their original value).""")
+
+    @classmethod
+    def description(cls):
+        return Description(name='Join Saccades to Trials',
+                           description="""Attach the first saccade after the go marker of each
+                           trial to the trial markers. The saccades (from NSLRHMM) and the go
+                           markers (from GetUnityTaskEvents) are matched with a sorted join, and
+                           the latency, duration, amplitude and direction (in degrees,
+                           counter-clockwise from rightward) of the saccade are added as
+                           fields SaccadeLatency, SaccadeDuration, SaccadeAmplitude and
+                           SaccadeDirection to all markers of the trial.""",
+                           version='0.1',
+                           license=Licenses.MIT)
+
+    @data.setter
+    @instrumented
+    def data(self, pkt):
+        mrk_chnk = pkt.chunks.get(self.marker_chunk) if pkt is not None else None
+        sac_chnk = self._find_saccade_chunk(pkt) if mrk_chnk is not None else None
+        if sac_chnk is not None:
+            mrk_ax = mrk_chnk.block.axes[instance]
+            sac_ax = sac_chnk.block.axes[instance]
+            mrk_data, sac_data = mrk_ax.data, sac_ax.data
+            mrk_trials = self._trial_keys(mrk_ax.times, mrk_data['UnityTrialIndex'])
+
+            # Go markers (one per trial)
+            b_go = self._is_marker(mrk_data['Marker'], mrk_chnk, self.go_marker)
+            go_times = np.asarray(mrk_ax.times)[b_go]
+            go_trials = mrk_trials[b_go]
+
+            # Saccades, sorted by start time
+            b_sac = self._is_marker(sac_data['Marker'], sac_chnk, self.saccade_marker)
+            b_sac &= np.asarray(sac_data['Amp']) >= self.min_amplitude
+            sac_ix = np.flatnonzero(b_sac)
+            sac_ix = sac_ix[np.argsort(np.asarray(sac_ax.times)[sac_ix], kind='stable')]
+            sac_starts = np.asarray(sac_ax.times)[sac_ix]
+            lap('select')
+
+            # First saccade that starts at least min_latency after each go marker
+            first = np.searchsorted(sac_starts, go_times + self.min_latency, side='left')
+            found = first < len(sac_starts)
+            first = sac_ix[np.minimum(first, len(sac_ix) - 1)] if len(sac_ix) else first
+            latency = np.full(len(go_times), np.nan)
+            latency[found] = np.asarray(sac_ax.times)[first[found]] - go_times[found]
+            found &= latency <= self.max_latency
+            latency[~found] = np.nan
+
+            def _per_go(values):
+                out = np.full(len(go_times), np.nan)
+                out[found] = np.asarray(values, dtype=float)[first[found]]
+                return out
+            duration = _per_go(sac_data['Duration'])
+            amplitude = _per_go(sac_data['Amp'])
+            direction = np.degrees(np.arctan2(_per_go(sac_data['PosY']) - _per_go(sac_data['StartY']),
+                                              _per_go(sac_data['PosX']) - _per_go(sac_data['StartX'])))
+            lap('join')
+
+            # Spread the per-trial values over all markers of the trial
+            order = np.argsort(go_trials, kind='stable')
+            pos = np.minimum(np.searchsorted(go_trials[order], mrk_trials), max(len(order) - 1, 0))
+            has_go = (go_trials[order][pos] == mrk_trials) if len(order) else np.zeros(len(mrk_trials), bool)
+            row_go = order[pos] if len(order) else pos
+
+            def _per_row(values):
+                out = np.full(len(mrk_trials), np.nan)
+                out[has_go] = values[row_go[has_go]]
+                return out
+            new_fields = [('SaccadeLatency', _per_row(latency)),
+                          ('SaccadeDuration', _per_row(duration)),
+                          ('SaccadeAmplitude', _per_row(amplitude)),
+                          ('SaccadeDirection', _per_row(direction))]
+            new_data = self._with_fields(mrk_data, new_fields)
+            if self.update_reaction_time and 'ReactionTime' in new_data.dtype.names:
+                b_sacc = ~np.isnan(new_data['SaccadeLatency'])
+                new_data['ReactionTime'][b_sacc] = new_data['SaccadeLatency'][b_sacc]
+            mrk_chnk.block = Block(data=mrk_chnk.block.data,
+                                   axes=(InstanceAxis(times=mrk_ax.times, data=new_data,
+                                                      instance_type='markers'),))
+            lap('table_build')
+            logger.info("Found saccades in %d of %d trials." % (np.sum(found), len(go_times)))
+
+        self._data = pkt
+
+    def _find_saccade_chunk(self, pkt):
+        if self.saccade_chunk:
+            return pkt.chunks.get(self.saccade_chunk)
+        for n, chnk in enumerate_chunks(pkt, with_axes=(instance,)):
+            names = getattr(chnk.block.axes[instance].data, 'dtype', np.dtype(float)).names or ()
+            if 'EndTime' in names and 'Amp' in names:
+                return chnk
+        return None
+
+    @staticmethod
+    def _trial_keys(times, trial_index):
+        """Unique key of the trial of each marker. UnityTrialIndex restarts
+        in each Unity file, so when several files were concatenated it is not
+        unique; instead, the trials are counted in time order, with a new
+        trial wherever the trial index changes."""
+        order = np.argsort(np.asarray(times), kind='stable')
+        index = np.asarray(trial_index)[order]
+        new_trial = np.ones(len(index), dtype=bool)
+        new_trial[1:] = index[1:] != index[:-1]
+        keys = np.empty(len(index), dtype=np.int64)
+        keys[order] = np.cumsum(new_trial) - 1
+        return keys
+
+    @staticmethod
+    def _is_marker(markers, chnk, marker):
+        """Mask of the instances with the given marker (which may be
+        dictionary-encoded, see columnar)."""
+        props = chnk.props if isinstance(chnk.props, dict) else {}
+        categories = props.get(CATEGORIES_PROP, {})
+        if 'Marker' in categories:
+            code = np.flatnonzero(np.asarray(categories['Marker']) == marker)
+            return np.asarray(markers) == (code[0] if len(code) else -2)
+        return np.asarray(markers) == marker
+
+    @staticmethod
+    def _with_fields(data, new_fields):
+        """Copy of a record array with float fields appended (or replaced)."""
+        descr, names = [], [n for n in data.dtype.names if n not in dict(new_fields)]
+        for name in names:
+            field = data.dtype.fields[name]
+            descr.append(((field[2], name) if len(field) > 2 else name, field[0]))
+        descr += [((ValueProperty.UNKNOWN, name), float) for name, _ in new_fields]
+        out = np.empty(len(data), dtype=descr)
+        for name in names:
+            out[name] = data[name]
+        for name, values in new_fields:
+            out[name] = values
+        return out
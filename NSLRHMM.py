@@ -1,9 +1,16 @@
 import logging
+import warnings
+from typing import Union, Type
 import numpy as np
 from neuropype.engine import *
+from .instrumentation import instrumented, lap
+from .columnar import encode_records, CATEGORIES_PROP
 
 logger = logging.getLogger(__name__)
 
+# chunk property of the denoised gaze chunks that holds the original time grid
+TIME_GRID_PROP = 'time_grid'
+
 
 class NSLRHMM(Node):
     # --- Input/output ports ---
@@ -15,7 +22,62 @@ class NSLRHMM(Node):
     saccade_amplitude = FloatPort(3.0)
     slow_phase_duration = FloatPort(0.3)
     slow_phase_speed = FloatPort(5.0)
-    optimize_noise = BoolPort(True)
+    optimize_noise = BoolPort(True, """Deprecated and ignored: use
+            noise_mode='optimize' instead.""", expert=True)
+    noise_mode = EnumPort('fixed', ['fixed', 'auto', 'optimize'], """How to
+            set the noise level of the segmentation. fixed uses noise_std.
+            auto estimates the noise of each channel from noise_windows
+            windows of noise_window_length seconds spread evenly over the
+            recording (robustly, from the median absolute second difference of
+            the signal, which is insensitive to saccades and to smooth
+            movement), keeps the estimate for the recording and channel pair,
+            and then runs the fast fixed-noise segmentation with it. When
+            streaming, the windows are collected from successive packets
+            until there are noise_windows of them; a new recording starts
+            where the time stamps jump backwards or by more than
+            noise_window_length. optimize fits the noise level over the whole
+            recording (nslr.fit_gaze with optimize_noise), which is much
+            slower.""")
+    noise_windows = IntPort(20, None, """Number of windows to estimate the
+            noise from (if noise_mode is auto).""")
+    noise_window_length = FloatPort(2.0, None, """Length of the windows to
+            estimate the noise from, in seconds (if noise_mode is auto).""")
+    categorical_columns = BoolPort(False, """Dictionary-encode the Marker
+            column of the event table. If enabled, Marker holds integer codes
+            into a sorted table of the segment classes, which is stored in the
+            chunk's properties under 'categories' ({'Marker': array of class
+            names}).""")
+    output_denoised = BoolPort(False, """Also output the denoised
+            (piecewise-linear) gaze signal, as a chunk named <chunk>_denoised
+            that holds only the breakpoints of the segments: an instance axis
+            with the start and end time of each segment and a space axis with
+            the channels. Use resample_denoised() to evaluate it on the
+            original time grid (stored compactly in the chunk's properties) or
+            on any other grid, without a full-rate copy of the signal.""")
+
+    def __init__(self,
+                 noise_std: Union[list, None, Type[Keep]] = Keep,
+                 saccade_amplitude: Union[float, None, Type[Keep]] = Keep,
+                 slow_phase_duration: Union[float, None, Type[Keep]] = Keep,
+                 slow_phase_speed: Union[float, None, Type[Keep]] = Keep,
+                 optimize_noise: Union[bool, None, Type[Keep]] = Keep,
+                 noise_mode: Union[str, None, Type[Keep]] = Keep,
+                 noise_windows: Union[int, None, Type[Keep]] = Keep,
+                 noise_window_length: Union[float, None, Type[Keep]] = Keep,
+                 categorical_columns: Union[bool, None, Type[Keep]] = Keep,
+                 output_denoised: Union[bool, None, Type[Keep]] = Keep,
+                 **kwargs):
+        """Create a new node. Accepts initial values for the ports."""
+        if optimize_noise is not Keep:
+            logger.warning("NSLRHMM.optimize_noise is deprecated and ignored; use noise_mode='optimize'.")
+        # noise estimation state of the current recording, by (chunk name,
+        # channel names)
+        self._noise = {}
+        super().__init__(noise_std=noise_std, saccade_amplitude=saccade_amplitude,
+                         slow_phase_duration=slow_phase_duration, slow_phase_speed=slow_phase_speed,
+                         optimize_noise=optimize_noise, noise_mode=noise_mode, noise_windows=noise_windows,
+                         noise_window_length=noise_window_length, categorical_columns=categorical_columns,
+                         output_denoised=output_denoised, **kwargs)
 
     @classmethod
     def description(cls):
@@ -33,7 +95,9 @@ class NSLRHMM(Node):
                            license=Licenses.MIT)
 
     @data.setter
+    @instrumented
     def data(self, pkt):
+        denoised = {}
         for n, chnk in enumerate_chunks(pkt, nonempty=True, only_signals=True, with_axes=(time,)):
             import nslr
             import nslr_hmm
@@ -42,16 +106,22 @@ class NSLRHMM(Node):
             ts = chnk.block.axes[time].times
             xs = chnk.block[time, ...].data
             # Segmentation using Pruned Exact Linear Time (PELT)
-            if True:
-                splitter = nslr.gaze_split(np.mean(self.noise_std), saccade_amplitude=self.saccade_amplitude,
+            if self.noise_mode != 'optimize':
+                noise_std = self.noise_std
+                if self.noise_mode == 'auto':
+                    noise_std = self._recording_noise(n, chnk.block.axes[space].names, ts, xs)
+                    lap('noise_estimate')
+                splitter = nslr.gaze_split(np.mean(noise_std), saccade_amplitude=self.saccade_amplitude,
                                            slow_phase_duration=self.slow_phase_duration,
                                            slow_phase_speed=self.slow_phase_speed)
-                model = nslr.Nslr2d(self.noise_std, splitter)
+                model = nslr.Nslr2d(noise_std, splitter)
                 segmentation = nslr.nslr2d(ts, xs, model)
             else:
                 segmentation = nslr.fit_gaze(ts, xs, structural_error=np.mean(self.noise_std),
-                                             optimize_noise=self.optimize_noise)
+                                             optimize_noise=True)
+            lap('segmentation')
             seg_classes = nslr_hmm.classify_segments(segmentation.segments)
+            lap('classification')
 
             if False:
                 COLORS = {
@@ -93,13 +163,135 @@ class NSLRHMM(Node):
             ev_df = pd.DataFrame(ev_dict)
 
             ev_dat = ev_df.drop(['StartTime'], axis=1).to_records(index=False)
+            ev_props = {Flags.is_event_stream: True}
+            if self.categorical_columns:
+                ev_dat, ev_props[CATEGORIES_PROP] = encode_records(ev_dat)
             ev_blk = Block(data=np.nan * np.ones((len(ev_dat),)),
                            axes=(InstanceAxis(ev_df['StartTime'], data=ev_dat),))
 
-            pkt.chunks[n] = Chunk(block=ev_blk, props=[Flags.is_event_stream])
+            pkt.chunks[n] = Chunk(block=ev_blk, props=ev_props)
+            lap('event_table')
 
+            if self.output_denoised:
+                # breakpoints: start and end of each segment, in order
+                bp_times = seg_ts.T.ravel()
+                bp_data = seg_xs.transpose(2, 0, 1).reshape(-1, seg_xs.shape[1])
+                bp_blk = Block(data=bp_data, axes=(InstanceAxis(bp_times),
+                                                   SpaceAxis(names=chnk.block.axes[space].names)))
+                denoised[n + '_denoised'] = Chunk(block=bp_blk, props={TIME_GRID_PROP: _time_grid(ts)})
+                lap('denoised')
+
+        pkt.chunks.update(denoised)
         self._data = pkt
 
+    def _recording_noise(self, name, channels, ts, xs):
+        """Noise std of each channel of the recording that the given (time x
+        channel) data continues. The estimate is the median over up to
+        noise_windows windows, which are taken from each packet until there
+        are that many; falls back to noise_std per channel where no estimate
+        is possible (yet)."""
+        ts, xs = np.asarray(ts, dtype=float), np.asarray(xs, dtype=float)
+        key = (name, tuple(channels))
+        rec = self._noise.get(key)
+        if rec is None or ts[0] < rec['last'] or ts[0] - rec['last'] > self.noise_window_length:
+            # new recording (or a discontinuity in this one)
+            rec = self._noise[key] = {'windows': np.zeros((0,) + xs.shape[1:]), 'pending': None}
+        rec['last'] = ts[-1]
+        needed = int(self.noise_windows) - len(rec['windows'])
+        if needed > 0:
+            if rec['pending'] is not None:
+                # samples of previous packets that were too short for a window
+                ts = np.concatenate((rec['pending'][0], ts))
+                xs = np.concatenate((rec['pending'][1], xs))
+            windows = self._window_noise(ts, xs, needed)
+            rec['windows'] = np.concatenate((rec['windows'], windows))
+            rec['pending'] = (ts, xs) if len(windows) == 0 else None
+            if len(rec['windows']) >= self.noise_windows:
+                logger.info("Estimated noise std of %s: %s" % (name, np.nanmedian(rec['windows'], axis=0)))
+        fallback = np.broadcast_to(np.asarray(self.noise_std, dtype=float), xs.shape[1:])
+        if len(rec['windows']):
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore', RuntimeWarning)
+                noise = np.nanmedian(rec['windows'], axis=0)
+        elif len(ts) >= 3:
+            # provisional estimate from all the (less than a window of) data so far
+            noise = _mad_noise(xs[None])[0]
+        else:
+            return fallback.tolist()
+        ok = np.isfinite(noise) & (noise > 0)
+        return np.where(ok, noise, fallback).tolist()
+
+    def _window_noise(self, ts, xs, max_windows):
+        """Noise std of each channel of the (time x channel) data in up to
+        max_windows evenly spaced windows of noise_window_length; returns a
+        (window x channel) array, with no windows if the data is shorter than
+        one."""
+        srate = (len(ts) - 1) / (ts[-1] - ts[0]) if len(ts) > 1 and ts[-1] > ts[0] else 0.0
+        win = max(int(self.noise_window_length * srate), 3)
+        n_win = min(int(max_windows), len(ts) // win)
+        if n_win < 1:
+            return np.zeros((0,) + xs.shape[1:])
+        starts = np.linspace(0, len(ts) - win, n_win).astype(int)
+        # (window, sample, channel)
+        return _mad_noise(xs[starts[:, None] + np.arange(win)])
+
+    def on_signal_changed(self):
+        """Callback to reset internal state when an input wire has been
+        changed."""
+        self._noise = {}
+
+    def on_port_assigned(self):
+        """Callback to reset internal state when a value was assigned to a
+        port (unless the port's setter has been overridden)."""
+        self._noise = {}
+        self.signal_changed(True)
+
+
+def _mad_noise(windows):
+    """Noise std of each channel in each (window, sample, channel) window.
+    For white noise of std s on a locally linear signal, the second difference
+    has std s*sqrt(6); the median absolute deviation ignores the few samples
+    around saccades (and NaNs from blinks)."""
+    d2 = np.diff(windows, n=2, axis=1)
+    with np.errstate(invalid='ignore'), warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        mad = np.nanmedian(np.abs(d2 - np.nanmedian(d2, axis=1, keepdims=True)), axis=1)
+    return mad / 0.6745 / np.sqrt(6)
+
+
+def resample_denoised(chunk, times=None):
+    """Evaluate a denoised gaze chunk (see NSLRHMM.output_denoised) at the
+    given times (default: the time grid of the original signal) by linear
+    interpolation between the breakpoints; times outside the segments give
+    NaN. Returns a (channel x time) array."""
+    if times is None:
+        grid = chunk.props[TIME_GRID_PROP]
+        times = grid['start'] + np.arange(grid['count']) / grid['rate'] if 'rate' in grid else grid['times']
+    times = np.asarray(times, dtype=float)
+    bp_times = np.asarray(chunk.block.axes[instance].times, dtype=float)
+    bp_data = np.asarray(chunk.block.data, dtype=float)
+    if len(bp_times) < 2:
+        return np.full((bp_data.shape[1], len(times)), np.nan)
+    # one search for all channels
+    k = np.clip(np.searchsorted(bp_times, times, side='right') - 1, 0, len(bp_times) - 2)
+    span = bp_times[k + 1] - bp_times[k]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        w = np.where(span > 0, (times - bp_times[k]) / span, 0.0)
+    out = bp_data[k] + w[:, None] * (bp_data[k + 1] - bp_data[k])
+    out[(times < bp_times[0]) | (times > bp_times[-1])] = np.nan
+    return out.T
+
+
+def _time_grid(ts):
+    """Compact description of a time grid: start, rate and count if it is
+    regular, else the times."""
+    ts = np.asarray(ts, dtype=float)
+    if len(ts) > 1:
+        rate = (len(ts) - 1) / (ts[-1] - ts[0]) if ts[-1] > ts[0] else 0.0
+        if rate > 0 and np.allclose(ts, ts[0] + np.arange(len(ts)) / rate, rtol=0, atol=1e-3 / rate):
+            return {'start': float(ts[0]), 'rate': float(rate), 'count': len(ts)}
+    return {'times': ts}
+
 
 """
 Notes.
@@ -1,6 +1,9 @@
 import logging
+from typing import Union, Type
 import numpy as np
 from neuropype.engine import *
+from .executors import cpu_budget, thread_pool
+from .instrumentation import instrumented, lap
 
 logger = logging.getLogger(__name__)
 
@@ -12,6 +15,40 @@ class PupilToAngle(Node):
 
     # --- Properties ---
     use_3d_gaze = BoolPort(True, help="""Use 3D gaze data. Else use 2D norm position.""")
+    num_threads = IntPort(1, help="""Number of threads to convert with. Long
+            chunks are split into blocks of block_size samples, which are
+            converted concurrently (together with the blocks of any other gaze
+            chunks in the packet) into a preallocated output. 0 uses one thread
+            per CPU.""", expert=True)
+    block_size = IntPort(65536, help="""Number of samples per block when
+            converting with multiple threads.""", expert=True)
+    output_velocity = BoolPort(False, help="""Also output the angular speed
+            of the gaze, in deg/s, as channel gaze_speed_deg_s, and a mask of
+            invalid samples (e.g., blinks) as channel gaze_invalid (1 if the
+            speed exceeds max_velocity or is undefined, else 0). The speed is
+            the derivative of the gaze angles with respect to the time stamps
+            of the time axis, and is computed within each chunk.""")
+    max_velocity = FloatPort(1000.0, help="""Maximum plausible angular speed,
+            in deg/s. Faster samples are marked as invalid.""")
+    smoothing_window = IntPort(0, help="""Length of the Savitzky-Golay
+            smoothing window for the speed, in samples (odd). If 0, the speed
+            is computed from central differences without smoothing.""")
+    smoothing_order = IntPort(2, help="""Polynomial order of the
+            Savitzky-Golay smoothing.""", expert=True)
+
+    def __init__(self,
+                 use_3d_gaze: Union[bool, None, Type[Keep]] = Keep,
+                 num_threads: Union[int, None, Type[Keep]] = Keep,
+                 block_size: Union[int, None, Type[Keep]] = Keep,
+                 output_velocity: Union[bool, None, Type[Keep]] = Keep,
+                 max_velocity: Union[float, None, Type[Keep]] = Keep,
+                 smoothing_window: Union[int, None, Type[Keep]] = Keep,
+                 smoothing_order: Union[int, None, Type[Keep]] = Keep,
+                 **kwargs):
+        """Create a new node. Accepts initial values for the ports."""
+        super().__init__(use_3d_gaze=use_3d_gaze, num_threads=num_threads, block_size=block_size,
+                         output_velocity=output_velocity, max_velocity=max_velocity,
+                         smoothing_window=smoothing_window, smoothing_order=smoothing_order, **kwargs)
 
     @classmethod
     def description(cls):
@@ -23,34 +60,86 @@ class PupilToAngle(Node):
                            license=Licenses.MIT)
 
     @data.setter
+    @instrumented
     def data(self, pkt):
+        # (chunk, gaze data, preallocated output) of each gaze chunk; the output
+        # holds the angles, followed by the speed and invalid mask if requested
+        out_names = ['gaze_ang_deg_' + _ for _ in ['x', 'y']]
+        if self.output_velocity:
+            out_names += ['gaze_speed_deg_s', 'gaze_invalid']
+        tasks = []
         for n, chnk in enumerate_chunks(pkt, nonempty=True, only_signals=True, with_axes=(time,)):
-
             if self.use_3d_gaze:
                 keep_chans = ['gaze_point_3d_' + _ for _ in ['x', 'y', 'z']]
-                dat_3d = chnk.block[space[keep_chans], ...].data.astype(np.float32)
-                # Sometimes it is possible that the predicted gaze is
-                # behind the camera which is physically impossible.
-                dat_3d[:, dat_3d[2, :] < 0] *= -1.0
             else:
                 keep_chans = ['norm_pos_' + _ for _ in ['x', 'y']]
-                dat_2d = chnk.block[space[keep_chans], ...].data.astype(np.float32)
-                width, height = [1000, 1000]
-                dat_2d[0] *= width
-                dat_2d[1] = (1.0 - dat_2d[1]) * height
-                dat_3d = unprojectPoints(dat_2d)
-
-            # Convert x,y,z to degrees visual angle.
-            r, theta, psi = cart_to_spherical(dat_3d)
-            angles = [theta, psi]
-            angles = np.rad2deg(angles)
-            ang_axes = (SpaceAxis(names=['gaze_ang_deg_' + _ for _ in ['x', 'y']]),
+            dat = chnk.block[space[keep_chans], ...].data
+            tasks.append((chnk, dat, np.empty((len(out_names),) + dat.shape[1:], dtype=np.float32)))
+
+        # Convert x,y,z to degrees visual angle, block by block.
+        n_threads = min(self.num_threads or cpu_budget(), cpu_budget())
+        blocks = []
+        for _, dat, angles in tasks:
+            step = max(int(self.block_size) if n_threads > 1 else dat.shape[1], 1)
+            blocks += [(dat, angles, start, start + step) for start in range(0, dat.shape[1], step)]
+        if n_threads > 1 and len(blocks) > 1:
+            list(thread_pool('PupilToAngle', n_threads).map(lambda b: self._convert_block(*b), blocks))
+        else:
+            for b in blocks:
+                self._convert_block(*b)
+        lap('convert')
+
+        if self.output_velocity:
+            for chnk, _, out in tasks:
+                self._velocity(out[:2], chnk.block.axes[time].times, speed=out[2], invalid=out[3])
+            lap('velocity')
+
+        for chnk, _, out in tasks:
+            ang_axes = (SpaceAxis(names=out_names),
                         deepcopy_most(chnk.block.axes[time]))
-            ang_blk = Block(data=angles, axes=ang_axes)
+            ang_blk = Block(data=out, axes=ang_axes)
             chnk.block = concat(space, chnk.block, ang_blk)
+        lap('concat')
 
         self._data = pkt
 
+    def _convert_block(self, dat, angles, start, stop):
+        """Convert the samples start:stop of the gaze data into angles."""
+        if self.use_3d_gaze:
+            dat_3d = dat[:, start:stop].astype(np.float32)
+            # Sometimes it is possible that the predicted gaze is
+            # behind the camera which is physically impossible.
+            dat_3d[:, dat_3d[2, :] < 0] *= -1.0
+        else:
+            dat_2d = dat[:, start:stop].astype(np.float32)
+            width, height = [1000, 1000]
+            dat_2d[0] *= width
+            dat_2d[1] = (1.0 - dat_2d[1]) * height
+            dat_3d = unprojectPoints(dat_2d)
+        r, theta, psi = cart_to_spherical(dat_3d)
+        np.rad2deg(theta, out=angles[0, start:stop])
+        np.rad2deg(psi, out=angles[1, start:stop])
+
+    def _velocity(self, angles, times, speed, invalid):
+        """Write the angular speed of the (2 x samples) angles and the mask of
+        invalid samples into the given arrays."""
+        times = np.asarray(times, dtype=float)
+        if len(times) < 2:
+            speed[:] = np.nan
+            invalid[:] = 1.0
+            return
+        window = int(self.smoothing_window) | 1 if self.smoothing_window else 0
+        if self.smoothing_order < window <= len(times):
+            from scipy.signal import savgol_filter
+            # derivative per sample, divided by the time per sample
+            d_ang = savgol_filter(angles, window, self.smoothing_order, deriv=1, axis=-1)
+            d_ang /= np.gradient(times)
+        else:
+            d_ang = np.gradient(angles, times, axis=-1)
+        np.hypot(d_ang[0], d_ang[1], out=speed)
+        with np.errstate(invalid='ignore'):
+            np.logical_not(speed <= self.max_velocity, out=invalid, casting='unsafe')
+
 
 def cart_to_spherical(xyz):
     # convert to spherical coordinates
@@ -5,15 +5,22 @@
 # This example code shows how to implement a wrapper for a scikit-learn
 # compatible machine learning algorithm as a NeuroPype node.
 
+import os
 import logging
 import numpy as np
 from neuropype.engine import *
-from neuropype.utilities.helpers import scoring_options
-from neuropype.nodes.machine_learning._shared import apply_predictor
+from .executors import blas_threads
+from .instrumentation import instrumented, lap
 
 
 logger = logging.getLogger(__name__)
 
+# format of the models in the model cache; bump this whenever the contents of
+# the trained models change, so that older cache files are not loaded
+_CACHE_FORMAT = 2
+# axis attributes that identify the ticks of an axis (whichever it has)
+_AXIS_TICKS = ('times', 'names', 'frequencies', 'lags', 'positions', 'units', 'data')
+
 
 class VariantLDA(Node):
     """Use Varying Linear Discriminant Analysis to classify data instances."""
@@ -91,6 +98,25 @@ class VariantLDA(Node):
         by a BakeDesignMatrix node.""", expert=True)
     n_components = IntPort(default=None, help="""The number of components to keep in the
         reduced model""")
+    svd_solver = EnumPort('auto', ['auto', 'full', 'randomized'], """Solver
+        used to decompose the model weights when n_components is set. full
+        computes an exact SVD of every class's weights in one batched call;
+        randomized uses a batched randomized range finder, which is much faster
+        when n_components is small relative to the number of models. auto
+        picks randomized when the weight matrices are large and n_components is
+        less than 80% of their smallest dimension.""",
+        verbose_name='weight decomposition solver', expert=True)
+    random_seed = IntPort(12345, None, """Random seed for the randomized
+        weight decomposition. Different values may give slightly different
+        (but equally valid) reduced models.""", verbose_name='random seed',
+        expert=True)
+    cache_dir = StringPort("", """Directory in which to cache trained models.
+        If set, the model is stored on disk after training, keyed by a
+        fingerprint of the training data, the labels and all settings that
+        affect training; when the node is later trained on identical data with
+        identical settings (e.g., when an offline evaluation graph is re-run),
+        the stored model is loaded instead of being retrained. Leave empty to
+        disable.""", verbose_name='trained model cache directory', expert=True)
 
     def __init__(self,
                  probabilistic: Union[bool, None, Type[Keep]] = Keep,
@@ -104,6 +130,9 @@ class VariantLDA(Node):
                  verbosity: Union[int, None, Type[Keep]] = Keep,
                  cond_field: Union[str, None, Type[Keep]] = Keep,
                  n_components: Union[int, None, Type[Keep]] = Keep,
+                 svd_solver: Union[str, None, Type[Keep]] = Keep,
+                 random_seed: Union[int, None, Type[Keep]] = Keep,
+                 cache_dir: Union[str, None, Type[Keep]] = Keep,
                  **kwargs):
         """Create a new node. Accepts initial values for the ports."""
         # unlike many other NeuroPype nodes, machine learning nodes usually do
@@ -115,7 +144,8 @@ class VariantLDA(Node):
         super().__init__(probabilistic=probabilistic, solver=solver, class_weights=class_weights, tolerance=tolerance,
                          shrinkage=shrinkage, initialize_once=initialize_once, dont_reset_model=dont_reset_model,
                          smoothing_window=smoothing_window, verbosity=verbosity, cond_field=cond_field,
-                         n_components=n_components, **kwargs)
+                         n_components=n_components, svd_solver=svd_solver, random_seed=random_seed,
+                         cache_dir=cache_dir, **kwargs)
 
     @classmethod
     def description(cls):
@@ -127,6 +157,7 @@ class VariantLDA(Node):
                            version='0.1.0', status=DevStatus.alpha)
 
     @data.setter
+    @instrumented
     def data(self, v):
         # this call is the canonical way to get the training data and optionally
         # training labels from the given Packet v; if one or both of these items
@@ -134,6 +165,16 @@ class VariantLDA(Node):
         X, y, X_n = extract_chunks(v, collapse_features=False, y_column=self.cond_field, return_data_chunk_label=True)
         # determine whether the model shall be trained
         init_flag = (not self.initialize_once) or (X_n not in self.M)
+        # if enabled, try to reuse a model previously trained on identical data
+        cache_file = None
+        if X is not None and y is not None and init_flag and self.cache_dir:
+            cache_file = self._cache_file(X, y)
+            cached = self._load_cached_model(cache_file)
+            if cached is not None:
+                logger.info("Loaded trained model from cache file %s." % cache_file)
+                self.M[X_n] = cached
+                init_flag = False
+            lap('cache_load')
         # check if all conditions are met to (re)train
         if X is not None and y is not None and init_flag:
             # generally we're deferring heavy imports until they're actually
@@ -163,7 +204,7 @@ class VariantLDA(Node):
 
             # bidirectional smoothing over independent_axis
             if self.smoothing_window > 1:
-                from scipy.ndimage.filters import uniform_filter1d
+                from scipy.ndimage import uniform_filter1d
                 # First forwards
                 data = uniform_filter1d(data.reshape(n_models, -1)[::-1], size=self.smoothing_window,
                                         axis=0, mode='nearest')
@@ -171,6 +212,8 @@ class VariantLDA(Node):
                 data = uniform_filter1d(data[::-1], size=self.smoothing_window, axis=0, mode='nearest')
                 data = data.reshape(n_models, n_trials, n_features)
 
+            lap('prepare')
+
             # Train an independent model for each entry in the self.independent_axis
             logger.info("Now training {} LDAs, 1 for each element in {}.".format(n_models, view.axes[0].type_str))
             lda_args = {'solver': self.solver, 'priors': priors,
@@ -178,14 +221,17 @@ class VariantLDA(Node):
             if self.shrinkage:
                 lda_args.update(shrinkage='auto')
             models = []
-            for m_ix in range(n_models):
-                # Initialize the model
-                temp = LDA(**lda_args)
-                # finally fit the model given the data -- this line assumes that
-                # the predicted value is one-dimensional (per trial, so it's a vector over trials)
-                temp.fit(data[m_ix], y.reshape(-1))
-                # Save the result
-                models.append(temp)
+            # the solvers' BLAS threads draw from the package's CPU budget
+            with blas_threads():
+                for m_ix in range(n_models):
+                    # Initialize the model
+                    temp = LDA(**lda_args)
+                    # finally fit the model given the data -- this line assumes that
+                    # the predicted value is one-dimensional (per trial, so it's a vector over trials)
+                    temp.fit(data[m_ix], y.reshape(-1))
+                    # Save the result
+                    models.append(temp)
+            lap('fit')
 
             # TODO: First output axis should be classes (i.e., conditional mean of instance axis.)
             out_axes = (InstanceAxis(np.arange(len(models[0].classes_)), models[0].classes_),
@@ -193,49 +239,47 @@ class VariantLDA(Node):
             self.M[X_n] = {
                 'models': models,
                 'filters': np.eye(n_features),
-                'patterns': np.eye(n_features),
                 'axes': out_axes
             }
 
-            n_comps = min(self.n_components or np.Inf, n_models)
+            n_comps = min(self.n_components or np.inf, n_models)
             if n_comps < n_models:
-                # We can decompose the model weights to get a dimensionality-reduced model
-                import scipy.linalg
-                from sklearn.utils.extmath import svd_flip
-                # For the decomposed (dim-reduced) model, we will save the ...
-                ind_weights = []  # independent axis weights (e.g., weights over time in time-varying LDA)
-                filters = []      # the 'other' axis weights (if space, this is a spatial filter)
-                patterns = []     # the patterns are the same as filters in PCA because orthogonality gives X = inv(X).T
-                coefs = []        # the matrix product of ind_weights and filters
-                weights = np.stack([_.coef_ for _ in models])
-                for class_ix in range(weights.shape[1]):
-                    Wy = weights[:, class_ix, :]
-                    # A PCA would center Wy first, otherwise this is identical.
-                    u, s, vh = scipy.linalg.svd(Wy, full_matrices=False)
-                    u, vh = svd_flip(u, vh)  # flip eigenvectors' sign to enforce deterministic output
-                    # assert np.allclose(Wy, np.dot(u[:, :n_models] * s[:n_models], vh[:n_models, :]))
-                    ind_weights.append(u[:, :n_comps] * s[:n_comps])
-                    filters.append(vh[:n_comps, :])  # same as pca.components_
-                    coefs.append(np.dot(ind_weights[-1], filters[-1]))
-                    # PCA filters are always orthogonal, so that means filter.T is equal to its inverse...
-                    # which means that the patterns are equal to the filters.
-                    # I'll leave the calculation below as an example for what should be done when not orthogonal.
-                    vh_inv = np.linalg.pinv(vh)
-                    patterns.append(np.transpose(vh_inv)[:n_comps, :])
+                # We can decompose the model weights to get a dimensionality-reduced model.
+                # Stack the weights as (classes, models, features) and decompose all classes at once.
+                weights = np.stack([_.coef_ for _ in models], axis=1)
+                u, s, vh = _batched_svd(weights, n_comps, solver=self.svd_solver, random_seed=self.random_seed)
+                # A PCA would center Wy first, otherwise this is identical.
+                ind_weights = u * s[:, None, :]  # independent axis weights (e.g., weights over time)
+                filters = vh                     # the 'other' axis weights (if space, this is a spatial filter)
+                # PCA filters are always orthogonal, so that means filter.T is equal to its inverse...
+                # which means that the patterns are equal to the filters and we can skip the pinv.
+                patterns = filters
+                coefs = np.matmul(ind_weights, filters)  # (classes, models, features)
 
                 # Put the coefficients back into LDA models
-                coefs = np.stack(coefs)
-                for m_ix in range(n_models):
-                    models[m_ix].coef_ = coefs[:, m_ix, :]
+                coefs = np.ascontiguousarray(coefs.transpose(1, 0, 2))
+                for model, coef in zip(models, coefs):
+                    model.coef_ = coef
 
                 # Save the result
                 self.M[X_n].update({
                     'models': models,
-                    'ind_weights': np.stack(ind_weights),
-                    'filters': np.stack(filters),
-                    'patterns': np.stack(patterns)
+                    'ind_weights': ind_weights,
+                    'filters': filters,
+                    'patterns': patterns
                 })
 
+            lap('decompose')
+
+            # Activation patterns of the final weights; for the full model (whose
+            # filters are the identity) these are also its patterns.
+            self.M[X_n]['activation_patterns'] = _activation_patterns(models, data, y)
+            self.M[X_n].setdefault('patterns', self.M[X_n]['activation_patterns'])
+            lap('patterns')
+
+            if cache_file is not None:
+                self._save_cached_model(cache_file, self.M[X_n])
+
         #
         X_view = X.block[axis_definers[self.independent_axis], instance, collapsedaxis]
         n_models, n_trials, n_features = X_view.shape
@@ -264,6 +308,7 @@ class VariantLDA(Node):
             out_block.data /= out_block.data.sum(axis=1).reshape((out_block.data.shape[0], -1))
 
         v.chunks[X_n].block = out_block
+        lap('predict')
 
         # finally we write the updated packet into our ._data variable, which is
         # the one that will be read out when our .data property is read from
@@ -281,6 +326,60 @@ class VariantLDA(Node):
         port (unless the port's setter has been overridden)."""
         self.signal_changed(True)
 
+    def _cache_file(self, X, y):
+        """Get the cache file name for a model trained on the given data chunk
+        and labels with the current settings."""
+        import json
+        import hashlib
+        h = hashlib.sha1()
+        _hash_values(h, X.block.data)
+        # the axes (e.g., the time points) end up in the model
+        for ax in X.block.axes:
+            h.update(ax.type_str.encode())
+            for attr in _AXIS_TICKS:
+                if getattr(ax, attr, None) is not None:
+                    h.update(attr.encode())
+                    _hash_values(h, getattr(ax, attr))
+        _hash_values(h, np.asarray(y).reshape(-1))
+        settings = {'cache_format': _CACHE_FORMAT,
+                    'solver': self.solver, 'class_weights': self.class_weights,
+                    'tolerance': self.tolerance, 'shrinkage': self.shrinkage,
+                    'independent_axis': self.independent_axis, 'smoothing_window': self.smoothing_window,
+                    'n_components': self.n_components, 'svd_solver': self.svd_solver,
+                    'random_seed': self.random_seed}
+        h.update(json.dumps(settings, sort_keys=True, default=str).encode())
+        return os.path.join(self.cache_dir, 'VariantLDA-%s.pkl' % h.hexdigest())
+
+    @staticmethod
+    def _load_cached_model(filename):
+        """Load a cached model, or return None if there is no usable one."""
+        import pickle
+        if not os.path.exists(filename):
+            return None
+        try:
+            with open(filename, 'rb') as f:
+                return pickle.load(f)
+        except Exception as e:
+            logger.warning("Could not load cached model %s (%s); retraining." % (filename, e))
+            return None
+
+    @staticmethod
+    def _save_cached_model(filename, model):
+        """Write a model to the cache; the file is replaced atomically so that
+        concurrent readers never see a partially written model."""
+        import pickle
+        import tempfile
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        fd, tmp_name = tempfile.mkstemp(dir=os.path.dirname(filename), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump(model, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_name, filename)
+        except Exception as e:
+            logger.warning("Could not write model cache file %s (%s)." % (filename, e))
+            if os.path.exists(tmp_name):
+                os.remove(tmp_name)
+
     def get_model(self):
         """Get the trainable model parameters of the node."""
         # any node that has "trainable" state (i.e., that should be possible to
@@ -290,4 +389,79 @@ class VariantLDA(Node):
 
     def set_model(self, v):
         """Set the trainable model parameters of the node."""
-        self.M = v['M']
\ No newline at end of file
+        self.M = v['M']
+
+
+def _hash_values(h, values):
+    """Add an array (of any dtype) to a hash."""
+    values = np.ascontiguousarray(values)
+    h.update(str((values.dtype.descr, values.shape)).encode())
+    if values.dtype.hasobject:
+        h.update(repr(values.tolist()).encode())
+    else:
+        h.update(values.tobytes() if values.dtype.names else values.data)
+
+
+def _activation_patterns(models, data, y):
+    """Activation patterns (Haufe et al., 2014) of a list of fitted LDA models,
+    as (classes, models, features): the weights of each model multiplied by the
+    covariance of its training data (models x trials x features, labels y).
+
+    The eigen and lsqr solvers have already estimated the within-class
+    covariance for fitting, weighted by the class priors; if those are the
+    class frequencies and the estimate is not shrunk, adding the between-class
+    scatter of the class means gives the data covariance without another pass
+    over the data. Otherwise (e.g., with class weights, shrinkage or the svd
+    solver, which keeps no covariance) it is computed from the data, for all
+    models at once.
+    """
+    coefs = np.stack([m.coef_ for m in models])  # (models, classes, features)
+    _, counts = np.unique(np.asarray(y).reshape(-1), return_counts=True)
+    priors = np.asarray(models[0].priors_, dtype=float)
+    if (all(getattr(m, 'covariance_', None) is not None and m.shrinkage is None for m in models)
+            and priors.shape == counts.shape and np.allclose(priors, counts / counts.sum())):
+        means = np.stack([m.means_ for m in models])  # (models, class means, features)
+        priors = priors.astype(means.dtype)
+        centered = means - np.matmul(priors, means)[:, None, :]
+        cov = np.stack([m.covariance_ for m in models])
+        cov += np.matmul(np.swapaxes(centered * priors[:, None], 1, 2), centered)
+    else:
+        centered = data - data.mean(axis=1, keepdims=True)
+        cov = np.matmul(np.swapaxes(centered, 1, 2), centered) / max(data.shape[1], 1)
+    # the covariances are symmetric, so W C = (C W^T)^T
+    return np.swapaxes(np.matmul(coefs, cov), 0, 1)
+
+
+def _batched_svd(W, n_comps, solver='auto', random_seed=12345, n_oversamples=10, n_iter=4):
+    """Truncated SVD of a stack of matrices W (batch x M x N), keeping n_comps components.
+
+    Returns u (batch x M x n_comps), s (batch x n_comps) and vh (batch x n_comps x N), with the
+    signs of the singular vectors fixed as in sklearn.utils.extmath.svd_flip (u-based).
+    """
+    n_batch, n_rows, n_cols = W.shape
+    k = min(n_rows, n_cols)
+    if solver == 'auto':
+        solver = 'randomized' if max(n_rows, n_cols) > 500 and n_comps < 0.8 * k else 'full'
+    if solver == 'randomized' and n_comps + n_oversamples < k:
+        # Batched randomized range finder (Halko et al., 2011), as in sklearn's randomized_svd.
+        rng = np.random.RandomState(random_seed)
+        Q = np.matmul(W, rng.normal(size=(n_cols, n_comps + n_oversamples)).astype(W.dtype, copy=False))
+        Wt = np.swapaxes(W, 1, 2)
+        for _ in range(n_iter):
+            Q, _r = np.linalg.qr(Q)
+            Q, _r = np.linalg.qr(np.matmul(Wt, Q))
+            Q = np.matmul(W, Q)
+        Q, _r = np.linalg.qr(Q)
+        # Project onto the (small) range and decompose that instead.
+        u_b, s, vh = np.linalg.svd(np.matmul(np.swapaxes(Q, 1, 2), W), full_matrices=False)
+        u = np.matmul(Q, u_b)
+    else:
+        u, s, vh = np.linalg.svd(W, full_matrices=False)
+    u, s, vh = u[:, :, :n_comps], s[:, :n_comps], vh[:, :n_comps, :]
+    # flip eigenvectors' sign to enforce deterministic output
+    max_abs_rows = np.argmax(np.abs(u), axis=1)
+    signs = np.sign(np.take_along_axis(u, max_abs_rows[:, None, :], axis=1))
+    signs[signs == 0] = 1
+    u *= signs
+    vh *= np.swapaxes(signs, 1, 2)
+    return u, s, vh
@@ -1,4 +1,51 @@
-from .GetUnityTaskEvents import GetUnityTaskEvents
-from .NSLRHMM import NSLRHMM
-from .PupilToAngle import PupilToAngle
-from .VariantLDA import VariantLDA
+"""Custom NeuroPype nodes.
+
+The node classes are imported lazily: a node's module (and with it
+neuropype.engine and any other dependencies) is only imported when the node is
+first accessed, e.g., as custom_neuropype.VariantLDA. This keeps importing the
+package cheap for short-lived processes that only use a few nodes.
+"""
+import sys
+import types
+import importlib
+
+# node class name -> name of the module that defines it
+_node_modules = {
+    'FixChannames': 'FixChannames',
+    'FixEvents': 'FixEvents',
+    'GetUnityTaskEvents': 'GetUnityTaskEvents',
+    'ImportReachGrasp': 'ImportReachGrasp',
+    'JoinSaccadesToTrials': 'JoinSaccadesToTrials',
+    'NSLRHMM': 'NSLRHMM',
+    'PupilToAngle': 'PupilToAngle',
+    'VariantLDA': 'VariantLDA',
+}
+
+__all__ = sorted(_node_modules)
+
+
+def __getattr__(name):
+    if name in _node_modules:
+        module = importlib.import_module('.' + _node_modules[name], __name__)
+        node = getattr(module, name)
+        globals()[name] = node
+        return node
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
+
+
+class _NodePackage(types.ModuleType):
+    """Package module that keeps node names bound to the node classes when
+    the modules defining them (which share their names) get imported, as was
+    the case when the nodes were imported eagerly."""
+
+    def __setattr__(self, name, value):
+        if name in _node_modules and isinstance(value, types.ModuleType):
+            return
+        super().__setattr__(name, value)
+
+
+sys.modules[__name__].__class__ = _NodePackage
@@ -0,0 +1,322 @@
+"""Run a node over many sessions in parallel and collect its output tables.
+
+This is the batch entry point for the nodes that parse behavior and marker
+data (GetUnityTaskEvents, FixEvents, ImportReachGrasp), e.g.:
+
+    from custom_neuropype.batch import run_batch
+    result = run_batch('FixEvents', ['s1/behavior.mat', 's2/behavior.mat'],
+                       config={'cloud_host': 'S3', 'cache_dir': '/scratch/cache'})
+    result.tables['markers']        # {'session': ..., 'time': ..., 'Marker': ...}
+    result.failures                 # sessions that failed, with the error
+    result.save('markers.tbl')      # see columnar.read_table
+
+Each session is processed in a worker process by a fresh instance of the node
+(configured with config, plus any per-session port values), and only the
+instance tables of the requested output chunks (one column per record field,
+plus the instance times) are sent back. The tables of all sessions are
+concatenated column by column, with a leading 'session' column. Columns that
+the node dictionary-encoded (categorical_columns) stay encoded, with the
+categories of all sessions merged into one table per column.
+
+A session is either a dict with the keys
+    id      name of the session in the output (default: derived from the files)
+    input   passed to the loader, which returns the node's input packet
+and any port values of the node (e.g., filename), or a string, which is used
+as the input if a loader is given and as the filename port value otherwise.
+The loader must be a module-level function (so that it can be sent to the
+workers); without one, the node gets an empty packet, which suffices for nodes
+that read their inputs from files (FixEvents).
+
+Failures are isolated per session: errors raised while processing a session
+are reported in its status. Sessions are handed to the workers as they become
+free, so when a session kills its worker process (for instance by exceeding the
+memory limit), only the sessions that were running at the time are affected:
+they are rerun in a new pool of the same size, and those that were running when
+a worker died a second time are rerun on their own, one at a time, so that they
+do not take down the other sessions in the pool.
+
+The worker processes draw from the package's CPU budget (see executors): the
+pool starts at most as many workers as the budget has free CPUs, and each
+worker runs single-threaded, with its BLAS/OpenMP threads capped to one.
+"""
+
+import os
+import time
+import logging
+import importlib
+import traceback
+from concurrent.futures import wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+
+import numpy as np
+
+from .executors import process_pool
+
+
+logger = logging.getLogger(__name__)
+
+
+class BatchResult:
+    """The concatenated output tables and the status of each session."""
+
+    def __init__(self, tables, categories, sessions):
+        # chunk name -> {column name: array}
+        self.tables = tables
+        # chunk name -> {column name: categories} for the encoded columns
+        self.categories = categories
+        # one dict per session, in input order: id, ok, seconds, rows, error, traceback
+        self.sessions = sessions
+
+    @property
+    def failures(self):
+        return [s for s in self.sessions if not s['ok']]
+
+    def to_dataframe(self, name='markers'):
+        """Get one of the tables as a pandas DataFrame."""
+        import pandas as pd
+        cats = self.categories.get(name, {})
+        return pd.DataFrame({col: pd.Categorical.from_codes(values, cats[col]) if col in cats else values
+                             for col, values in self.tables[name].items()})
+
+    def save(self, filename, name='markers'):
+        """Save one of the tables in the columnar table format (see
+        columnar.write_table); string columns are dictionary-encoded."""
+        from .columnar import write_table
+        write_table(filename, self.tables[name], self.categories.get(name),
+                    metadata={'table': name, 'sessions': [s['id'] for s in self.sessions]})
+
+    def __repr__(self):
+        return '<BatchResult: %d sessions (%d failed), tables %s>' % (
+            len(self.sessions), len(self.failures),
+            ', '.join('%s (%d rows)' % (n, len(t['session'])) for n, t in self.tables.items()))
+
+
+def run_batch(node, sessions, config=None, loader=None, chunks=('markers', 'trials'),
+              max_workers=None, max_memory_mb=None, sessions_per_worker=None,
+              prefetch_files=True, log=logger.info):
+    """Run a node over sessions in a process pool and concatenate the outputs.
+
+    Args:
+        node: class name of the node in this package (e.g., 'FixEvents')
+        sessions: list of sessions (see the module docstring)
+        config: dict of port values shared by all sessions
+        loader: function (input) -> Packet that loads a session's input
+        chunks: names of the output chunks whose instance tables are collected
+        max_workers: number of worker processes (default: the CPU budget, see
+          executors; fewer if the budget has fewer CPUs free)
+        max_memory_mb: limit on the address space of each worker, in MiB
+          (POSIX only); a session that exceeds it fails with a MemoryError
+        sessions_per_worker: replace each worker process after this many
+          sessions, which returns any memory it has accumulated
+        prefetch_files: start downloading the sessions' files into the
+          download cache in the background (if a cache directory is set)
+        log: function to report progress with
+
+    Returns:
+        a BatchResult
+    """
+    config = dict(config or {})
+    sessions = [_normalize_session(s, ix, loader) for ix, s in enumerate(sessions)]
+    if prefetch_files:
+        _prefetch(sessions, config)
+
+    pool_args = {'max_workers': max_workers, 'name': 'batch',
+                 'initializer': _init_worker, 'initargs': (max_memory_mb,)}
+    if sessions_per_worker:
+        pool_args['max_tasks_per_child'] = sessions_per_worker  # Python >= 3.11
+    job = (node, config, loader, tuple(chunks))
+    results = [None] * len(sessions)
+    t_start = time.perf_counter()
+
+    # run the sessions in parallel; the sessions that were running when a
+    # worker died are rerun in a new pool, and if they are running when a
+    # worker dies again, they are suspects and get rerun one at a time below
+    queue = list(range(len(sessions)))
+    strikes = [0] * len(sessions)
+    suspects = []
+    while queue:
+        crashed = _run_pool(pool_args, job, sessions, queue, results, log)
+        for ix in crashed:
+            strikes[ix] += 1
+        suspects += [ix for ix in crashed if strikes[ix] > 1]
+        retry = sorted(ix for ix in crashed if strikes[ix] == 1)
+        if retry:
+            log("A worker process died; rerunning the %d sessions that were running." % len(retry))
+        queue = retry + queue
+    if suspects:
+        log("Rerunning %d sessions that were running when workers died, one at a time."
+            % len(suspects))
+        pool_args = dict(pool_args, max_workers=1)
+        for ix in sorted(suspects):
+            with process_pool(**pool_args) as pool:
+                try:
+                    results[ix] = pool.submit(_run_session, job, sessions[ix]).result()
+                except BrokenProcessPool as e:
+                    results[ix] = _failure('worker process died (%s)' % e, ''), {}
+            _report(log, sessions[ix], results[ix])
+
+    statuses, parts = [], {}
+    for sess, (status, sess_tables) in zip(sessions, results):
+        statuses.append(dict(status, id=sess['id']))
+        for name, (cols, cats) in sess_tables.items():
+            parts.setdefault(name, []).append((sess['id'], cols, cats))
+    tables, categories = {}, {}
+    for name, table_parts in parts.items():
+        tables[name], categories[name] = _concat_tables(table_parts)
+    n_failed = sum(not s['ok'] for s in statuses)
+    log("Processed %d sessions in %.1f s (%d failed)."
+        % (len(sessions), time.perf_counter() - t_start, n_failed))
+    return BatchResult(tables, categories, statuses)
+
+
+def _run_pool(pool_args, job, sessions, queue, results, log):
+    """Run the sessions of the queue (by index, taken from its front) in a new
+    pool, handing them to the workers as they become free, until the queue is
+    done or a worker dies. Returns the sessions that were running then."""
+    running = {}
+    with process_pool(**pool_args) as pool:
+        while queue or running:
+            while queue and len(running) < pool.workers:
+                ix = queue.pop(0)
+                running[pool.submit(_run_session, job, sessions[ix])] = ix
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            if any(isinstance(fut.exception(), BrokenProcessPool) for fut in done):
+                # the other sessions have finished, or fail at once
+                done, _ = wait(running)
+            crashed = []
+            for fut in done:
+                ix = running.pop(fut)
+                try:
+                    results[ix] = fut.result()
+                except BrokenProcessPool:
+                    crashed.append(ix)
+                    continue
+                _report(log, sessions[ix], results[ix])
+            if crashed:
+                return sorted(crashed)
+    return []
+
+
+def _normalize_session(session, ix, loader):
+    if isinstance(session, str):
+        session = {'input': session} if loader is not None else {'filename': session}
+    session = dict(session)
+    if 'id' not in session:
+        path = session.get('input', session.get('filename'))
+        if isinstance(path, str) and path:
+            # include the directory, since the files of all sessions often
+            # share one name (e.g., <session>/behavior.mat)
+            stem = os.path.splitext(os.path.basename(path))[0]
+            parent = os.path.basename(os.path.dirname(path))
+            session['id'] = (parent + '/' + stem) if parent else stem
+        else:
+            session['id'] = 'session%d' % ix
+    return session
+
+
+def _prefetch(sessions, config):
+    from .cloud_cache import prefetch
+    filenames = [s['filename'] for s in sessions if s.get('filename')]
+    if filenames:
+        prefetch(filenames, host=config.get('cloud_host', 'Default'),
+                 account=config.get('cloud_account', ''), bucket=config.get('cloud_bucket', ''),
+                 credentials=config.get('cloud_credentials', ''), cache_dir=config.get('cache_dir', ''))
+
+
+def _init_worker(max_memory_mb):
+    if max_memory_mb:
+        try:
+            import resource
+        except ImportError:
+            logger.warning("Memory limits are not supported on this platform.")
+            return
+        limit = int(max_memory_mb) * 2**20
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+
+def _run_session(job, session):
+    """Process one session (in a worker); returns (status, tables)."""
+    node_name, config, loader, chunks = job
+    t0 = time.perf_counter()
+    try:
+        package = importlib.import_module(__name__.rpartition('.')[0])
+        ports = dict(config)
+        ports.update((k, v) for k, v in session.items() if k not in ('id', 'input'))
+        node = getattr(package, node_name)(**ports)
+        if loader is not None:
+            pkt = loader(session['input'])
+        else:
+            from neuropype.engine import Packet
+            pkt = Packet({})
+        node.data = pkt
+        out = node.data
+        tables = {name: _instance_columns(out.chunks[name])
+                  for name in chunks if out is not None and name in out.chunks}
+    except Exception as e:
+        # MemoryError included: the worker is still usable once it has unwound
+        return _failure('%s: %s' % (type(e).__name__, e), traceback.format_exc()), {}
+    rows = {name: len(cols['time']) for name, (cols, _) in tables.items()}
+    return {'ok': True, 'seconds': time.perf_counter() - t0, 'rows': rows}, tables
+
+
+def _failure(error, tb):
+    return {'ok': False, 'seconds': None, 'rows': {}, 'error': error, 'traceback': tb}
+
+
+def _report(log, session, result):
+    status = result[0]
+    if status['ok']:
+        log("%s: done in %.2f s (%s)" % (session['id'], status['seconds'],
+                                         ', '.join('%s: %d rows' % kv for kv in status['rows'].items())))
+    else:
+        log("%s: FAILED: %s" % (session['id'], status['error']))
+
+
+def _instance_columns(chunk):
+    """Get the instance table of a chunk as ({column name: array},
+    {column name: categories})."""
+    from neuropype.engine import instance
+    from .columnar import CATEGORIES_PROP
+    axis = chunk.block.axes[instance]
+    cols = {'time': np.asarray(axis.times)}
+    data = np.asarray(axis.data)
+    if data.dtype.names:
+        for field in data.dtype.names:
+            cols[field] = np.asarray(data[field])
+    else:
+        cols['Marker'] = data
+    props = getattr(chunk, 'props', None)
+    return cols, props.get(CATEGORIES_PROP, {}) if isinstance(props, dict) else {}
+
+
+def _concat_tables(parts):
+    """Concatenate the (session id, columns, categories) of several sessions;
+    returns (columns, categories). The codes of encoded columns are remapped
+    to the union of the sessions' categories. Columns that are missing in a
+    session are filled with None (or NaN for float columns, -1 for encoded
+    columns)."""
+    from .columnar import code_dtype
+    names = list(dict.fromkeys(['session'] + [c for _, cols, _ in parts for c in cols]))
+    out, out_cats = {}, {}
+    for name in names:
+        sess_cats = [cats[name] for _, cols, cats in parts if name in cats]
+        if sess_cats:
+            out_cats[name] = np.unique(np.concatenate(sess_cats))
+            codes_dtype = code_dtype(len(out_cats[name]))
+        pieces = []
+        for sess_id, cols, cats in parts:
+            n = len(cols['time'])
+            if name == 'session':
+                pieces.append(np.full(n, sess_id))
+            elif name in cats:
+                remap = np.append(np.searchsorted(out_cats[name], cats[name]), -1).astype(codes_dtype)
+                pieces.append(remap[cols[name]])
+            elif name in cols:
+                pieces.append(cols[name])
+            elif name in out_cats:
+                pieces.append(np.full(n, -1, dtype=codes_dtype))
+            else:
+                kinds = {c[name].dtype.kind for _, c, _ in parts if name in c}
+                pieces.append(np.full(n, np.nan) if kinds <= {'f'} else np.full(n, None, dtype=object))
+        out[name] = np.concatenate(pieces)
+    return out, out_cats
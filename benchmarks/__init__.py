@@ -0,0 +1,5 @@
+"""Offline benchmark suite for the custom NeuroPype nodes.
+
+See __main__.py for usage. The synthetic input generators are in
+generators.py, the benchmarks in suite.py.
+"""
@@ -0,0 +1,123 @@
+"""Run the benchmark suite.
+
+Usage (from the directory containing the package):
+
+    python -m custom_neuropype.benchmarks [--quick] [--only NAME[,NAME...]]
+        [--repeats N] [--output results.json]
+        [--baseline baseline.json [--tolerance 0.25]] [--save-baseline baseline.json]
+
+Each benchmark is run over a sweep of input sizes; the best and median wall
+time of the repetitions are written as JSON. If a baseline is given, any result
+that is slower than the baseline by more than the tolerance is reported as a
+regression, and the exit status is 1. If neuropype is not installed, the
+benchmarks run against stand-ins for its packet types (see standins.py).
+"""
+
+import sys
+import json
+import time
+import platform
+import argparse
+import traceback
+
+from . import standins
+
+
+def run_suite(names=None, quick=False, repeats=3, log=print):
+    """Run the benchmarks and return the results as a JSON-serializable dict."""
+    from .suite import BENCHMARKS
+    results = []
+    for name, (bench, unit, sizes, quick_sizes) in BENCHMARKS.items():
+        if names and name not in names:
+            continue
+        for size in (quick_sizes if quick else sizes):
+            entry = {'name': name, 'size': size, 'unit': unit, 'repeats': repeats}
+            try:
+                prepare, run, *cleanup = bench(size)
+                timings = []
+                try:
+                    for _ in range(repeats):
+                        args = prepare()
+                        t0 = time.perf_counter()
+                        value = run(args)
+                        elapsed = time.perf_counter() - t0
+                        # benchmarks that time themselves (e.g. in a subprocess) return the time
+                        timings.append(value if isinstance(value, float) else elapsed)
+                finally:
+                    for func in cleanup:
+                        func()
+                timings.sort()
+                entry.update(min_s=timings[0], median_s=timings[len(timings) // 2])
+                log("%-24s %10s %-8s min %10.4f s   median %10.4f s"
+                    % (name, size, unit, entry['min_s'], entry['median_s']))
+            except ImportError as e:
+                entry.update(skipped=str(e))
+                log("%-24s %10s %-8s skipped (%s)" % (name, size, unit, e))
+            except Exception as e:
+                entry.update(error='%s: %s' % (type(e).__name__, e))
+                log("%-24s %10s %-8s error (%s)" % (name, size, unit, entry['error']))
+                log(traceback.format_exc(limit=3))
+            results.append(entry)
+    return {'meta': _environment(), 'results': results}
+
+
+def compare(results, baseline, tolerance=0.25):
+    """Compare results against a baseline; returns a list of regressions as
+    (name, size, baseline seconds, current seconds)."""
+    base = {(r['name'], r['size']): r for r in baseline['results'] if 'min_s' in r}
+    regressions = []
+    for r in results['results']:
+        b = base.get((r['name'], r['size']))
+        if b is not None and 'min_s' in r and r['min_s'] > b['min_s'] * (1 + tolerance):
+            regressions.append((r['name'], r['size'], b['min_s'], r['min_s']))
+    return regressions
+
+
+def _environment():
+    import numpy
+    meta = {'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'python': platform.python_version(),
+            'platform': platform.platform(), 'numpy': numpy.__version__,
+            'neuropype': 'stand-ins' if standins.install() else 'installed'}
+    try:
+        import neuropype
+        meta['neuropype_version'] = getattr(neuropype, '__version__', 'unknown')
+    except ImportError:
+        pass
+    return meta
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m custom_neuropype.benchmarks',
+                                     description='Benchmark the custom NeuroPype nodes.')
+    parser.add_argument('--quick', action='store_true', help='use the smaller size sweeps')
+    parser.add_argument('--only', default='', help='comma-separated benchmark names')
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--output', default='', help='write the results to this JSON file')
+    parser.add_argument('--baseline', default='', help='compare against this JSON results file')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='allowed slowdown relative to the baseline (0.25 = 25%%)')
+    parser.add_argument('--save-baseline', default='', help='also write the results here as the new baseline')
+    args = parser.parse_args(argv)
+
+    standins.install()
+    names = [n for n in args.only.split(',') if n]
+    results = run_suite(names=names, quick=args.quick, repeats=args.repeats)
+    for filename in (args.output, args.save_baseline):
+        if filename:
+            with open(filename, 'w') as f:
+                json.dump(results, f, indent=1)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        for name, size, before, after in regressions:
+            print("REGRESSION %s (size %s): %.4f s -> %.4f s (%+.0f%%)"
+                  % (name, size, before, after, 100 * (after / before - 1)))
+        if regressions:
+            return 1
+        print("No regressions against %s." % args.baseline)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,206 @@
+"""Synthetic, realistic inputs for the benchmarks.
+
+Each generator is deterministic for a given size and seed. The packet builders
+use whatever neuropype.engine resolves to (the real one, or the stand-ins).
+"""
+
+import json
+
+import numpy as np
+
+
+def unity_marker_strings(n_trials, seed=0):
+    """JSON marker strings and times of a Unity saccade task session with
+    n_trials trials, following the trial lifecycle of GetUnityTaskEvents."""
+    rng = np.random.RandomState(seed)
+    markers = []
+    t = 0.0
+
+    def emit(dt, obj):
+        nonlocal t
+        t += dt
+        markers.append((t, json.dumps(obj, separators=(',', ':'))))
+
+    def obj_info(identity, visible):
+        pos = rng.uniform(-1, 1, 3).round(3).tolist()
+        return {'ObjectInfo': {'_isVisible': visible, '_identity': identity,
+                               '_position': pos, '_pointingTo': [0.0, 0.0, 1.0]}}
+
+    for tr in range(n_trials):
+        modifier = int(rng.randint(0, 3))
+        response = int(rng.randint(1, 3))
+        cue_pos, targ_pos = int(rng.randint(0, 2)), int(rng.randint(0, 2))
+
+        def state(phase, correct=False, selected=-1):
+            return {'TrialState': {'condition': 5, 'isCorrect': correct, 'modifier': modifier,
+                                   'trialIndex': tr, 'response': response,
+                                   'cuePositionIndex': cue_pos, 'targetPositionIndex': targ_pos,
+                                   'targetObjectIndex': 0, 'selectedObjectIndex': 0,
+                                   'selectedPositionIndex': selected, 'targetColorIndex': -1,
+                                   'trialPhaseIndex': phase}}
+
+        def user_input(cls):
+            return {'Input:': {'trialIndex': tr, 'selectedObjectClass': cls, 'info': 'Selected: ' + cls}}
+
+        emit(0.5, obj_info('Target', False))
+        emit(0.01, state(1))
+        emit(0.2, user_input('Wall'))
+        emit(0.1, user_input('Fixation'))
+        emit(0.01, state(2))
+        emit(0.5, obj_info('Cue', True))
+        emit(0.01, state(3))
+        emit(0.1, obj_info('Cue', False))
+        emit(0.01, state(4))
+        emit(0.5, obj_info('Target', True))
+        emit(0.01, state(5))
+        emit(0.3, obj_info('CentralFixation', False))
+        emit(0.01, state(6))
+        emit(0.01, state(7))
+        emit(0.01, state(8))
+        emit(rng.uniform(0.15, 0.4), user_input('Target'))
+        emit(0.05, state(8, correct=True, selected=targ_pos))
+        emit(0.2, state(9, correct=True, selected=targ_pos))
+        if rng.rand() < 0.01:
+            emit(0.01, {'CameraRecenter:': True})
+    times, strings = zip(*markers) if markers else ((), ())
+    return np.asarray(times), np.asarray(strings, dtype=object)
+
+
+def pupil_gaze(n_samples, srate=200.0, seed=0):
+    """Pupil-Labs style gaze channels: 3-D gaze point (mm, in front of the
+    camera) and normalized 2-D position, with saccade-like steps."""
+    rng = np.random.RandomState(seed)
+    n_fix = max(1, n_samples // 60)
+    targets = rng.uniform(-0.3, 0.3, (n_fix, 2))
+    ang = np.repeat(targets, -(-n_samples // n_fix), axis=0)[:n_samples]
+    ang = ang + rng.normal(0, 0.002, ang.shape)
+    depth = 500.0
+    chans = {
+        'gaze_point_3d_x': depth * np.tan(ang[:, 0]),
+        'gaze_point_3d_y': depth * np.tan(ang[:, 1]),
+        'gaze_point_3d_z': np.full(n_samples, depth),
+        'norm_pos_x': 0.5 + ang[:, 0],
+        'norm_pos_y': 0.5 + ang[:, 1],
+    }
+    times = np.arange(n_samples) / srate
+    return times, chans
+
+
+def gaze_segments(n_segments, t_max, seed=0):
+    """NSLRHMM-style eye movement events: start times and a record array with
+    the fields EndTime, Marker, Duration, Amp, StartX, PosX, StartY, PosY."""
+    rng = np.random.RandomState(seed)
+    starts = np.sort(rng.uniform(0, t_max, n_segments))
+    durations = np.minimum(np.diff(starts, append=t_max), 0.05)
+    start_pos = rng.normal(0, 5, (2, n_segments))
+    end_pos = start_pos + rng.normal(0, 5, (2, n_segments))
+    markers = np.where(rng.rand(n_segments) < 0.4, 'Saccade', 'Fixation').astype(object)
+    data = np.rec.fromarrays([starts + durations, markers, durations,
+                              np.hypot(*(end_pos - start_pos)),
+                              start_pos[0], end_pos[0], start_pos[1], end_pos[1]],
+                             names=['EndTime', 'Marker', 'Duration', 'Amp', 'StartX', 'PosX', 'StartY', 'PosY'])
+    return starts, data
+
+
+def blackrock_digital_events(n_trials, seed=0):
+    """Times and 16-bit codes of the digital events of a Reach-and-Grasp
+    session, with a mix of correct and error trials."""
+    rng = np.random.RandomState(seed)
+    grip_codes = {'SG': 65370, 'PG': 65365}
+    force_codes = {'HF': 65366, 'LF': 65369}
+    sr_codes = {'SG': 65386, 'PG': 65381}
+    rw_codes = {'SG': 65514, 'PG': 65509}
+    codes, times = [], []
+    t = 0.0
+    for _ in range(n_trials):
+        grip = 'SG' if rng.rand() < 0.5 else 'PG'
+        force = 'HF' if rng.rand() < 0.5 else 'LF'
+        seq = [65296, 65360, grip_codes[grip], 65360, force_codes[force], sr_codes[grip], rw_codes[grip], 65312]
+        if rng.rand() < 0.15:
+            # error trial: the monkey releases the switch early
+            cut = rng.randint(2, 5)
+            seq = seq[:cut] + [sr_codes[grip], 65312]
+        for code in seq:
+            t += rng.uniform(0.1, 0.6)
+            codes.append(code)
+            times.append(t)
+    return np.asarray(times), np.asarray(codes, dtype=np.int64)
+
+
+def blackrock_nev(filename, n_trials, spikes_per_event=100, seed=0):
+    """Write a Blackrock .nev file with the digital events of
+    blackrock_digital_events(n_trials) among spike packets on 96 channels."""
+    from ..nev import write_nev
+    rng = np.random.RandomState(seed)
+    times, codes = blackrock_digital_events(n_trials, seed=seed)
+    n_spikes = len(times) * spikes_per_event
+    spike_times = np.sort(rng.uniform(0, times[-1] if len(times) else 1.0, n_spikes))
+    return write_nev(filename, times, codes, spike_times, rng.randint(1, 97, n_spikes))
+
+
+def epoched_tensor(n_trials, n_times, n_channels, n_classes=2, seed=0):
+    """Labeled epochs (trials x times x channels) with a class-dependent,
+    time-varying spatial pattern."""
+    rng = np.random.RandomState(seed)
+    y = rng.randint(0, n_classes, n_trials)
+    patterns = rng.normal(0, 1, (n_classes, n_channels))
+    envelope = np.sin(np.linspace(0, np.pi, n_times))
+    X = rng.normal(0, 1, (n_trials, n_times, n_channels))
+    X += 0.5 * envelope[None, :, None] * patterns[y][:, None, :]
+    return X, y
+
+
+def location_rule_mat(filename, n_trials, seed=0):
+    """Write a Location Rule behavior .mat file with n_trials trials (plus an
+    unrelated large variable, as in the real files)."""
+    import scipy.io
+    rng = np.random.RandomState(seed)
+    start = np.cumsum(rng.uniform(2000, 4000, n_trials))
+    scipy.io.savemat(filename, {
+        'startTime': start[None, :],
+        'targetOnset': rng.uniform(300, 500, (1, n_trials)),
+        'cueOnset': rng.uniform(600, 900, (1, n_trials)),
+        'sacStartTime': rng.uniform(1000, 1400, (1, n_trials)),
+        'newClass': rng.randint(1, 9, (1, n_trials)).astype(float),
+        'eyeData': rng.normal(0, 1, (n_trials, 200)),
+    })
+    return filename
+
+
+# --- packet builders ---
+
+def marker_packet(times, strings):
+    import neuropype.engine as ne
+    data = np.rec.fromarrays([strings], names=['Marker'])
+    blk = ne.Block(data=np.full(len(times), np.nan),
+                   axes=(ne.InstanceAxis(times, data=data, instance_type='markers'),))
+    return ne.Packet({'markers': ne.Chunk(block=blk, props={ne.Flags.has_markers: True})})
+
+
+def segment_chunk(times, data):
+    import neuropype.engine as ne
+    blk = ne.Block(data=np.full(len(times), np.nan), axes=(ne.InstanceAxis(times, data=data),))
+    return ne.Chunk(block=blk, props={ne.Flags.is_event_stream: True})
+
+
+def event_packet(times, codes):
+    import neuropype.engine as ne
+    labels = np.full(len(times), 'digital_input_port', dtype=object)
+    blk = ne.Block(data=codes, axes=(ne.InstanceAxis(times, data=labels),))
+    return ne.Packet({'events': ne.Chunk(block=blk)})
+
+
+def signal_packet(data, chan_names, srate=1000.0, name='analogsignals'):
+    import neuropype.engine as ne
+    times = np.arange(data.shape[1]) / srate
+    blk = ne.Block(data=data, axes=(ne.SpaceAxis(names=chan_names), ne.TimeAxis(times, nominal_rate=srate)))
+    return ne.Packet({name: ne.Chunk(block=blk)})
+
+
+def epoch_packet(X, y):
+    import neuropype.engine as ne
+    n_trials, n_times, n_channels = X.shape
+    inst = ne.InstanceAxis(np.arange(n_trials, dtype=float), data=np.rec.fromarrays([y], names=['TargetValue']))
+    blk = ne.Block(data=X, axes=(inst, ne.TimeAxis(np.arange(n_times) / 100.0),
+                                 ne.SpaceAxis(names=['ch%d' % k for k in range(n_channels)])))
+    return ne.Packet({'eeg': ne.Chunk(block=blk)})
@@ -0,0 +1,177 @@
+"""Streaming replay harness for measuring per-packet latency of online nodes.
+
+A recording (or synthetic data) is sliced into packets of chunk_size samples,
+which are released at the rate at which they would arrive from a live stream
+(optionally sped up or slowed down), and pushed through one node or a chain of
+nodes. For each packet, the latency is the time from its scheduled arrival to
+the end of processing; a packet misses its deadline if its latency exceeds the
+deadline (by default, the interval between packets). No LSL stream or hardware
+is involved.
+
+Usage (from the directory containing the package):
+
+    python -m custom_neuropype.benchmarks.replay --scenario gaze --chunk 10 --duration 30
+    python -m custom_neuropype.benchmarks.replay --scenario utah --speed 0   # as fast as possible
+    python -m custom_neuropype.benchmarks.replay --recording rec.npz --nodes FixChannames
+
+A recording is an .npz file with the arrays data (channels x samples), srate
+(scalar) and names (channel names).
+"""
+
+import sys
+import json
+import time
+import argparse
+
+import numpy as np
+
+from . import standins
+from . import generators as gen
+
+
+def signal_packets(data, names, srate, chunk_size, name='signal'):
+    """Slice a (channels x samples) recording into streaming packets of
+    chunk_size samples each."""
+    import neuropype.engine as ne
+    n_samples = data.shape[1]
+    times = np.arange(n_samples) / srate
+    space_axis = ne.SpaceAxis(names=list(names))
+    for start in range(0, n_samples, chunk_size):
+        stop = min(start + chunk_size, n_samples)
+        blk = ne.Block(data=data[:, start:stop].copy(),
+                       axes=(space_axis, ne.TimeAxis(times[start:stop], nominal_rate=srate)))
+        yield times[stop - 1], stop - start, ne.Packet({name: ne.Chunk(block=blk, props={ne.Flags.is_streaming: True})})
+
+
+def epoch_packets(X, y, epoch_rate, chunk_size=1):
+    """Slice labeled epochs into packets of chunk_size epochs, arriving at
+    epoch_rate epochs per second."""
+    for start in range(0, len(X), chunk_size):
+        stop = min(start + chunk_size, len(X))
+        pkt = gen.epoch_packet(X[start:stop], y[start:stop])
+        yield (stop - 1) / epoch_rate, stop - start, pkt
+
+
+def replay(nodes, packets, speed=1.0, deadline=None):
+    """Push packets through a chain of nodes and measure their latency.
+
+    Args:
+        nodes: list of nodes; the output of each is the input of the next
+        packets: iterable of (stream time of the last sample, number of
+          samples, packet), in stream order
+        speed: replay speed relative to real time; 0 replays as fast as
+          possible (latency is then the processing time alone)
+        deadline: maximum allowed latency in seconds (default: the interval
+          between consecutive packets, scaled by the speed if it is nonzero)
+
+    Returns:
+        a dict with latency percentiles (in ms), jitter, throughput and the
+        number of missed deadlines
+    """
+    latencies, n_samples, intervals = [], 0, []
+    busy = 0.0
+    t_start = time.perf_counter()
+    t_first = prev_t = None
+    for t_stream, n, pkt in packets:
+        if t_first is None:
+            t_first = prev_t = t_stream
+        if prev_t != t_stream:
+            intervals.append(t_stream - prev_t)
+        prev_t = t_stream
+        if speed > 0:
+            # the packet arrives once its last sample has been recorded
+            arrival = t_start + (t_stream - t_first) / speed
+            wait = arrival - time.perf_counter()
+            if wait > 0:
+                time.sleep(wait)
+        else:
+            arrival = time.perf_counter()
+        t0 = time.perf_counter()
+        for node in nodes:
+            node.data = pkt
+            pkt = node.data
+        t1 = time.perf_counter()
+        busy += t1 - t0
+        latencies.append(t1 - max(arrival, t_start))
+        n_samples += n
+
+    latencies = np.asarray(latencies)
+    if deadline is None:
+        deadline = np.median(intervals) / (speed or 1.0) if intervals else np.inf
+    return {
+        'packets': len(latencies),
+        'samples': n_samples,
+        'latency_p50_ms': 1000 * float(np.percentile(latencies, 50)) if len(latencies) else np.nan,
+        'latency_p99_ms': 1000 * float(np.percentile(latencies, 99)) if len(latencies) else np.nan,
+        'latency_max_ms': 1000 * float(latencies.max()) if len(latencies) else np.nan,
+        'jitter_ms': 1000 * float(latencies.std()) if len(latencies) else np.nan,
+        'throughput_samples_per_s': n_samples / busy if busy > 0 else np.inf,
+        'deadline_ms': 1000 * float(deadline),
+        'missed_deadlines': int(np.sum(latencies > deadline)),
+    }
+
+
+def _scenario(args):
+    """Get (nodes, packets) for the command-line arguments."""
+    import importlib
+    pkg = importlib.import_module(__package__.rsplit('.', 1)[0])
+    n_samples = int(args.duration * args.srate)
+    if args.recording:
+        rec = np.load(args.recording, allow_pickle=False)
+        srate = float(rec['srate'])
+        packets = signal_packets(rec['data'], rec['names'], srate, args.chunk)
+        names = args.nodes.split(',') if args.nodes else []
+        return [getattr(pkg, n)() for n in names], packets
+    if args.scenario == 'gaze':
+        times, chans = gen.pupil_gaze(n_samples, srate=args.srate)
+        names = list(chans)
+        nodes = [pkg.PupilToAngle()]
+        if args.nodes:
+            nodes = [getattr(pkg, n)() for n in args.nodes.split(',')]
+        return nodes, signal_packets(np.stack([chans[k] for k in names]), names, args.srate, args.chunk)
+    if args.scenario == 'utah':
+        data = np.random.RandomState(0).normal(0, 1, (args.channels, n_samples)).astype(np.float32)
+        names = ['elec%d' % (k + 1) for k in range(args.channels)]
+        return [pkg.FixChannames()], signal_packets(data, names, args.srate, args.chunk)
+    if args.scenario == 'lda':
+        X, y = gen.epoched_tensor(200 + int(args.duration * args.epoch_rate), 50, 32)
+        node = pkg.VariantLDA(n_components=3)
+        node.data = gen.epoch_packet(X[:200], y[:200])  # calibrate first
+        return [node], epoch_packets(X[200:], y[200:], args.epoch_rate, args.chunk)
+    raise ValueError("Unknown scenario %s." % args.scenario)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m custom_neuropype.benchmarks.replay',
+                                     description='Replay a stream through online nodes and measure latency.')
+    parser.add_argument('--scenario', default='gaze', choices=['gaze', 'utah', 'lda'])
+    parser.add_argument('--recording', default='', help='replay this .npz recording instead')
+    parser.add_argument('--nodes', default='', help='comma-separated node chain (overrides the scenario)')
+    parser.add_argument('--srate', type=float, default=200.0, help='sampling rate (synthetic signals)')
+    parser.add_argument('--channels', type=int, default=96, help='number of channels (utah scenario)')
+    parser.add_argument('--epoch-rate', type=float, default=2.0, help='epochs per second (lda scenario)')
+    parser.add_argument('--chunk', type=int, default=None,
+                        help='samples (or epochs) per packet; default 10 samples or 1 epoch')
+    parser.add_argument('--duration', type=float, default=30.0, help='seconds of data to replay')
+    parser.add_argument('--speed', type=float, default=1.0, help='replay speed; 0 = as fast as possible')
+    parser.add_argument('--deadline-ms', type=float, default=None, help='default: packet interval')
+    parser.add_argument('--output', default='', help='write the report to this JSON file')
+    args = parser.parse_args(argv)
+    if args.chunk is None:
+        args.chunk = 1 if args.scenario == 'lda' and not args.recording else 10
+
+    standins.install()
+    nodes, packets = _scenario(args)
+    report = replay(nodes, packets, speed=args.speed,
+                    deadline=args.deadline_ms / 1000 if args.deadline_ms is not None else None)
+    report.update(nodes=[type(n).__name__ for n in nodes], chunk=args.chunk, speed=args.speed)
+    for k, v in report.items():
+        print('%-26s %s' % (k, v))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=1)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
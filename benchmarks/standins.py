@@ -0,0 +1,366 @@
+"""Minimal stand-ins for the parts of the neuropype API used by the nodes.
+
+These are only installed (into sys.modules) when neuropype itself cannot be
+imported, so that the benchmarks can run fully offline. They implement just
+enough of the packet/chunk/block/axis model, the port declarations and the
+chunk helper functions for the nodes in this package to be constructed and
+run; they make no attempt at validating their inputs.
+"""
+
+import sys
+import copy
+import types
+from typing import Union, Type
+
+import numpy as np
+
+
+class Keep:
+    """Placeholder for 'keep the current port value'."""
+
+
+# --- ports ---
+
+class Port:
+    def __init__(self, default=None, value_type=None, help='', *args, **kwargs):
+        self.default = default
+        self.name = None
+        self.fset = None
+
+    def __set_name__(self, owner, name):
+        self.name = name
+
+    def setter(self, fset):
+        self.fset = fset
+        return self
+
+    def __get__(self, obj, objtype=None):
+        if obj is None:
+            return self
+        if self.fset is not None:
+            return obj.__dict__.get('_data')
+        return obj.__dict__.get(self.name, self.default)
+
+    def __set__(self, obj, value):
+        if self.fset is not None:
+            self.fset(obj, value)
+        else:
+            obj.__dict__[self.name] = value
+            obj.on_port_assigned()
+
+
+class DataPort(Port):
+    def __init__(self, value_type=None, help='', *args, **kwargs):
+        super().__init__(None, value_type, help)
+
+
+class _ValuePort(Port):
+    def __init__(self, default=None, *args, **kwargs):
+        super().__init__(default)
+
+
+BoolPort = StringPort = ListPort = DictPort = _ValuePort
+
+
+class _NumberPort(_ValuePort):
+    # as in neuropype, the second positional argument is the domain
+    def __init__(self, default=None, domain=None, help='', *args, **kwargs):
+        if isinstance(domain, str):
+            raise TypeError("The domain of a numeric port must not be a string "
+                            "(pass the help text as the third argument or as help=).")
+        super().__init__(default)
+
+
+IntPort = FloatPort = _NumberPort
+
+
+class EnumPort(_ValuePort):
+    def __init__(self, default=None, domain=None, help='', *args, **kwargs):
+        super().__init__(default)
+
+
+# --- nodes ---
+
+class Description:
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+class Licenses:
+    MIT = 'MIT'
+
+
+class DevStatus:
+    alpha = 'alpha'
+    beta = 'beta'
+
+
+class Node:
+    def __init__(self, **kwargs):
+        for k, v in kwargs.items():
+            if v is not Keep:
+                setattr(self, k, v)
+
+    def on_port_assigned(self):
+        pass
+
+    def signal_changed(self, *args):
+        pass
+
+
+# --- value properties (unique objects, so they can be used as record titles) ---
+
+class _Property:
+    def __init__(self, name):
+        self.name = name
+
+    def __add__(self, other):
+        return _Property(self.name + '+' + other.name)
+
+    def __repr__(self):
+        return self.name
+
+
+class ValueProperty:
+    UNKNOWN = _Property('unknown')
+    INTEGER = _Property('integer')
+    NONNEGATIVE = _Property('nonnegative')
+    STRING = _Property('string')
+    CATEGORY = _Property('category')
+    NORMALIZED = _Property('normalized')
+
+
+class DistributionType:
+    BERNOULLI = 'bernoulli'
+
+
+class Flags:
+    has_markers = 'has_markers'
+    is_event_stream = 'is_event_stream'
+    is_streaming = 'is_streaming'
+
+
+# --- axes ---
+
+class Axis:
+    type_str = 'axis'
+
+    def __len__(self):
+        return len(self._ticks())
+
+    def _ticks(self):
+        raise NotImplementedError
+
+
+class InstanceAxis(Axis):
+    type_str = 'instance'
+
+    def __init__(self, times=(), data=None, instance_type=None, **kwargs):
+        self.times = np.asarray(times, dtype=float)
+        self.data = data if data is not None else np.arange(len(self.times))
+        self.instance_type = instance_type
+
+    def _ticks(self):
+        return self.times
+
+
+class TimeAxis(Axis):
+    type_str = 'time'
+
+    def __init__(self, times=(), nominal_rate=None, **kwargs):
+        self.times = np.asarray(times, dtype=float)
+        self.nominal_rate = nominal_rate
+
+    def _ticks(self):
+        return self.times
+
+
+class SpaceAxis(Axis):
+    type_str = 'space'
+
+    def __class_getitem__(cls, names):
+        # space[names] selects channels by name
+        return _Selection(cls, names)
+
+    def __init__(self, names=(), positions=None, **kwargs):
+        self.names = np.asarray(names, dtype=object)
+
+    def _ticks(self):
+        return self.names
+
+
+class FeatureAxis(Axis):
+    type_str = 'feature'
+
+    def __init__(self, names=(), **kwargs):
+        self.names = np.asarray(names, dtype=object)
+
+    def _ticks(self):
+        return self.names
+
+
+class CollapsedAxis(Axis):
+    type_str = 'collapsed'
+
+    def __init__(self, n=0):
+        self.n = n
+
+    def _ticks(self):
+        return np.arange(self.n)
+
+
+# the axis definers are the axis classes themselves
+instance, time, space, feature, collapsedaxis = InstanceAxis, TimeAxis, SpaceAxis, FeatureAxis, CollapsedAxis
+axis_names = ('instance', 'time', 'space', 'feature')
+axis_definers = {'instance': instance, 'time': time, 'space': space, 'feature': feature}
+
+
+class _Selection:
+    def __init__(self, definer, names):
+        self.definer = definer
+        self.names = list(names)
+
+
+class _Axes(tuple):
+    """Tuple of axes that can also be indexed (and searched) by axis type."""
+
+    def __getitem__(self, item):
+        if isinstance(item, type):
+            return tuple.__getitem__(self, self.index(item))
+        return tuple.__getitem__(self, item)
+
+    def index(self, item, *args):
+        if isinstance(item, type):
+            for ix, ax in enumerate(self):
+                if isinstance(ax, item):
+                    return ix
+            raise ValueError("no %s axis" % item.type_str)
+        return tuple.index(self, item, *args)
+
+
+class Block:
+    def __init__(self, data=None, axes=()):
+        self.data = np.asarray(data)
+        self.axes = _Axes(axes)
+
+    @property
+    def shape(self):
+        return self.data.shape
+
+    @property
+    def ndim(self):
+        return self.data.ndim
+
+    def __getitem__(self, definers):
+        """Reorder the axes as given by a tuple of axis types; Ellipsis keeps
+        the remaining axes in order and collapsedaxis flattens them into one.
+        An axis type may be replaced by a selection of names (space[names])."""
+        selections = {}
+        for ix, d in enumerate(definers):
+            if isinstance(d, _Selection):
+                selections[d.definer] = d.names
+                definers = definers[:ix] + (d.definer,) + definers[ix + 1:]
+        order = [self.axes.index(d) for d in definers if d not in (Ellipsis, collapsedaxis)]
+        rest = [ix for ix in range(self.ndim) if ix not in order]
+        data = np.transpose(self.data, order + rest)
+        axes = [self.axes[ix] for ix in order]
+        for pos, ax in enumerate(axes):
+            if type(ax) in selections:
+                lookup = {name: k for k, name in enumerate(ax.names)}
+                keep = [lookup[name] for name in selections[type(ax)]]
+                data = np.take(data, keep, axis=pos)
+                axes[pos] = type(ax)(names=ax.names[keep])
+        if collapsedaxis in definers:
+            data = data.reshape(data.shape[:len(order)] + (-1,))
+            axes.append(CollapsedAxis(data.shape[-1]))
+        else:
+            axes.extend(self.axes[ix] for ix in rest)
+        return Block(data=data, axes=axes)
+
+
+class Chunk:
+    def __init__(self, block=None, props=None):
+        self.block = block
+        self.props = props if props is not None else {}
+
+
+class Packet:
+    def __init__(self, chunks=None):
+        self.chunks = dict(chunks or {})
+
+
+# --- helpers ---
+
+def deepcopy_most(obj):
+    return copy.deepcopy(obj)
+
+
+def enumerate_chunks(pkt, nonempty=False, only_signals=False, with_axes=(), **kwargs):
+    for n, chnk in list(pkt.chunks.items()):
+        blk = chnk.block
+        if nonempty and blk.data.size == 0:
+            continue
+        if only_signals and not any(isinstance(ax, TimeAxis) for ax in blk.axes):
+            continue
+        if not all(any(isinstance(ax, d) for ax in blk.axes) for d in with_axes):
+            continue
+        yield n, chnk
+
+
+def find_first_chunk(pkt, name_equals=None, with_axes=(), **kwargs):
+    for n, chnk in pkt.chunks.items():
+        if name_equals is not None and n != name_equals:
+            continue
+        if all(any(isinstance(ax, d) for ax in chnk.block.axes) for d in with_axes):
+            return n, chnk
+    return None, None
+
+
+def extract_chunks(pkt, collapse_features=False, y_column='TargetValue', return_data_chunk_label=False,
+                   **kwargs):
+    """Get the first chunk with an instance axis and its labels (if any)."""
+    for n, chnk in pkt.chunks.items():
+        if any(isinstance(ax, InstanceAxis) for ax in chnk.block.axes):
+            data = chnk.block.axes[instance].data
+            y = None
+            if getattr(data, 'dtype', None) is not None and data.dtype.names and y_column in data.dtype.names:
+                y = np.asarray(data[y_column])
+            return (chnk, y, n) if return_data_chunk_label else (chnk, y)
+    return (None, None, None) if return_data_chunk_label else (None, None)
+
+
+def concat(axis, *blocks):
+    ix = blocks[0].axes.index(axis)
+    data = np.concatenate([b.data for b in blocks], axis=ix)
+    axes = list(blocks[0].axes)
+    axes[ix] = SpaceAxis(names=np.concatenate([b.axes[ix].names for b in blocks]))
+    return Block(data=data, axes=axes)
+
+
+def _cloud_get(filename, **kwargs):
+    return filename
+
+
+def install():
+    """Make `import neuropype...` resolve to these stand-ins, unless the real
+    neuropype is available. Returns whether the stand-ins were installed."""
+    try:
+        import neuropype.engine  # noqa: F401
+        return False
+    except ImportError:
+        pass
+    this = sys.modules[__name__]
+    public = [k for k in vars(this) if not k.startswith('_') and k not in ('install', 'sys', 'copy', 'types')]
+    engine = types.ModuleType('neuropype.engine')
+    for k in public:
+        setattr(engine, k, getattr(this, k))
+    engine.__all__ = public
+    modules = {'neuropype': types.ModuleType('neuropype'), 'neuropype.engine': engine}
+    for sub in ('packet', 'block', 'axes', 'constants', 'node', 'ports'):
+        modules['neuropype.engine.' + sub] = engine
+    cloud = types.ModuleType('neuropype.utilities.cloud')
+    cloud.storage = types.SimpleNamespace(cloud_get=_cloud_get)
+    modules['neuropype.utilities'] = types.ModuleType('neuropype.utilities')
+    modules['neuropype.utilities.cloud'] = cloud
+    sys.modules.update(modules)
+    return True
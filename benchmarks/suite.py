@@ -0,0 +1,230 @@
+"""Benchmark definitions.
+
+Each benchmark is a function of the problem size that returns a pair of
+callables (prepare, run): prepare() builds a fresh input (untimed) and
+run(input) processes it (timed). The nodes mutate their input packets, so
+every repetition gets its own input. Benchmarks that write input files return
+a third callable, cleanup(), that the runner calls when they are done.
+"""
+
+import os
+import sys
+import tempfile
+import subprocess
+
+import numpy as np
+
+from . import generators as gen
+
+
+def _package():
+    """The custom_neuropype package (imported under whatever name it has)."""
+    return sys.modules[__name__.rsplit('.', 2)[0]]
+
+
+def bench_import_package(size):
+    """Time to import the package in a fresh interpreter (size is ignored)."""
+    pkg_dir = os.path.dirname(os.path.abspath(_package().__file__))
+    code = ("import time, sys; t0 = time.perf_counter(); import %s; "
+            "sys.stdout.write(repr(time.perf_counter() - t0))" % os.path.basename(pkg_dir))
+    env = dict(os.environ, PYTHONPATH=os.path.dirname(pkg_dir) + os.pathsep + os.environ.get('PYTHONPATH', ''))
+
+    def run(_):
+        out = subprocess.run([sys.executable, '-c', code], env=env, check=True,
+                             stdout=subprocess.PIPE).stdout
+        return float(out)
+    return (lambda: None), run
+
+
+def _temp_dir():
+    """A temporary directory for the input files of a benchmark, and the
+    callable that removes it."""
+    tmpdir = tempfile.TemporaryDirectory(prefix='cnp_bench_')
+    return tmpdir.name, tmpdir.cleanup
+
+
+def bench_get_unity_task_events(n_trials, object_positions=False):
+    times, strings = gen.unity_marker_strings(n_trials)
+    node = _package().GetUnityTaskEvents(object_positions=object_positions)
+
+    def run(pkt):
+        node.data = pkt
+    return (lambda: gen.marker_packet(times, strings.copy())), run
+
+
+def bench_get_unity_task_events_objects(n_trials):
+    """GetUnityTaskEvents with the object position chunk."""
+    return bench_get_unity_task_events(n_trials, object_positions=True)
+
+
+def bench_pupil_to_angle(n_samples, num_threads=1):
+    times, chans = gen.pupil_gaze(n_samples)
+    names = list(chans)
+    data = np.stack([chans[k] for k in names])
+    node = _package().PupilToAngle(use_3d_gaze=True, num_threads=num_threads)
+
+    def run(pkt):
+        node.data = pkt
+    return (lambda: gen.signal_packet(data.copy(), names, srate=200.0, name='gaze')), run
+
+
+def bench_pupil_to_angle_threaded(n_samples):
+    """PupilToAngle with one thread per CPU."""
+    return bench_pupil_to_angle(n_samples, num_threads=0)
+
+
+def bench_nslrhmm(n_samples, noise_mode='fixed'):
+    import nslr  # noqa: F401 -- skipped if not installed
+    times, chans = gen.pupil_gaze(n_samples)
+    ang = np.degrees(np.arctan2(np.stack([chans['gaze_point_3d_x'], chans['gaze_point_3d_y']]),
+                                chans['gaze_point_3d_z']))
+    node = _package().NSLRHMM(noise_mode=noise_mode)
+
+    def run(pkt):
+        # each run replays the recording from its start, which the node
+        # treats as a new recording (and estimates the noise again)
+        node.data = pkt
+    return (lambda: gen.signal_packet(ang.copy(), ['gaze_ang_deg_x', 'gaze_ang_deg_y'],
+                                      srate=200.0, name='gaze')), run
+
+
+def bench_nslrhmm_auto_noise(n_samples):
+    """NSLRHMM with the noise level estimated from the recording."""
+    return bench_nslrhmm(n_samples, noise_mode='auto')
+
+
+def bench_join_saccades_to_trials(n_segments, n_trials=400):
+    times, strings = gen.unity_marker_strings(n_trials)
+    unity = _package().GetUnityTaskEvents()
+    unity.data = gen.marker_packet(times, strings)
+    markers = unity.data.chunks['markers']
+    seg_times, seg_data = gen.gaze_segments(n_segments, times[-1])
+    node = _package().JoinSaccadesToTrials()
+
+    def prepare():
+        import neuropype.engine as ne
+        return ne.Packet({'markers': ne.Chunk(block=markers.block, props=dict(markers.props)),
+                          'gaze': gen.segment_chunk(seg_times, seg_data)})
+
+    def run(pkt):
+        node.data = pkt
+    return prepare, run
+
+
+def bench_fix_channames(n_channels, n_packets=200, n_samples=32):
+    """Stream of n_packets small packets from an n_channels Utah array."""
+    names = ['elec%d' % (k + 1) for k in range(n_channels)]
+    data = np.zeros((n_channels, n_samples), dtype=np.float32)
+    node = _package().FixChannames()
+
+    def prepare():
+        return [gen.signal_packet(data, names) for _ in range(n_packets)]
+
+    def run(pkts):
+        for pkt in pkts:
+            node.data = pkt
+    return prepare, run
+
+
+def bench_fix_events(n_trials):
+    tmpdir, cleanup = _temp_dir()
+    try:
+        filename = gen.location_rule_mat(os.path.join(tmpdir, 'behavior_%d.mat' % n_trials), n_trials)
+        node = _package().FixEvents(filename=filename, cloud_host='None')
+    except BaseException:
+        cleanup()
+        raise
+
+    def run(pkt):
+        node.data = pkt
+    return (lambda: gen.marker_packet(np.zeros(0), np.zeros(0, dtype=object))), run, cleanup
+
+
+def bench_fix_events_merge(n_trials):
+    """FixEvents merging into hardware markers on a clock that is 1.5 s
+    ahead, with clock alignment."""
+    import scipy.io
+    tmpdir, cleanup = _temp_dir()
+    try:
+        filename = gen.location_rule_mat(os.path.join(tmpdir, 'behavior_%d.mat' % n_trials), n_trials)
+        mat = scipy.io.loadmat(filename)
+        node = _package().FixEvents(filename=filename, cloud_host='None', mode='merge', align_clocks=True)
+    except BaseException:
+        cleanup()
+        raise
+    hw_times = np.sort((mat['startTime'] + np.vstack((mat['targetOnset'], mat['cueOnset'],
+                                                      mat['sacStartTime']))).ravel()) / 1000 + 1.5
+    hw_markers = np.full(len(hw_times), 'hardware', dtype=object)
+
+    def run(pkt):
+        node.data = pkt
+    return (lambda: gen.marker_packet(hw_times, hw_markers.copy())), run, cleanup
+
+
+def bench_import_reach_grasp(n_trials):
+    times, codes = gen.blackrock_digital_events(n_trials)
+    node = _package().ImportReachGrasp(trial_table=True)
+
+    def run(pkt):
+        node.data = pkt
+    return (lambda: gen.event_packet(times, codes)), run
+
+
+def bench_import_reach_grasp_nev(n_trials):
+    """ImportReachGrasp reading the events from a .nev file (with 100 spike
+    packets per event) instead of an events chunk."""
+    tmpdir, cleanup = _temp_dir()
+    try:
+        filename = gen.blackrock_nev(os.path.join(tmpdir, 'session_%d.nev' % n_trials), n_trials)
+        node = _package().ImportReachGrasp(nev_filename=filename, cloud_host='None', trial_table=True)
+    except BaseException:
+        cleanup()
+        raise
+
+    def prepare():
+        import neuropype.engine as ne
+        return ne.Packet({})
+
+    def run(pkt):
+        node.data = pkt
+    return prepare, run, cleanup
+
+
+def bench_variant_lda(n_times, n_trials=200, n_channels=32, n_components=3):
+    X, y = gen.epoched_tensor(n_trials, n_times, n_channels)
+
+    def prepare():
+        node = _package().VariantLDA(n_components=n_components)
+        return node, gen.epoch_packet(X.copy(), y)
+
+    def run(args):
+        node, pkt = args
+        node.data = pkt
+    return prepare, run
+
+
+def bench_variant_lda_full(n_times):
+    return bench_variant_lda(n_times, n_components=None)
+
+
+# name -> (benchmark, size unit, default sizes, quick sizes)
+BENCHMARKS = {
+    'import_package': (bench_import_package, 'run', [1], [1]),
+    'get_unity_task_events': (bench_get_unity_task_events, 'trials', [100, 400, 1600], [50, 200]),
+    'get_unity_task_events_objects': (bench_get_unity_task_events_objects, 'trials', [100, 400, 1600],
+                                      [50, 200]),
+    'pupil_to_angle': (bench_pupil_to_angle, 'samples', [10**4, 10**5, 10**6], [10**4, 10**5]),
+    'pupil_to_angle_threaded': (bench_pupil_to_angle_threaded, 'samples', [10**4, 10**5, 10**6],
+                                [10**4, 10**5]),
+    'nslrhmm': (bench_nslrhmm, 'samples', [10**3, 10**4, 10**5], [10**3, 10**4]),
+    'nslrhmm_auto_noise': (bench_nslrhmm_auto_noise, 'samples', [10**3, 10**4, 10**5], [10**3, 10**4]),
+    'join_saccades_to_trials': (bench_join_saccades_to_trials, 'segments', [10**4, 10**5, 10**6],
+                                [10**4, 10**5]),
+    'fix_channames': (bench_fix_channames, 'channels', [96, 256], [96, 256]),
+    'fix_events': (bench_fix_events, 'trials', [10**3, 10**4, 10**5], [10**3, 10**4]),
+    'fix_events_merge': (bench_fix_events_merge, 'trials', [10**3, 10**4, 10**5], [10**3, 10**4]),
+    'import_reach_grasp': (bench_import_reach_grasp, 'trials', [10**3, 10**4, 10**5], [10**3, 10**4]),
+    'import_reach_grasp_nev': (bench_import_reach_grasp_nev, 'trials', [10**2, 10**3, 10**4], [10**2, 10**3]),
+    'variant_lda': (bench_variant_lda, 'times', [25, 100, 400], [25, 100]),
+    'variant_lda_full': (bench_variant_lda_full, 'times', [25, 100, 400], [25, 100]),
+}
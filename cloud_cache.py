@@ -0,0 +1,307 @@
+"""Local, size-bounded cache for files fetched with neuropype's storage.cloud_get.
+
+Nodes that read files from cloud storage (FixEvents, ImportReachGrasp) call
+cloud_get() from this module instead of storage.cloud_get(). If a cache
+directory is given, each remote file is downloaded once into that directory,
+under a name derived from its host, account, bucket, path and (where the store
+can tell) its version, and is served from there on subsequent runs. neuropype's
+storage API does not expose the ETag or modification time of remote files, so
+their cached copies are reused until they are older than max_age seconds (if
+given, or CUSTOM_NEUROPYPE_CACHE_MAX_AGE), are invalidated with
+DownloadCache.invalidate(), or are evicted. The least recently used files are
+evicted when the cache grows beyond its size limit, except for files used within
+the last min_age seconds, which another process may have just been handed but
+not yet opened. Several worker processes may share one cache directory:
+downloads go to temporary files that are renamed into place, and concurrent
+downloads, uses and evictions of the same file are serialized with a lock file
+next to it (which is removed along with the file).
+
+A batch runner can call prefetch() to download the files of upcoming sessions
+in the background while the current session is being processed.
+"""
+
+import os
+import time
+import shutil
+import hashlib
+import logging
+import tempfile
+
+from .executors import thread_pool
+
+
+logger = logging.getLogger(__name__)
+
+# default maximum total size of a cache directory, in bytes
+DEFAULT_MAX_SIZE = 10 * 2**30
+# files used within this many seconds are not evicted
+DEFAULT_MIN_AGE = 300.0
+# cache directory to use if a node does not specify one
+CACHE_DIR_ENV_VAR = 'CUSTOM_NEUROPYPE_CACHE_DIR'
+# maximum age of cached copies of remote files, in seconds, if not given
+MAX_AGE_ENV_VAR = 'CUSTOM_NEUROPYPE_CACHE_MAX_AGE'
+
+
+class NeuropypeStore:
+    """Files hosted on a storage provider supported by neuropype's cloud
+    utilities. The storage API does not expose object metadata (ETag or
+    modification time), so the version of a file cannot be known: without a
+    max_age, remote files are assumed to be immutable (which holds for
+    recorded sessions), and otherwise the version changes every max_age
+    seconds, so that cached copies are downloaded again at the latest max_age
+    seconds after they were downloaded."""
+
+    def __init__(self, host='Default', account='', bucket='', credentials='', max_age=None):
+        self.host = host
+        self.account = account
+        self.bucket = bucket
+        self.credentials = credentials
+        self.max_age = max_age
+
+    def identity(self, path):
+        return self.host, self.account, self.bucket, path
+
+    def version(self, path):
+        if not self.max_age:
+            return None
+        return 'ttl-%d-%d' % (self.max_age, time.time() // self.max_age)
+
+    def fetch(self, path, dest):
+        from neuropype.utilities.cloud import storage
+        local = storage.cloud_get(path, host=self.host, account=self.account,
+                                  bucket=self.bucket, credentials=self.credentials)
+        # move rather than copy the download, so the file is not stored twice
+        shutil.move(local, dest)
+
+
+class LocalDirStore:
+    """A directory standing in for a cloud bucket (e.g., for testing). The
+    version of a file is its modification time and size."""
+
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+
+    def identity(self, path):
+        return 'Local', '', self.root, path
+
+    def version(self, path):
+        st = os.stat(os.path.join(self.root, path))
+        return '%d-%d' % (st.st_mtime_ns, st.st_size)
+
+    def fetch(self, path, dest):
+        shutil.copyfile(os.path.join(self.root, path), dest)
+
+
+class DownloadCache:
+    """A directory of downloaded files, bounded in size by LRU eviction."""
+
+    def __init__(self, cache_dir, max_size=DEFAULT_MAX_SIZE, min_age=DEFAULT_MIN_AGE):
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.max_size = max_size
+        self.min_age = min_age
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def key(self, store, path):
+        """Content key for the current version of a file in a store."""
+        ident = store.identity(path) + (store.version(path),)
+        digest = hashlib.sha1(repr(ident).encode('utf-8')).hexdigest()
+        return digest + os.path.splitext(path)[1]
+
+    def get(self, store, path):
+        """Get the local file name of a cached copy of path, downloading it
+        first if necessary."""
+        key = self.key(store, path)
+        filename = os.path.join(self.cache_dir, key)
+        # marking the file as used under its lock keeps evict() from removing
+        # it in between (see evict)
+        with _FileLock(filename + '.lock'):
+            if self._touch(filename):
+                logger.debug("Using cached copy of %s." % path)
+                return filename
+            logger.info("Downloading %s into cache %s..." % (path, self.cache_dir))
+            fd, tmp_name = tempfile.mkstemp(dir=self.cache_dir, suffix='.part')
+            os.close(fd)
+            try:
+                store.fetch(path, tmp_name)
+                os.replace(tmp_name, filename)
+            finally:
+                if os.path.exists(tmp_name):
+                    os.remove(tmp_name)
+        self.evict(keep=filename)
+        return filename
+
+    def invalidate(self, store, path):
+        """Remove the cached copy of the current version of a file (e.g.,
+        after it has changed remotely), so that the next get() downloads it
+        again. Returns whether there was a cached copy."""
+        filename = os.path.join(self.cache_dir, self.key(store, path))
+        with _FileLock(filename + '.lock'):
+            try:
+                os.remove(filename)
+            except FileNotFoundError:
+                return False
+            _remove_lock(filename + '.lock')
+            return True
+
+    def prefetch(self, store, paths):
+        """Download the given files into the cache in the background. Returns
+        a list of futures that resolve to the local file names."""
+        # the downloads wait on the network, so they share an I/O pool that
+        # does not count against the CPU budget (see executors)
+        pool = thread_pool('cloud_cache_prefetch', 4, cpu_bound=False)
+        return [pool.submit(self.get, store, p) for p in paths]
+
+    def size(self):
+        """Total size of the cached files, in bytes."""
+        return sum(sz for _, _, sz in self._entries())
+
+    def evict(self, keep=None):
+        """Remove least recently used files until the cache fits in
+        max_size. Never removes the file named keep, files used within the
+        last min_age seconds, or files that another process is downloading or
+        getting at the moment. The lock file of a removed file is removed
+        while it is held; processes waiting on it then lock a new one (see
+        _FileLock)."""
+        with _FileLock(os.path.join(self.cache_dir, '.evict.lock')):
+            entries = sorted(self._entries())
+            total = sum(sz for _, _, sz in entries)
+            cutoff = time.time() - self.min_age
+            for last_used, filename, sz in entries:
+                if total <= self.max_size:
+                    break
+                if filename == keep or last_used > cutoff:
+                    continue
+                try:
+                    with _FileLock(filename + '.lock', blocking=False):
+                        # it may have been used since it was listed
+                        if os.stat(filename).st_mtime > cutoff:
+                            continue
+                        os.remove(filename)
+                        _remove_lock(filename + '.lock')
+                    total -= sz
+                except OSError:
+                    # in use, removed by another process, or still open (on Windows)
+                    pass
+
+    def _entries(self):
+        """List (last access time, file name, size) of all cached files."""
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.is_file() and not entry.name.endswith(('.lock', '.part')):
+                try:
+                    st = entry.stat()
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, entry.path, st.st_size))
+        return entries
+
+    @staticmethod
+    def _touch(filename):
+        """Mark a cached file as recently used; returns whether it exists."""
+        try:
+            os.utime(filename)
+            return True
+        except OSError:
+            return False
+
+
+def _remove_lock(filename):
+    """Remove a lock file that the caller holds (where the platform allows)."""
+    try:
+        os.remove(filename)
+    except OSError:
+        # e.g., open elsewhere on Windows; it stays and is reused
+        pass
+
+
+class _FileLock:
+    """Exclusive inter-process lock on a lock file. If not blocking, entering
+    raises BlockingIOError if another process holds the lock. If the lock
+    file was removed (by its holder) while waiting for it, the lock is taken
+    on the lock file that now has its name."""
+
+    def __init__(self, filename, blocking=True):
+        self.filename = filename
+        self.blocking = blocking
+        self.fd = None
+
+    def __enter__(self):
+        while True:
+            self.fd = os.open(self.filename, os.O_RDWR | os.O_CREAT)
+            try:
+                self._lock()
+            except BaseException:
+                os.close(self.fd)
+                raise
+            try:
+                if os.path.samestat(os.fstat(self.fd), os.stat(self.filename)):
+                    return self
+            except OSError:
+                pass
+            self.__exit__()
+
+    def _lock(self):
+        try:
+            import fcntl
+        except ImportError:
+            import msvcrt
+            while True:
+                try:
+                    msvcrt.locking(self.fd, msvcrt.LK_LOCK if self.blocking else msvcrt.LK_NBLCK, 1)
+                    return
+                except OSError:
+                    if not self.blocking:
+                        raise BlockingIOError("%s is locked." % self.filename)
+                    time.sleep(0.05)
+        fcntl.flock(self.fd, fcntl.LOCK_EX if self.blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+    def __exit__(self, *args):
+        try:
+            import fcntl
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+        except ImportError:
+            import msvcrt
+            os.lseek(self.fd, 0, os.SEEK_SET)
+            msvcrt.locking(self.fd, msvcrt.LK_UNLCK, 1)
+        os.close(self.fd)
+
+
+def _max_age(max_age):
+    """The given maximum age of cached copies, else the one of the
+    environment (None: cached copies never expire)."""
+    if max_age is None:
+        try:
+            max_age = float(os.environ.get(MAX_AGE_ENV_VAR, '') or 0)
+        except ValueError:
+            logger.warning("Ignoring invalid %s." % MAX_AGE_ENV_VAR)
+            max_age = 0
+    return max_age or None
+
+
+def cloud_get(filename, host='Default', account='', bucket='', credentials='', cache_dir='',
+              max_size=DEFAULT_MAX_SIZE, max_age=None):
+    """Drop-in replacement for storage.cloud_get that goes through a local
+    download cache. The cache is used if cache_dir (or the environment variable
+    CUSTOM_NEUROPYPE_CACHE_DIR) is set and the file is actually remote. Cached
+    copies are downloaded again once they are older than max_age seconds (or
+    CUSTOM_NEUROPYPE_CACHE_MAX_AGE; default: never)."""
+    cache_dir = cache_dir or os.environ.get(CACHE_DIR_ENV_VAR, '')
+    if not cache_dir or host in ('Local', 'None') or os.path.isfile(filename):
+        from neuropype.utilities.cloud import storage
+        return storage.cloud_get(filename, host=host, account=account,
+                                 bucket=bucket, credentials=credentials)
+    store = NeuropypeStore(host=host, account=account, bucket=bucket, credentials=credentials,
+                           max_age=_max_age(max_age))
+    return DownloadCache(cache_dir, max_size=max_size).get(store, filename)
+
+
+def prefetch(filenames, host='Default', account='', bucket='', credentials='', cache_dir='',
+             max_size=DEFAULT_MAX_SIZE, max_age=None):
+    """Start downloading the given remote files into the cache in the
+    background. Returns a list of futures (empty if caching is disabled)."""
+    cache_dir = cache_dir or os.environ.get(CACHE_DIR_ENV_VAR, '')
+    if not cache_dir or host in ('Local', 'None'):
+        return []
+    store = NeuropypeStore(host=host, account=account, bucket=bucket, credentials=credentials,
+                           max_age=_max_age(max_age))
+    return DownloadCache(cache_dir, max_size=max_size).prefetch(store, filenames)
@@ -0,0 +1,205 @@
+"""Dictionary-encoded (categorical) columns and a memory-mappable table file.
+
+Event tables are stored in InstanceAxis.data as record arrays. String fields
+are normally Python object columns, which are large and slow to filter.
+encode_records() replaces them with integer codes into a table of categories
+(one sorted array of strings per field); nodes that emit encoded tables put
+the categories into the chunk's properties under CATEGORIES_PROP:
+
+    codes, cats = chunk.block.axes[instance].data, chunk.props['categories']
+    saccades = codes['Marker'] == np.searchsorted(cats['Marker'], 'Saccade')
+
+Missing values are encoded as -1.
+
+write_table() and read_table() store a table (a dict of equal-length columns)
+in a single file with the layout
+
+    b'CNPTABL1'                  magic (8 bytes)
+    uint64 (little-endian)       length of the header
+    header                       JSON: number of rows, and for each column its
+                                 name, dtype, byte offset and categories (if any)
+    column buffers               each aligned to 64 bytes; the offsets in the
+                                 header are relative to the first buffer
+
+so that read_table() can memory-map the columns without deserializing any
+Python objects. String columns are dictionary-encoded on writing.
+"""
+
+import json
+
+import numpy as np
+
+
+# chunk property that holds the categories of the encoded fields
+CATEGORIES_PROP = 'categories'
+
+_MAGIC = b'CNPTABL1'
+_ALIGN = 64
+
+
+def code_dtype(n_categories):
+    """Smallest signed integer type for the codes of n_categories (and -1)."""
+    for dtype in (np.int8, np.int16, np.int32):
+        if n_categories <= np.iinfo(dtype).max:
+            return np.dtype(dtype)
+    return np.dtype(np.int64)
+
+
+def encode_column(values):
+    """Dictionary-encode an array of strings; returns (codes, categories).
+
+    The categories are always sorted, so that codes can be looked up with
+    np.searchsorted. None and NaN are encoded as -1; any other values that are
+    not strings (e.g., numbers, or a mix of types) are encoded as their str(),
+    as they would be decoded anyway.
+    """
+    import pandas as pd
+    values = np.asarray(values)
+    if values.dtype.kind == 'S':
+        values = np.char.decode(values, 'utf-8')
+    elif values.dtype.kind != 'U' and pd.api.types.infer_dtype(values.ravel(), skipna=True) != 'string':
+        missing = pd.isna(values)
+        strings = np.full(values.shape, None, dtype=object)
+        strings[~missing] = values[~missing].astype(str)
+        values = strings
+    codes, categories = pd.factorize(values, sort=True)
+    categories = np.asarray(categories).astype(str)
+    return codes.astype(code_dtype(len(categories))), categories
+
+
+def decode_column(codes, categories, missing=None):
+    """Map codes back to an array of strings, with missing in place of -1.
+    With missing=None, the result is an object array (as in unencoded tables),
+    otherwise a fixed-width string array."""
+    codes = np.asarray(codes)
+    categories = np.asarray(categories)
+    if missing is None:
+        lookup = np.append(categories.astype(object), [None])
+    else:
+        lookup = np.append(categories, [missing])
+    return lookup[codes]
+
+
+def encode_records(data, fields=None):
+    """Encode the string fields (or the given fields) of a record array.
+
+    Returns:
+        (record array with integer code fields, {field name: categories});
+        the other fields and the field titles are kept.
+    """
+    data = np.asarray(data)
+    if fields is None:
+        fields = [f for f in data.dtype.names if data.dtype[f].kind in 'OUS']
+    categories, columns, descr = {}, [], []
+    for name in data.dtype.names:
+        title = data.dtype.fields[name][2] if len(data.dtype.fields[name]) > 2 else None
+        key = (title, name) if title is not None else name
+        if name in fields:
+            codes, categories[name] = encode_column(data[name])
+            columns.append(codes)
+        else:
+            columns.append(data[name])
+        descr.append((key, columns[-1].dtype))
+    out = np.empty(len(data), dtype=descr)
+    for name, col in zip(data.dtype.names, columns):
+        out[name] = col
+    return out, categories
+
+
+def decode_records(data, categories):
+    """Inverse of encode_records: turn the encoded fields back into object
+    columns of strings."""
+    data = np.asarray(data)
+    descr, columns = [], []
+    for name in data.dtype.names:
+        title = data.dtype.fields[name][2] if len(data.dtype.fields[name]) > 2 else None
+        key = (title, name) if title is not None else name
+        col = decode_column(data[name], categories[name]) if name in categories else data[name]
+        columns.append(col)
+        descr.append((key, col.dtype))
+    out = np.empty(len(data), dtype=descr)
+    for name, col in zip(data.dtype.names, columns):
+        out[name] = col
+    return out
+
+
+def write_table(filename, columns, categories=None, metadata=None):
+    """Write a table to a file.
+
+    Args:
+        filename: name of the file
+        columns: dict of equal-length 1d arrays; string and object columns are
+          dictionary-encoded
+        categories: {column name: categories} for columns that are already
+          encoded
+        metadata: optional JSON-serializable dict stored in the header
+    """
+    categories = dict(categories or {})
+    lengths = {len(col) for col in columns.values()}
+    if len(lengths) > 1:
+        raise ValueError("All columns must have the same length.")
+    buffers, header_cols = [], []
+    for name, col in columns.items():
+        col = np.asarray(col)
+        if col.dtype.kind in 'OUS' and name not in categories:
+            col, categories[name] = encode_column(col)
+        if col.ndim != 1 or col.dtype.kind not in 'biuf':
+            raise ValueError("Column %s has unsupported type %s." % (name, col.dtype))
+        col = np.ascontiguousarray(col, dtype=col.dtype.newbyteorder('<'))
+        entry = {'name': name, 'dtype': col.dtype.str}
+        if name in categories:
+            entry['categories'] = np.asarray(categories[name]).astype(str).tolist()
+        buffers.append(col)
+        header_cols.append(entry)
+
+    offset = 0
+    for entry, buf in zip(header_cols, buffers):
+        entry['offset'] = offset
+        offset = _aligned(offset + buf.nbytes)
+    header = {'rows': lengths.pop() if lengths else 0, 'columns': header_cols,
+              'metadata': metadata or {}}
+    blob = json.dumps(header).encode()
+
+    with open(filename, 'wb') as f:
+        f.write(_MAGIC)
+        f.write(np.uint64(len(blob)).astype('<u8').tobytes())
+        f.write(blob)
+        start = _aligned(f.tell())
+        for entry, buf in zip(header_cols, buffers):
+            f.write(b'\0' * (start + entry['offset'] - f.tell()))
+            f.write(buf.tobytes())
+
+
+def read_table(filename, mmap=True):
+    """Read a table written by write_table.
+
+    Returns:
+        (columns, categories, metadata), where columns is a dict of arrays
+        (read-only memory maps if mmap is True, which is free until the data
+        is accessed), and categories holds the categories of the encoded
+        columns (see decode_column).
+    """
+    with open(filename, 'rb') as f:
+        if f.read(len(_MAGIC)) != _MAGIC:
+            raise ValueError("%s is not a table file." % filename)
+        size = int(np.frombuffer(f.read(8), dtype='<u8')[0])
+        header = json.loads(f.read(size).decode())
+        start = _aligned(f.tell())
+        columns, categories = {}, {}
+        for entry in header['columns']:
+            dtype = np.dtype(entry['dtype'])
+            if header['rows'] == 0:
+                columns[entry['name']] = np.zeros(0, dtype=dtype)
+            elif mmap:
+                columns[entry['name']] = np.memmap(filename, dtype=dtype, mode='r',
+                                                   offset=start + entry['offset'], shape=(header['rows'],))
+            else:
+                f.seek(start + entry['offset'])
+                columns[entry['name']] = np.fromfile(f, dtype=dtype, count=header['rows'])
+            if 'categories' in entry:
+                categories[entry['name']] = np.asarray(entry['categories'], dtype=str)
+    return columns, categories, header['metadata']
+
+
+def _aligned(offset):
+    return -(-offset // _ALIGN) * _ALIGN
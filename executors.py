@@ -0,0 +1,321 @@
+"""Process-wide CPU budget shared by the parallel code paths of this package.
+
+The thread and process pools of the nodes (PupilToAngle's conversion threads,
+the cloud_cache prefetch threads, batch's worker processes) and the
+multithreaded BLAS inside VariantLDA's solvers all draw from one budget of
+CPUs, so that running them side by side does not oversubscribe the machine.
+The budget defaults to the number of CPUs, or to the value of the environment
+variable CUSTOM_NEUROPYPE_CPUS, and can be changed with set_cpu_budget().
+
+    thread_pool(name, n)    the shared thread pool of the given name, created
+                            on first use and resized by later calls; each
+                            task of a CPU-bound pool holds one CPU of the
+                            budget while it runs
+    process_pool(n, ...)    a process pool whose workers reserve CPUs of the
+                            budget until the pool is shut down; each worker
+                            gets a budget of threads_per_worker CPUs and its
+                            BLAS/OpenMP threads are capped accordingly
+    blas_threads()          context manager that reserves some of the free
+                            CPUs for a multithreaded BLAS computation (waiting
+                            for one if none is free) and limits the BLAS
+                            threads to them
+    utilization()           the budget, the CPUs in use, and the workers and
+                            busy workers of each pool
+
+The BLAS/OpenMP thread counts are capped through threadpoolctl if it is
+installed, and otherwise only through the environment variables that the BLAS
+libraries read when they are loaded (which covers newly spawned workers).
+"""
+
+import os
+import logging
+import threading
+import contextlib
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+
+logger = logging.getLogger(__name__)
+
+# environment variable with the default CPU budget
+BUDGET_ENV_VAR = 'CUSTOM_NEUROPYPE_CPUS'
+# environment variables read by the BLAS/OpenMP libraries at load time
+BLAS_ENV_VARS = ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS',
+                 'BLIS_NUM_THREADS', 'VECLIB_MAXIMUM_THREADS', 'NUMEXPR_NUM_THREADS')
+
+
+def default_cpu_budget():
+    """The CPU budget given by CUSTOM_NEUROPYPE_CPUS, else the number of CPUs."""
+    value = os.environ.get(BUDGET_ENV_VAR, '')
+    try:
+        if int(value) > 0:
+            return int(value)
+    except ValueError:
+        if value:
+            logger.warning("Ignoring invalid %s=%r." % (BUDGET_ENV_VAR, value))
+    return os.cpu_count() or 1
+
+
+class CpuBudget:
+    """A number of CPUs that tasks take and give back. CPUs are taken either
+    one per task, waiting until one is free (acquire), or as a reservation of
+    up to n CPUs, waiting until at least one is free (reserve); the CPUs in
+    use never exceed the total (unless it is lowered with resize).
+
+    A thread that already holds CPUs of the budget (e.g., a task of a
+    CPU-bound thread pool, or the creator of a process pool) does not wait
+    for a reservation, which could deadlock, but is granted only the free
+    CPUs, possibly none. CPUs are released by the thread that took them,
+    unless another owner (a thread ident) is given."""
+
+    def __init__(self, total):
+        self.total = max(int(total), 1)
+        self.in_use = 0
+        self._held = {}     # thread ident -> CPUs held
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        with self._cond:
+            while self.in_use >= self.total:
+                self._cond.wait()
+            self._take(1)
+
+    def reserve(self, n):
+        with self._cond:
+            if not self._held.get(threading.get_ident()):
+                while self.in_use >= self.total:
+                    self._cond.wait()
+            granted = max(min(int(n), self.total - self.in_use), 0)
+            self._take(granted)
+            return granted
+
+    def release(self, n=1, owner=None):
+        with self._cond:
+            self.in_use -= n
+            owner = threading.get_ident() if owner is None else owner
+            self._held[owner] = self._held.get(owner, 0) - n
+            if self._held[owner] <= 0:
+                del self._held[owner]
+            self._cond.notify_all()
+
+    def _take(self, n):
+        self.in_use += n
+        if n:
+            ident = threading.get_ident()
+            self._held[ident] = self._held.get(ident, 0) + n
+
+    def resize(self, total):
+        with self._cond:
+            self.total = max(int(total), 1)
+            self._cond.notify_all()
+
+
+_budget = CpuBudget(default_cpu_budget())
+# the thread pools, by name, and the live process pools
+_thread_pools = {}
+_process_pools = []
+_pools_lock = threading.Lock()
+
+
+def cpu_budget():
+    """The number of CPUs that the parallel code of this process may use."""
+    return _budget.total
+
+
+def set_cpu_budget(n=None):
+    """Set the number of CPUs that the parallel code of this process may use
+    (None: back to the default). Thread pools are resized when they are next
+    requested; until then, and for running process pools, the tasks of
+    CPU-bound pools are throttled to the new budget."""
+    _budget.resize(n or default_cpu_budget())
+
+
+class _BudgetThreadPool(ThreadPoolExecutor):
+    """Thread pool of up to capacity threads that runs at most workers tasks
+    at a time, each holding a CPU of the budget while it runs (if
+    cpu_bound)."""
+
+    def __init__(self, name, capacity, cpu_bound):
+        super().__init__(max_workers=capacity, thread_name_prefix=name)
+        self.name = name
+        self.capacity = capacity
+        self.workers = capacity
+        self.cpu_bound = cpu_bound
+        self.busy = 0
+        self._slots = threading.Condition()
+
+    def resize(self, workers):
+        with self._slots:
+            self.workers = workers
+            self._slots.notify_all()
+
+    def submit(self, fn, *args, **kwargs):
+        return super().submit(self._run, fn, args, kwargs)
+
+    def _run(self, fn, args, kwargs):
+        with self._slots:
+            while self.busy >= self.workers:
+                self._slots.wait()
+            self.busy += 1
+        try:
+            if self.cpu_bound:
+                _budget.acquire()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                if self.cpu_bound:
+                    _budget.release()
+        finally:
+            with self._slots:
+                self.busy -= 1
+                self._slots.notify()
+
+
+def thread_pool(name, max_workers=None, cpu_bound=True):
+    """Get the shared thread pool of the given name, creating it on first use,
+    with max_workers workers. The size defaults to (and, for CPU-bound pools,
+    is limited to) the CPU budget. Pools that wait on I/O (cpu_bound=False) do
+    not count against the budget.
+
+    There is one pool per name: a smaller size only limits the number of
+    tasks that it runs at a time, and a larger one replaces it with a larger
+    pool (the old one is shut down, but finishes the tasks already submitted
+    to it).
+    """
+    n = int(max_workers or cpu_budget())
+    if cpu_bound:
+        n = min(n, cpu_budget())
+    n = max(n, 1)
+    with _pools_lock:
+        pool = _thread_pools.get(name)
+        if pool is None or n > pool.capacity or pool.cpu_bound != cpu_bound:
+            old, pool = pool, _BudgetThreadPool(name, n, cpu_bound)
+            _thread_pools[name] = pool
+            if old is not None:
+                old.shutdown(wait=False)
+        elif n != pool.workers:
+            pool.resize(n)
+        return pool
+
+
+class _BudgetProcessPool(ProcessPoolExecutor):
+    """Process pool that holds a reservation of one CPU per worker until it is
+    shut down, and counts its pending tasks."""
+
+    def __init__(self, name, max_workers, threads_per_worker, initializer, initargs, **kwargs):
+        self.name = name
+        self._owner = threading.get_ident()
+        self.reserved = _budget.reserve(max_workers)
+        # if the creating thread holds all of the budget, one worker runs on its CPUs
+        self.workers = max(self.reserved, 1)
+        if self.workers < max_workers:
+            logger.info("Starting %d instead of %d worker processes (CPU budget: %d of %d in use)."
+                        % (self.workers, max_workers, _budget.in_use - self.reserved, _budget.total))
+        self.pending = 0
+        self._released = False
+        try:
+            super().__init__(max_workers=self.workers, initializer=_init_process,
+                             initargs=(threads_per_worker, initializer, initargs), **kwargs)
+        except BaseException:
+            self._release()
+            raise
+        with _pools_lock:
+            _process_pools.append(self)
+
+    @property
+    def busy(self):
+        return min(self.pending, self.workers)
+
+    def submit(self, fn, *args, **kwargs):
+        fut = super().submit(fn, *args, **kwargs)
+        with _pools_lock:
+            self.pending += 1
+        fut.add_done_callback(self._task_done)
+        return fut
+
+    def _task_done(self, fut):
+        with _pools_lock:
+            self.pending -= 1
+
+    def shutdown(self, *args, **kwargs):
+        try:
+            super().shutdown(*args, **kwargs)
+        finally:
+            self._release()
+
+    def _release(self):
+        with _pools_lock:
+            if self._released:
+                return
+            self._released = True
+            if self in _process_pools:
+                _process_pools.remove(self)
+        _budget.release(self.reserved, owner=self._owner)
+
+
+def process_pool(max_workers=None, initializer=None, initargs=(), threads_per_worker=1,
+                 name='process_pool', **kwargs):
+    """Create a process pool with up to max_workers workers (default: the CPU
+    budget), as many as the budget has free CPUs (waiting until one is free).
+    Each
+    worker runs with a budget of threads_per_worker CPUs and BLAS/OpenMP
+    threads capped to it, before calling initializer(*initargs). Further
+    keyword arguments are passed to ProcessPoolExecutor. Use it as a context
+    manager (or call shutdown()) to return its CPUs to the budget."""
+    return _BudgetProcessPool(name, int(max_workers or cpu_budget()), threads_per_worker,
+                              initializer, initargs, **kwargs)
+
+
+def _init_process(threads, initializer, initargs):
+    configure_worker(threads)
+    if initializer is not None:
+        initializer(*initargs)
+
+
+def configure_worker(threads=1):
+    """Give this (worker) process a budget of the given number of CPUs and cap
+    its BLAS/OpenMP threads to it."""
+    set_cpu_budget(threads)
+    for var in BLAS_ENV_VARS:
+        os.environ[var] = str(threads)
+    try:
+        from threadpoolctl import threadpool_limits
+    except ImportError:
+        return
+    threadpool_limits(limits=threads)
+
+
+@contextlib.contextmanager
+def blas_threads(max_threads=None):
+    """Reserve up to max_threads free CPUs of the budget (default: half of the
+    budget, so that the thread pools keep some), waiting until at least one is
+    free, for a BLAS/OpenMP computation and limit the BLAS/OpenMP threads to
+    them while in the context. Yields the number of threads. In a thread that
+    already holds CPUs of the budget (e.g., a thread pool task), it does not
+    wait, and the computation runs on the CPUs that are free, or else on a
+    single thread.
+
+    The limits set through threadpoolctl apply to the whole process, so
+    concurrent computations in other threads are limited as well.
+    """
+    n = _budget.reserve(max_threads or max(cpu_budget() // 2, 1))
+    threads = max(n, 1)
+    try:
+        try:
+            from threadpoolctl import threadpool_limits
+            limits = threadpool_limits(limits=threads)
+        except ImportError:
+            limits = contextlib.nullcontext()
+        with limits:
+            yield threads
+    finally:
+        _budget.release(n)
+
+
+def utilization():
+    """Current use of the CPU budget: a dict with the budget, the CPUs in use,
+    and per pool its kind, number of workers and number of busy workers."""
+    with _pools_lock:
+        pools = [(p, 'thread') for p in _thread_pools.values()] + [(p, 'process') for p in _process_pools]
+        return {'budget': _budget.total, 'in_use': _budget.in_use,
+                'pools': [{'name': p.name, 'kind': kind, 'workers': p.workers, 'busy': p.busy,
+                           'cpu_bound': getattr(p, 'cpu_bound', True)} for p, kind in pools]}
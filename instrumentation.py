@@ -0,0 +1,220 @@
+"""Opt-in performance instrumentation for the nodes in this package.
+
+Each node's data setter is wrapped with @instrumented. While instrumentation is
+disabled (the default), the wrapper only checks a flag and calls the setter.
+Once enabled with enable(sink, ...), every call records a metrics dict:
+
+    node            class name of the node
+    start           wall-clock time at which the call started (time.time())
+    wall_s          duration of the call, in seconds
+    in_count        number of samples/instances in the input packet
+    out_count       number of samples/instances in the output packet
+    phases          {phase name: seconds} for the named sub-phases of the call
+    peak_mem_bytes  peak memory allocated during the call (only if enabled
+                    with trace_memory=True, which uses tracemalloc and is slow)
+
+and passes it to all sinks. Nodes delimit their sub-phases with lap(name),
+which ends the phase called name at the current time (it began at the previous
+lap or at the start of the call), or with the context manager phase(name).
+
+Metrics can also be enabled without code changes by setting the environment
+variable CUSTOM_NEUROPYPE_METRICS to the name of a JSON-lines file.
+"""
+
+import os
+import json
+import time
+import logging
+import threading
+import functools
+from collections import defaultdict, deque
+
+
+logger = logging.getLogger(__name__)
+
+# active sinks; instrumentation is enabled iff this is non-empty
+_sinks = []
+_trace_memory = False
+# per-thread stack of the metrics records of the calls in progress
+_local = threading.local()
+
+
+def enable(*sinks, trace_memory=False):
+    """Enable instrumentation, sending metrics to the given sinks (callables
+    that take a metrics dict, such as the sink classes below)."""
+    global _trace_memory
+    _sinks[:] = sinks or [LoggerSink()]
+    _trace_memory = trace_memory
+
+
+def disable():
+    """Disable instrumentation."""
+    global _trace_memory
+    _sinks[:] = []
+    _trace_memory = False
+
+
+def is_enabled():
+    return bool(_sinks)
+
+
+def instrumented(setter):
+    """Decorator for a node's data setter."""
+    @functools.wraps(setter)
+    def wrapper(node, pkt):
+        if not _sinks:
+            return setter(node, pkt)
+        return _run_instrumented(setter, node, pkt)
+    return wrapper
+
+
+def lap(name):
+    """End the sub-phase called name of the current call."""
+    stack = getattr(_local, 'stack', None)
+    if stack:
+        record = stack[-1]
+        now = time.perf_counter()
+        record['phases'][name] = record['phases'].get(name, 0.0) + now - record['_lap']
+        record['_lap'] = now
+
+
+class phase:
+    """Context manager that times a sub-phase of the current call."""
+
+    __slots__ = ('name', 't0')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        stack = getattr(_local, 'stack', None)
+        if stack:
+            now = time.perf_counter()
+            phases = stack[-1]['phases']
+            phases[self.name] = phases.get(self.name, 0.0) + now - self.t0
+            stack[-1]['_lap'] = now
+
+
+def _run_instrumented(setter, node, pkt):
+    import tracemalloc
+    stack = getattr(_local, 'stack', None)
+    if stack is None:
+        stack = _local.stack = []
+    record = {'node': type(node).__name__, 'start': time.time(), 'in_count': packet_size(pkt),
+              'phases': {}}
+    trace = _trace_memory
+    started_tracing = False
+    if trace:
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            started_tracing = True
+        tracemalloc.reset_peak()
+        mem_before = tracemalloc.get_traced_memory()[0]
+    stack.append(record)
+    t0 = record['_lap'] = time.perf_counter()
+    try:
+        return setter(node, pkt)
+    except Exception as e:
+        record['error'] = '%s: %s' % (type(e).__name__, e)
+        raise
+    finally:
+        record['wall_s'] = time.perf_counter() - t0
+        stack.pop()
+        del record['_lap']
+        if trace:
+            record['peak_mem_bytes'] = tracemalloc.get_traced_memory()[1] - mem_before
+            if started_tracing:
+                tracemalloc.stop()
+        record['out_count'] = packet_size(getattr(node, '_data', None))
+        for sink in list(_sinks):
+            try:
+                sink(record)
+            except Exception as e:
+                logger.warning("Metrics sink %r failed: %s" % (sink, e))
+
+
+def packet_size(pkt):
+    """Total number of samples (time points) and instances in a packet."""
+    total = 0
+    for chnk in getattr(pkt, 'chunks', {}).values():
+        for ax in getattr(getattr(chnk, 'block', None), 'axes', ()):
+            if getattr(ax, 'type_str', None) in ('time', 'instance'):
+                total += len(ax)
+                break
+    return total
+
+
+# --- sinks ---
+
+class LoggerSink:
+    """Log each metrics record."""
+
+    def __init__(self, log=logger, level=logging.INFO):
+        self.log = log
+        self.level = level
+
+    def __call__(self, record):
+        phases = ', '.join('%s %.4f s' % kv for kv in record['phases'].items())
+        self.log.log(self.level, "%s: %.4f s, %d -> %d samples/instances%s%s"
+                     % (record['node'], record['wall_s'], record['in_count'], record['out_count'],
+                        ' (%s)' % phases if phases else '',
+                        ', peak memory %d bytes' % record['peak_mem_bytes']
+                        if 'peak_mem_bytes' in record else ''))
+
+
+class JsonLinesSink:
+    """Append each metrics record as a line of JSON to a file. Lines are
+    written with a single write() call on a file opened for appending, so
+    several processes can share one file."""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.lock = threading.Lock()
+
+    def __call__(self, record):
+        line = json.dumps(record) + '\n'
+        with self.lock, open(self.filename, 'a') as f:
+            f.write(line)
+
+
+class HistogramSink:
+    """Keep the most recent values of each metric per node in memory, for
+    histograms and percentile summaries."""
+
+    def __init__(self, max_values=10000):
+        self.max_values = max_values
+        self.values = defaultdict(lambda: deque(maxlen=self.max_values))
+        self.lock = threading.Lock()
+
+    def __call__(self, record):
+        with self.lock:
+            node = record['node']
+            for metric in ('wall_s', 'in_count', 'out_count', 'peak_mem_bytes'):
+                if metric in record:
+                    self.values[node, metric].append(record[metric])
+            for name, secs in record['phases'].items():
+                self.values[node, 'phase:' + name].append(secs)
+
+    def histogram(self, node, metric, bins=20):
+        """Get (counts, bin edges) of a metric of a node."""
+        import numpy as np
+        with self.lock:
+            return np.histogram(np.asarray(self.values[node, metric]), bins=bins)
+
+    def summary(self):
+        """Get {(node, metric): {count, mean, p50, p90, p99, max}}."""
+        import numpy as np
+        with self.lock:
+            items = [(k, np.asarray(v, dtype=float)) for k, v in self.values.items() if len(v)]
+        return {k: {'count': len(v), 'mean': float(v.mean()), 'p50': float(np.percentile(v, 50)),
+                    'p90': float(np.percentile(v, 90)), 'p99': float(np.percentile(v, 99)),
+                    'max': float(v.max())}
+                for k, v in items}
+
+
+if os.environ.get('CUSTOM_NEUROPYPE_METRICS'):
+    enable(JsonLinesSink(os.environ['CUSTOM_NEUROPYPE_METRICS']))
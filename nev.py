@@ -0,0 +1,107 @@
+"""Event-only reader for Blackrock .nev files.
+
+A .nev file starts with a 336-byte basic header
+
+    FileTypeID              char[8]     'NEURALEV' (or 'BREVENTS' in spec 3.0)
+    FileSpec                uint8[2]    major, minor version
+    AdditionalFlags         uint16
+    BytesInHeaders          uint32      size of all headers, in bytes
+    BytesInDataPackets      uint32      size of each data packet, in bytes
+    TimeStampResolution     uint32      timestamp ticks per second
+    SampleTimeResolution    uint32
+    TimeOrigin              uint16[8]   Windows SYSTEMTIME
+    CreatingApplication     char[32]
+    Comment                 char[256]
+    NumberOfExtendedHeaders uint32
+
+followed by the extended headers and then by fixed-size data packets. Each
+packet starts with a timestamp (uint32, or uint64 from spec 3.0 on) and a
+packet ID; packet ID 0 marks the digital/serial input packets, which continue
+with an insertion reason (uint8), a reserved byte, and the 16-bit input value.
+As in neo's BlackrockRawIO, the packets with insertion reason 1 are the
+digital input port events and those with reason 129 the serial port events.
+
+read_digital_events() memory-maps the packets with a structured dtype and
+selects the event packets block by block, so that only the few event words are
+ever copied out of the file, however many spike packets it holds.
+"""
+
+import os
+
+import numpy as np
+
+
+_BASIC_HEADER = np.dtype([
+    ('file_type_id', 'S8'), ('ver_major', 'u1'), ('ver_minor', 'u1'), ('additional_flags', '<u2'),
+    ('bytes_in_headers', '<u4'), ('bytes_in_data_packets', '<u4'), ('timestamp_resolution', '<u4'),
+    ('sample_resolution', '<u4'), ('time_origin', '<u2', (8,)), ('creating_application', 'S32'),
+    ('comment', 'S256'), ('n_extended_headers', '<u4')])
+
+# insertion reasons of the event packets
+DIGITAL_INPUT = 1
+SERIAL_INPUT = 129
+
+
+def read_nev_header(filename):
+    """Read the basic header of a .nev file as a dict."""
+    header = np.fromfile(filename, dtype=_BASIC_HEADER, count=1)
+    if len(header) == 0 or header['file_type_id'][0] not in (b'NEURALEV', b'BREVENTS'):
+        raise ValueError("%s is not a Blackrock .nev file." % filename)
+    return {name: header[name][0] for name in _BASIC_HEADER.names}
+
+
+def packet_dtype(header):
+    """Structured dtype of the event fields of the data packets (the rest of
+    each packet is skipped)."""
+    ts_format, ts_size = ('<u8', 8) if header['ver_major'] >= 3 else ('<u4', 4)
+    return np.dtype({'names': ['timestamp', 'packet_id', 'reason', 'value'],
+                     'formats': [ts_format, '<u2', 'u1', '<u2'],
+                     'offsets': [0, ts_size, ts_size + 2, ts_size + 4],
+                     'itemsize': int(header['bytes_in_data_packets'])})
+
+
+def read_digital_events(filename, reason=DIGITAL_INPUT, block_packets=2**20):
+    """Read the times (in seconds) and the 16-bit values of the digital (or,
+    with reason=SERIAL_INPUT, serial) input events of a .nev file."""
+    header = read_nev_header(filename)
+    dtype = packet_dtype(header)
+    offset = int(header['bytes_in_headers'])
+    n_packets = (os.path.getsize(filename) - offset) // dtype.itemsize
+    times, values = [], []
+    if n_packets > 0:
+        packets = np.memmap(filename, dtype=dtype, mode='r', offset=offset, shape=(n_packets,))
+        for start in range(0, n_packets, block_packets):
+            block = packets[start:start + block_packets]
+            sel = np.flatnonzero((block['packet_id'] == 0) & (block['reason'] == reason))
+            times.append(np.asarray(block['timestamp'][sel], dtype=np.float64))
+            values.append(np.asarray(block['value'][sel], dtype=np.int64))
+        del packets
+    times = np.concatenate(times) if times else np.zeros(0)
+    values = np.concatenate(values) if values else np.zeros(0, dtype=np.int64)
+    return times / float(header['timestamp_resolution']), values
+
+
+def write_nev(filename, times, values, spike_times=(), spike_channels=(), timestamp_resolution=30000,
+              packet_bytes=104, spec=(2, 3), reason=DIGITAL_INPUT):
+    """Write a minimal .nev file with the given digital input events (and,
+    optionally, spike packets with empty waveforms); used for testing."""
+    header = np.zeros(1, dtype=_BASIC_HEADER)
+    header['file_type_id'] = b'BREVENTS' if spec[0] >= 3 else b'NEURALEV'
+    header['ver_major'], header['ver_minor'] = spec
+    header['bytes_in_headers'] = _BASIC_HEADER.itemsize
+    header['bytes_in_data_packets'] = packet_bytes
+    header['timestamp_resolution'] = header['sample_resolution'] = timestamp_resolution
+    header['creating_application'] = b'custom_neuropype'
+    dtype = packet_dtype({name: header[name][0] for name in _BASIC_HEADER.names})
+    ev_ts = np.round(np.asarray(times, dtype=float) * timestamp_resolution).astype(np.uint64)
+    sp_ts = np.round(np.asarray(spike_times, dtype=float) * timestamp_resolution).astype(np.uint64)
+    packets = np.zeros(len(ev_ts) + len(sp_ts), dtype=dtype)
+    packets['timestamp'] = np.concatenate((ev_ts, sp_ts))
+    packets['packet_id'] = np.concatenate((np.zeros(len(ev_ts)), np.asarray(spike_channels))).astype(np.uint16)
+    packets['reason'][:len(ev_ts)] = reason
+    packets['value'][:len(ev_ts)] = np.asarray(values, dtype=np.uint16)
+    packets = packets[np.argsort(packets['timestamp'], kind='stable')]
+    with open(filename, 'wb') as f:
+        f.write(header.tobytes())
+        f.write(packets.tobytes())
+    return filename
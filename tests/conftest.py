@@ -0,0 +1,32 @@
+"""Make this repository importable as custom_neuropype (its name when it is
+included as a submodule), whatever the name of its directory."""
+
+import os
+import sys
+import importlib.util
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# statements that import the package in a fresh interpreter
+IMPORT_PACKAGE = """
+import sys, importlib.util
+spec = importlib.util.spec_from_file_location(
+    'custom_neuropype', %r, submodule_search_locations=[%r])
+sys.modules['custom_neuropype'] = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(sys.modules['custom_neuropype'])
+import custom_neuropype
+""" % (os.path.join(ROOT, '__init__.py'), ROOT)
+
+if 'custom_neuropype' not in sys.modules:
+    exec(IMPORT_PACKAGE)
+
+
+@pytest.fixture
+def engine():
+    """neuropype.engine, or the benchmarks' stand-ins for it if neuropype is
+    not installed."""
+    from custom_neuropype.benchmarks import standins
+    standins.install()
+    return importlib.import_module('neuropype.engine')
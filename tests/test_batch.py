@@ -0,0 +1,68 @@
+import os
+
+import numpy as np
+import pytest
+
+
+def _load(spec):
+    """Loader run in the workers: logs the call, and exits the worker for
+    the 'crash' sessions (every time) and the 'crash_once' one (first time)."""
+    kind, log_file = spec
+    with open(log_file, 'a') as f:
+        f.write(kind + '\n')
+    with open(log_file) as f:
+        calls = f.read().split()
+    if kind == 'crash' or (kind == 'crash_once' and calls.count(kind) == 1):
+        os._exit(1)
+    from neuropype.engine import Packet
+    return Packet({})
+
+
+def _sessions(tmp_path, kinds):
+    from custom_neuropype.benchmarks import generators as gen
+    log_file = str(tmp_path / 'calls.log')
+    sessions = []
+    for k, kind in enumerate(kinds):
+        filename = gen.location_rule_mat(str(tmp_path / ('s%d.mat' % k)), 5 + k, seed=k)
+        sessions.append({'id': '%s%d' % (kind, k), 'input': (kind, log_file), 'filename': filename})
+    return sessions, log_file
+
+
+@pytest.fixture
+def budget():
+    from custom_neuropype import executors
+    executors.set_cpu_budget(2)
+    yield
+    executors.set_cpu_budget()
+
+
+def test_batch_concatenates_sessions(tmp_path, engine, budget):
+    from custom_neuropype.batch import run_batch
+    sessions, _ = _sessions(tmp_path, ['good'] * 3)
+    result = run_batch('FixEvents', sessions, config={'cloud_host': 'None', 'categorical_columns': True},
+                       loader=_load, max_workers=2, log=lambda msg: None)
+    assert not result.failures
+    table, cats = result.tables['markers'], result.categories['markers']
+    rows = [s['rows']['markers'] for s in result.sessions]
+    assert len(table['session']) == sum(rows)
+    assert list(np.unique(table['session'])) == ['good0', 'good1', 'good2']
+    # the codes of every session refer to the merged, sorted categories
+    assert list(cats['Marker']) == sorted(cats['Marker'])
+    assert table['Marker'].min() >= 0 and table['Marker'].max() < len(cats['Marker'])
+
+
+def test_batch_reruns_only_running_sessions(tmp_path, engine, budget):
+    from custom_neuropype.batch import run_batch
+    kinds = ['crash'] + ['good'] * 6 + ['crash_once']
+    sessions, log_file = _sessions(tmp_path, kinds)
+    messages = []
+    result = run_batch('FixEvents', sessions, config={'cloud_host': 'None'}, loader=_load,
+                       max_workers=2, log=messages.append)
+    assert [s['id'] for s in result.failures] == ['crash0']
+    assert 'worker process died' in result.failures[0]['error']
+    assert all(s['ok'] for s in result.sessions[1:])
+    with open(log_file) as f:
+        calls = f.read().split()
+    # the good sessions that were not running when a worker died ran once
+    assert calls.count('good') <= 6 + 2
+    assert calls.count('crash') == 3 and calls.count('crash_once') == 2
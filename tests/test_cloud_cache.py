@@ -0,0 +1,97 @@
+import os
+import time
+import threading
+
+
+def _cache(tmp_path, n_files, **kwargs):
+    from custom_neuropype.cloud_cache import DownloadCache, LocalDirStore
+    (tmp_path / 'bucket').mkdir()
+    for k in range(n_files):
+        (tmp_path / 'bucket' / ('f%d.bin' % k)).write_bytes(b'x' * 1000)
+    return DownloadCache(str(tmp_path / 'cache'), **kwargs), LocalDirStore(str(tmp_path / 'bucket'))
+
+
+def _age(filename, seconds):
+    t = time.time() - seconds
+    os.utime(filename, (t, t))
+
+
+def test_evict_keeps_recently_used_and_locked_files(tmp_path):
+    from custom_neuropype.cloud_cache import _FileLock
+    cache, store = _cache(tmp_path, 4, max_size=2500, min_age=60.0)
+    files = [cache.get(store, 'f%d.bin' % k) for k in range(3)]
+    # over the limit, but all files were just handed out
+    assert all(os.path.exists(f) for f in files)
+    _age(files[0], 1000)
+    _age(files[1], 999)
+    with _FileLock(files[0] + '.lock'):
+        # another process is getting f0 at the moment
+        new = cache.get(store, 'f3.bin')
+    assert os.path.exists(files[0]) and not os.path.exists(files[1])
+    assert os.path.exists(files[2]) and os.path.exists(new)
+    # the lock file of the evicted file is removed with it
+    assert not os.path.exists(files[1] + '.lock') and os.path.exists(files[2] + '.lock')
+    cache.evict()
+    assert not os.path.exists(files[0]) and cache.size() <= 2500
+
+
+def test_get_marks_cached_file_as_used(tmp_path):
+    cache, store = _cache(tmp_path, 2, max_size=1500, min_age=60.0)
+    first = cache.get(store, 'f0.bin')
+    _age(first, 1000)
+    assert cache.get(store, 'f0.bin') == first
+    cache.get(store, 'f1.bin')
+    # f0 was used again just now, so it is not evicted
+    assert os.path.exists(first)
+
+
+def test_waiting_lock_follows_removed_lock_file(tmp_path):
+    from custom_neuropype.cloud_cache import _FileLock, _remove_lock
+    name = str(tmp_path / 'f.lock')
+    entered = threading.Event()
+    result = {}
+
+    def wait_for_lock():
+        entered.set()
+        with _FileLock(name) as lock:
+            result['current'] = os.path.samestat(os.fstat(lock.fd), os.stat(name))
+
+    with _FileLock(name):
+        waiter = threading.Thread(target=wait_for_lock)
+        waiter.start()
+        entered.wait()
+        time.sleep(0.1)
+        _remove_lock(name)
+    waiter.join(5)
+    assert result == {'current': True}
+
+
+def test_invalidate_downloads_again(tmp_path):
+    cache, store = _cache(tmp_path, 1)
+    first = cache.get(store, 'f0.bin')
+    assert cache.invalidate(store, 'f0.bin')
+    assert not os.path.exists(first) and not cache.invalidate(store, 'f0.bin')
+    assert cache.get(store, 'f0.bin') == first and os.path.exists(first)
+
+
+def test_neuropype_store_version_and_fetch(tmp_path, engine, monkeypatch):
+    from neuropype.utilities.cloud import storage
+    from custom_neuropype import cloud_cache
+    assert cloud_cache.NeuropypeStore().version('a.mat') is None
+    store = cloud_cache.NeuropypeStore(max_age=60)
+    monkeypatch.setattr(cloud_cache.time, 'time', lambda: 1000.0)
+    version = store.version('a.mat')
+    monkeypatch.setattr(cloud_cache.time, 'time', lambda: 1019.0)
+    assert store.version('a.mat') == version
+    monkeypatch.setattr(cloud_cache.time, 'time', lambda: 1021.0)
+    assert store.version('a.mat') != version
+
+    download = tmp_path / 'download.mat'
+
+    def cloud_get(filename, **kwargs):
+        download.write_bytes(b'data')
+        return str(download)
+    monkeypatch.setattr(storage, 'cloud_get', cloud_get)
+    store.fetch('a.mat', str(tmp_path / 'cached.mat'))
+    # the download is moved into the cache, not copied
+    assert not download.exists() and (tmp_path / 'cached.mat').read_bytes() == b'data'
@@ -0,0 +1,48 @@
+import numpy as np
+
+
+def test_encode_column_sorts_categories():
+    from custom_neuropype.columnar import encode_column, decode_column
+    values = np.array(['Go', 'Cue', None, 'Go', np.nan, 'Target'], dtype=object)
+    codes, cats = encode_column(values)
+    assert list(cats) == ['Cue', 'Go', 'Target'] and codes.dtype == np.int8
+    assert list(codes) == [1, 0, -1, 1, -1, 2]
+    assert list(decode_column(codes, cats)) == ['Go', 'Cue', None, 'Go', None, 'Target']
+
+
+def test_encode_column_mixed_types_are_sorted_as_strings():
+    from custom_neuropype.columnar import encode_column, decode_column
+    for values in (np.array(['x', 3, None, 2.5, 10], dtype=object), np.array([10, 2, 3]),
+                   np.array([b'b', b'a'])):
+        codes, cats = encode_column(values)
+        assert list(cats) == sorted(cats)
+        decoded = decode_column(codes, cats)
+        assert list(decoded) == [None if v is None else (v.decode() if isinstance(v, bytes) else str(v))
+                                 for v in values]
+
+
+def test_records_round_trip():
+    from custom_neuropype.columnar import encode_records, decode_records
+    data = np.rec.fromarrays([np.array(['b', 'a', 'b'], dtype=object), np.arange(3.0)],
+                             names=['Marker', 'Value'])
+    codes, cats = encode_records(data)
+    assert set(cats) == {'Marker'} and codes['Value'].dtype == np.float64
+    decoded = decode_records(codes, cats)
+    assert list(decoded['Marker']) == ['b', 'a', 'b']
+    np.testing.assert_array_equal(decoded['Value'], data['Value'])
+
+
+def test_table_file_round_trip(tmp_path):
+    from custom_neuropype.columnar import write_table, read_table, decode_column
+    columns = {'time': np.linspace(0, 1, 1000), 'Marker': np.array(['Go', 'Cue'] * 500, dtype=object),
+               'trial': np.arange(1000) // 10}
+    filename = str(tmp_path / 'markers.tbl')
+    write_table(filename, columns, metadata={'session': 's1'})
+    for mmap in (True, False):
+        cols, cats, meta = read_table(filename, mmap=mmap)
+        assert meta == {'session': 's1'} and list(cats['Marker']) == ['Cue', 'Go']
+        np.testing.assert_array_equal(cols['time'], columns['time'])
+        np.testing.assert_array_equal(cols['trial'], columns['trial'])
+        assert list(decode_column(cols['Marker'], cats['Marker'])) == list(columns['Marker'])
+    write_table(filename, {'time': np.zeros(0)})
+    assert len(read_table(filename)[0]['time']) == 0
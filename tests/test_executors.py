@@ -0,0 +1,96 @@
+import threading
+import time
+
+import pytest
+
+
+def _peak_concurrency(pool, n_tasks=12):
+    active, peak, lock = [0], [0], threading.Lock()
+
+    def task(_):
+        with lock:
+            active[0] += 1
+            peak[0] = max(peak[0], active[0])
+        time.sleep(0.02)
+        with lock:
+            active[0] -= 1
+    list(pool.map(task, range(n_tasks)))
+    return peak[0]
+
+
+def test_thread_pools_are_resized_per_name():
+    from custom_neuropype import executors
+    executors.set_cpu_budget(4)
+    try:
+        pool = executors.thread_pool('test_resize', 4)
+        assert _peak_concurrency(pool) == 4
+        # a smaller size limits the same pool
+        assert executors.thread_pool('test_resize', 2) is pool
+        assert _peak_concurrency(pool) == 2
+        # as does a smaller budget
+        executors.set_cpu_budget(3)
+        assert executors.thread_pool('test_resize') is pool and pool.workers == 3
+        names = [p['name'] for p in executors.utilization()['pools']]
+        assert names.count('test_resize') == 1
+    finally:
+        executors.set_cpu_budget()
+
+
+def test_blas_threads_leaves_cpus_for_thread_pools():
+    from custom_neuropype import executors
+    executors.set_cpu_budget(4)
+    try:
+        with executors.blas_threads() as n:
+            assert n == 2 and executors.utilization()['in_use'] == 2
+            # thread pool tasks still get the other CPUs
+            assert _peak_concurrency(executors.thread_pool('test_blas', 4)) == 2
+        assert executors.utilization()['in_use'] == 0
+    finally:
+        executors.set_cpu_budget()
+
+
+def test_reserve_waits_for_a_free_cpu():
+    from custom_neuropype import executors
+    budget = executors.CpuBudget(2)
+    assert budget.reserve(5) == 2
+    granted = []
+    waiter = threading.Thread(target=lambda: granted.append(budget.reserve(3)))
+    waiter.start()
+    time.sleep(0.05)
+    # the budget is used up, so the reservation waits
+    assert granted == [] and budget.in_use == 2
+    budget.release(1)
+    waiter.join(5)
+    assert granted == [1] and budget.in_use == 2
+
+
+def test_nested_reservations_do_not_wait():
+    from custom_neuropype import executors
+    executors.set_cpu_budget(1)
+    try:
+        # a task of a CPU-bound pool holds the only CPU; its BLAS runs on it
+        pool = executors.thread_pool('test_nested', 1)
+
+        def task():
+            with executors.blas_threads(4) as n:
+                return n, executors.utilization()['in_use']
+        assert pool.submit(task).result(timeout=5) == (1, 1)
+        assert executors.utilization()['in_use'] == 0
+    finally:
+        executors.set_cpu_budget()
+
+
+def test_replaced_thread_pool_is_shut_down():
+    from custom_neuropype import executors
+    executors.set_cpu_budget(4)
+    try:
+        small = executors.thread_pool('test_replace', 1)
+        future = small.submit(time.sleep, 0.05)
+        large = executors.thread_pool('test_replace', 3)
+        assert large is not small and large.capacity == 3
+        # the old pool finishes its tasks but takes no new ones
+        assert future.result(timeout=5) is None
+        with pytest.raises(RuntimeError):
+            small.submit(time.sleep, 0)
+    finally:
+        executors.set_cpu_budget()
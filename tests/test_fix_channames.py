@@ -0,0 +1,37 @@
+import numpy as np
+
+
+def _packet(engine, names):
+    from custom_neuropype.benchmarks import generators as gen
+    return gen.signal_packet(np.zeros((len(names), 10)), names)
+
+
+def _space(engine, pkt):
+    blk = pkt.chunks['analogsignals'].block
+    return blk.axes[blk.axes.index(engine.space)]
+
+
+def test_each_chunk_gets_its_own_axis(engine):
+    from custom_neuropype import FixChannames
+    names = ['elec1', 'elec2', 'ref']
+    node = FixChannames()
+    node.data = _packet(engine, names)
+    first = _space(engine, node.data)
+    assert list(first.names) == ['ch1', 'ch2', 'ref']
+    # changing the axis of one packet does not affect those of later packets
+    first.names[2] = 'changed'
+    node.data = _packet(engine, names)
+    second = _space(engine, node.data)
+    assert second is not first and list(second.names) == ['ch1', 'ch2', 'ref']
+
+
+def test_unchanged_names_keep_axis(engine):
+    from custom_neuropype import FixChannames
+    pkt = _packet(engine, ['Fz', 'Cz'])
+    axis = _space(engine, pkt)
+    node = FixChannames(rule='mapping', mapping={'Pz': 'P0'})
+    node.data = pkt
+    assert _space(engine, node.data) is axis
+    node.mapping = {'Cz': 'C0'}
+    node.data = _packet(engine, ['Fz', 'Cz'])
+    assert list(_space(engine, node.data).names) == ['Fz', 'C0']
@@ -0,0 +1,78 @@
+import numpy as np
+
+
+def test_estimate_clock_offset_recovers_offset(engine):
+    from custom_neuropype.FixEvents import estimate_clock_offset
+    rng = np.random.RandomState(0)
+    ref = np.sort(rng.uniform(0, 30000, 10000))
+    kept = rng.rand(len(ref)) < 0.6
+    times = np.concatenate((ref[kept] - 7.5 + rng.normal(0, 0.005, kept.sum()),
+                            rng.uniform(0, 30000, 1000)))
+    offset, n_pairs = estimate_clock_offset(ref, times, max_offset=10.0, tolerance=0.05)
+    assert abs(offset - 7.5) < 0.002
+    assert n_pairs >= 0.95 * kept.sum()
+    # with few pairs allowed, the coarse offset comes from a subset of the events
+    offset, _ = estimate_clock_offset(ref, times, max_offset=10.0, tolerance=0.05, max_pairs=10000)
+    assert abs(offset - 7.5) < 0.002
+
+
+def test_estimate_clock_offset_without_matches(engine):
+    from custom_neuropype.FixEvents import estimate_clock_offset
+    assert estimate_clock_offset([], [1.0], 10.0, 0.05) == (0.0, 0)
+    assert estimate_clock_offset([1.0], [50.0], 10.0, 0.05) == (0.0, 0)
+
+
+def _events_file(tmp_path, n_trials=8):
+    from custom_neuropype.benchmarks import generators as gen
+    return gen.location_rule_mat(str(tmp_path / 'behavior.mat'), n_trials)
+
+
+def _markers(engine, node):
+    chunk = node.data.chunks['markers']
+    return chunk.block.axes[engine.instance], chunk.props
+
+
+def test_replace_categorical_matches_strings(tmp_path, engine):
+    from custom_neuropype import FixEvents
+    from custom_neuropype.columnar import decode_column, CATEGORIES_PROP
+    from custom_neuropype.benchmarks import generators as gen
+    filename = _events_file(tmp_path)
+    plain, encoded = FixEvents(filename=filename, cloud_host='None'), \
+        FixEvents(filename=filename, cloud_host='None', categorical_columns=True)
+    plain.data = gen.marker_packet(np.zeros(0), np.zeros(0, dtype=object))
+    encoded.data = gen.marker_packet(np.zeros(0), np.zeros(0, dtype=object))
+    strings = _markers(engine, plain)[0].data
+    axis, props = _markers(engine, encoded)
+    cats = props[CATEGORIES_PROP]['Marker']
+    assert list(cats) == sorted(cats)
+    assert list(decode_column(axis.data['Marker'], cats)) == list(strings)
+
+
+def test_merge_into_records_without_marker_field(tmp_path, engine):
+    from custom_neuropype import FixEvents
+    from custom_neuropype.columnar import decode_column, CATEGORIES_PROP
+    filename = _events_file(tmp_path)
+    old_times = np.array([0.5, 1.5, 2.5])
+
+    def packet():
+        data = np.rec.fromarrays([np.array([1.0, 2.0, 3.0])], names=['Value'])
+        blk = engine.Block(data=np.full(3, np.nan),
+                           axes=(engine.InstanceAxis(old_times, data=data, instance_type='markers'),))
+        return engine.Packet({'markers': engine.Chunk(block=blk, props={})})
+
+    node = FixEvents(filename=filename, cloud_host='None', mode='merge')
+    node.data = packet()
+    axis, _ = _markers(engine, node)
+    is_old = np.isin(axis.times, old_times)
+    assert is_old.sum() == 3 and np.all(axis.data['Value'][is_old] == [1.0, 2.0, 3.0])
+    # the existing instances have no marker; all markers are strings
+    assert all(isinstance(m, str) for m in axis.data['Marker'])
+    assert np.all(axis.data['Marker'][is_old] == '') and np.all(axis.data['Marker'][~is_old] != '')
+
+    node = FixEvents(filename=filename, cloud_host='None', mode='merge', categorical_columns=True)
+    node.data = packet()
+    axis, props = _markers(engine, node)
+    codes, cats = axis.data['Marker'], props[CATEGORIES_PROP]['Marker']
+    assert np.all(codes[is_old] == -1) and np.all(codes[~is_old] >= 0)
+    assert '' not in cats and list(cats) == sorted(cats)
+    assert all(isinstance(m, str) for m in decode_column(codes[~is_old], cats))
@@ -0,0 +1,46 @@
+import json
+import subprocess
+import sys
+
+from conftest import IMPORT_PACKAGE
+
+HEAVY_MODULES = ['pandas', 'sklearn', 'scipy.ndimage', 'cv2', 'nslr']
+
+
+def _run(code):
+    """Run code after importing the package in a fresh interpreter; returns
+    what it prints, decoded from JSON."""
+    out = subprocess.run([sys.executable, '-c', IMPORT_PACKAGE + code],
+                         capture_output=True, text=True, check=True)
+    return json.loads(out.stdout)
+
+
+def test_import_loads_no_nodes_or_heavy_dependencies():
+    loaded = _run("""
+import json
+print(json.dumps([m for m in %r if m in sys.modules]))
+""" % (['neuropype.engine'] + HEAVY_MODULES))
+    assert loaded == []
+
+
+def test_registry_names_resolve_to_node_classes():
+    resolved = _run("""
+import json
+from custom_neuropype.benchmarks import standins
+standins.install()
+out = {}
+for name, module in custom_neuropype._node_modules.items():
+    node = getattr(custom_neuropype, name)
+    out[name] = [isinstance(node, type), node.__name__, node.__module__,
+                 getattr(custom_neuropype, name) is node]
+out['heavy'] = [m for m in %r if m in sys.modules]
+print(json.dumps(out))
+""" % HEAVY_MODULES)
+    heavy = resolved.pop('heavy')
+    from custom_neuropype import _node_modules
+    assert set(resolved) == set(_node_modules)
+    for name, (is_class, cls_name, module, cached) in resolved.items():
+        assert is_class and cls_name == name and cached
+        assert module == 'custom_neuropype.' + _node_modules[name]
+    # accessing the nodes must not import their optional dependencies either
+    assert heavy == []
@@ -0,0 +1,121 @@
+import os
+import importlib
+
+import numpy as np
+
+
+ODML = """<?xml version="1.0" encoding="UTF-8"?>
+<odML version="1">
+  <section><name>Recording</name>
+    <section><name>TaskSettings</name>
+      <property><name>TaskCondition</name><value>%d<type>int</type></value></property>
+      <property><name>TrialIDs</name><value>[1, 2, 3]<type>int</type></value></property>
+    </section>
+  </section>
+  <section><name>UtahArray</name>
+    <section><name>Array</name>
+      <section><name>Electrode_001</name>
+        <property><name>ID</name><value>7<type>int</type></value></property>
+      </section>
+      <section><name>Electrode_002</name>
+        <property><name>ID</name><value>8<type>int</type></value></property>
+      </section>
+    </section>
+  </section>
+</odML>
+"""
+
+FIELDS = {'TaskCondition': ('Recording/TaskSettings', 'TaskCondition'),
+          'TrialIDs': ('Recording/TaskSettings', 'TrialIDs'),
+          'ElectrodeIDs': ('UtahArray/Array/*', 'ID')}
+
+
+def _odml(path, condition):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        f.write(ODML % condition)
+    return path
+
+
+def _count_parses(monkeypatch):
+    irg = importlib.import_module('custom_neuropype.ImportReachGrasp')
+    calls = []
+    parse = irg._parse_odml
+    monkeypatch.setattr(irg, '_parse_odml', lambda filename, fields: calls.append(filename) or parse(filename, fields))
+    return calls
+
+
+def test_odml_index_reuse_and_invalidation(tmp_path, engine, monkeypatch):
+    from custom_neuropype.ImportReachGrasp import load_odml_index
+    calls = _count_parses(monkeypatch)
+    filename = _odml(str(tmp_path / 'session.odml'), 1)
+    meta = load_odml_index(filename, FIELDS)
+    assert meta == {'TaskCondition': 1, 'TrialIDs': [1, 2, 3], 'ElectrodeIDs': [7, 8]}
+    assert os.path.exists(filename + '.index.json')
+    assert load_odml_index(filename, FIELDS) == meta and len(calls) == 1
+    # a subset of the fields is served from the index, a new one is parsed
+    assert load_odml_index(filename, {'TaskCondition': FIELDS['TaskCondition']}) == {'TaskCondition': 1}
+    assert len(calls) == 1
+    # modifying the file discards the index
+    _odml(filename, 23)
+    assert load_odml_index(filename, FIELDS)['TaskCondition'] == 23 and len(calls) == 2
+
+
+def test_odml_index_dir_keeps_sessions_apart(tmp_path, engine, monkeypatch):
+    from custom_neuropype.ImportReachGrasp import load_odml_index
+    calls = _count_parses(monkeypatch)
+    index_dir = str(tmp_path / 'cache')
+    first = _odml(str(tmp_path / 'a' / 'session.odml'), 1)
+    second = _odml(str(tmp_path / 'b' / 'session.odml'), 2)
+    # same file name, size and (possibly) modification time
+    os.utime(second, ns=(os.stat(first).st_atime_ns, os.stat(first).st_mtime_ns))
+    assert load_odml_index(first, FIELDS, index_dir=index_dir)['TaskCondition'] == 1
+    assert load_odml_index(second, FIELDS, index_dir=index_dir)['TaskCondition'] == 2
+    assert load_odml_index(first, FIELDS, index_dir=index_dir)['TaskCondition'] == 1
+    assert len(calls) == 2 and len(os.listdir(index_dir)) == 2
+
+
+TS_ON, STOP, WS, SG, HF, SR_SG, RW_SG = 65296, 65312, 65360, 65370, 65366, 65386, 65514
+TRIAL_EVENTS = [
+    STOP,                                           # before the first trial: ignored
+    TS_ON, WS, SG, WS, HF, SR_SG, RW_SG, STOP,      # correct SG-HF trial
+    TS_ON, WS, SG, SR_SG, STOP, STOP,               # released before CUE-OFF; the last STOP ends it
+    TS_ON, WS,                                      # never stopped
+]
+
+
+def test_reconstruct_trials(engine):
+    from custom_neuropype import ImportReachGrasp
+    times = np.arange(len(TRIAL_EVENTS), dtype=float)
+    tr_times, tr = ImportReachGrasp.reconstruct_trials(times, np.array(TRIAL_EVENTS))
+    np.testing.assert_array_equal(tr_times, [1.0, 9.0, 15.0])
+    np.testing.assert_array_equal(tr['TrialID'], [0, 1, 2])
+    # the performance code is the bitmask of the trial events that occurred
+    assert list(tr['PerformanceCode']) == [255, 0b10100111, 0]
+    assert list(tr['Performance']) == ['correct_trial', 'error<CUE-OFF', 'incomplete_trial']
+    np.testing.assert_array_equal(tr['CueOnTime'][:2], [3.0, 11.0])
+    np.testing.assert_array_equal(tr['StopTime'][:2], [8.0, 14.0])
+    assert np.isnan(tr['StopTime'][2]) and np.isnan(tr['CueOffTime'][1])
+    assert list(tr['TrialType']) == ['SGHF', 'SG', '']
+    assert list(tr['GripType'][:2]) == ['SG', 'SG'] and tr['ForceType'][0] == 'HF'
+
+
+def test_map_event_codes(engine):
+    from custom_neuropype import ImportReachGrasp
+    labels = ImportReachGrasp.map_event_codes([TS_ON, SG, 12, -1, 2**20, STOP])
+    assert list(labels) == ['TS-ON', 'SG-ON', 'UNKNOWN', 'UNKNOWN', 'UNKNOWN', 'STOP']
+    # the lookup table agrees with the label dictionary for every known code
+    codes = np.array([int(c) for c in ImportReachGrasp.event_labels_str])
+    assert list(ImportReachGrasp.map_event_codes(codes)) == list(ImportReachGrasp.event_labels_str.values())
+
+
+def test_trial_table_is_optional(engine):
+    from custom_neuropype import ImportReachGrasp
+    from custom_neuropype.benchmarks import generators as gen
+    times = np.arange(len(TRIAL_EVENTS), dtype=float)
+    node = ImportReachGrasp()
+    node.data = gen.event_packet(times, np.array(TRIAL_EVENTS))
+    assert 'markers' in node.data.chunks and 'trials' not in node.data.chunks
+    node = ImportReachGrasp(trial_table=True)
+    node.data = gen.event_packet(times, np.array(TRIAL_EVENTS))
+    assert len(node.data.chunks['trials'].block.axes[engine.instance].data) == 3
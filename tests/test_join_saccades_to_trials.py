@@ -0,0 +1,55 @@
+import numpy as np
+
+
+def _markers(engine, n_trials=6):
+    """Markers of two concatenated Unity sessions (whose trial indices both
+    start at 0), as produced by GetUnityTaskEvents."""
+    import custom_neuropype as cn
+    from custom_neuropype.benchmarks import generators as gen
+    t1, s1 = gen.unity_marker_strings(n_trials, seed=1)
+    t2, s2 = gen.unity_marker_strings(n_trials, seed=2)
+    times = np.concatenate((t1, np.asarray(t2) + t1[-1] + 10.0))
+    node = cn.GetUnityTaskEvents()
+    node.data = gen.marker_packet(times, list(s1) + list(s2))
+    return node.data.chunks['markers'], t1[-1] + 5.0
+
+
+def _saccades(engine, go_times, latencies):
+    from custom_neuropype.benchmarks import generators as gen
+    n = len(go_times)
+    data = np.rec.fromarrays([go_times + latencies + 0.03, np.full(n, 'Saccade', dtype=object),
+                              np.full(n, 0.03), np.full(n, 5.0), np.zeros(n), np.full(n, 5.0),
+                              np.zeros(n), np.zeros(n)],
+                             names=['EndTime', 'Marker', 'Duration', 'Amp', 'StartX', 'PosX', 'StartY', 'PosY'])
+    return gen.segment_chunk(go_times + latencies, data)
+
+
+def test_join_with_concatenated_sessions(engine):
+    import custom_neuropype as cn
+    markers, split = _markers(engine)
+    ax = markers.block.axes[engine.instance]
+    times, data = np.asarray(ax.times), ax.data
+    is_go = np.asarray(data['Marker']) == 'Go'
+    go_times = times[is_go]
+    latencies = 0.1 + 0.01 * np.arange(len(go_times))
+    # the trial indices repeat in the second session
+    trials = np.asarray(data['UnityTrialIndex'])
+    assert set(trials[times < split]) == set(trials[times > split])
+
+    node = cn.JoinSaccadesToTrials(update_reaction_time=False)
+    node.data = engine.Packet({'markers': markers, 'gaze': _saccades(engine, go_times, latencies)})
+    out = node.data.chunks['markers'].block.axes[engine.instance].data
+
+    session = (times > split).astype(int)
+    go_latency = dict(zip(zip(session[is_go], trials[is_go]), latencies))
+    expected = [go_latency.get(key, np.nan) for key in zip(session, trials)]
+    np.testing.assert_allclose(out['SaccadeLatency'], expected)
+    np.testing.assert_allclose(out['SaccadeAmplitude'][is_go], 5.0)
+
+
+def test_trial_keys_follow_time_order():
+    from custom_neuropype.JoinSaccadesToTrials import JoinSaccadesToTrials
+    times = np.array([0.0, 1.0, 2.0, 3.0, 4.0, 5.0, 0.5])
+    index = np.array([0, 0, 1, 0, 0, 1, 0])
+    keys = JoinSaccadesToTrials._trial_keys(times, index)
+    np.testing.assert_array_equal(keys, [0, 0, 1, 2, 2, 3, 0])
@@ -0,0 +1,57 @@
+import numpy as np
+import pytest
+
+
+def _events(n=50, seed=0):
+    rng = np.random.RandomState(seed)
+    times = np.sort(rng.uniform(0, 10, n)).round(4)
+    return times, rng.randint(0, 2**16, n)
+
+
+@pytest.mark.parametrize('spec', [(2, 3), (3, 0)])
+def test_round_trip(tmp_path, spec):
+    from custom_neuropype import nev
+    times, values = _events()
+    rng = np.random.RandomState(1)
+    spike_times = rng.uniform(0, 10, 2000)
+    filename = nev.write_nev(str(tmp_path / 'session.nev'), times, values, spike_times,
+                             rng.randint(1, 97, len(spike_times)), spec=spec)
+    assert nev.read_nev_header(filename)['ver_major'] == spec[0]
+    # small blocks, so that the events are selected across block boundaries
+    ev_times, ev_values = nev.read_digital_events(filename, block_packets=97)
+    np.testing.assert_allclose(ev_times, times, atol=1e-4)
+    np.testing.assert_array_equal(ev_values, values)
+    assert len(nev.read_digital_events(filename, reason=nev.SERIAL_INPUT)[0]) == 0
+
+
+def test_serial_events_and_empty_file(tmp_path):
+    from custom_neuropype import nev
+    times, values = _events(5)
+    filename = nev.write_nev(str(tmp_path / 'serial.nev'), times, values, reason=nev.SERIAL_INPUT)
+    assert len(nev.read_digital_events(filename)[0]) == 0
+    np.testing.assert_array_equal(nev.read_digital_events(filename, reason=nev.SERIAL_INPUT)[1], values)
+    empty = nev.write_nev(str(tmp_path / 'empty.nev'), [], [])
+    ev_times, ev_values = nev.read_digital_events(empty)
+    assert len(ev_times) == 0 and len(ev_values) == 0
+
+
+def test_not_a_nev_file(tmp_path):
+    from custom_neuropype import nev
+    (tmp_path / 'other.nev').write_bytes(b'NEURALEX' + bytes(400))
+    with pytest.raises(ValueError):
+        nev.read_digital_events(str(tmp_path / 'other.nev'))
+
+
+def test_import_reach_grasp_reads_nev(tmp_path, engine):
+    from custom_neuropype import ImportReachGrasp
+    from custom_neuropype.benchmarks import generators as gen
+    times, codes = gen.blackrock_digital_events(20)
+    filename = gen.blackrock_nev(str(tmp_path / 'session.nev'), 20, spikes_per_event=10)
+    from_file = ImportReachGrasp(nev_filename=filename, cloud_host='None')
+    from_file.data = engine.Packet({})
+    from_chunk = ImportReachGrasp()
+    from_chunk.data = gen.event_packet(times, codes)
+    ax_file = from_file.data.chunks['markers'].block.axes[engine.instance]
+    ax_chunk = from_chunk.data.chunks['markers'].block.axes[engine.instance]
+    np.testing.assert_allclose(ax_file.times, ax_chunk.times, atol=1e-4)
+    assert list(ax_file.data) == list(ax_chunk.data)
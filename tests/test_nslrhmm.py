@@ -0,0 +1,34 @@
+import numpy as np
+
+
+def _recording(noise, seconds=60.0, srate=200.0, start=0.0, seed=0):
+    rng = np.random.RandomState(seed)
+    ts = start + np.arange(int(seconds * srate)) / srate
+    xs = np.stack([np.sin(ts), np.cos(ts)], axis=1) + rng.normal(0, noise, (len(ts), 2))
+    return ts, xs
+
+
+def test_auto_noise_is_estimated_per_recording(engine):
+    import custom_neuropype as cn
+    node = cn.NSLRHMM(noise_mode='auto')
+    first = node._recording_noise('gaze', ['x', 'y'], *_recording(0.1))
+    # another session through the same node, with its clock starting over
+    second = node._recording_noise('gaze', ['x', 'y'], *_recording(0.5, seed=1))
+    np.testing.assert_allclose(first, 0.1, rtol=0.1)
+    np.testing.assert_allclose(second, 0.5, rtol=0.1)
+
+
+def test_auto_noise_accumulates_windows_over_packets(engine):
+    import custom_neuropype as cn
+    node = cn.NSLRHMM(noise_mode='auto', noise_windows=5, noise_window_length=1.0)
+    ts, xs = _recording(0.2, seconds=30.0)
+    estimates = [node._recording_noise('gaze', ['x', 'y'], ts[k:k + 50], xs[k:k + 50] * (1 + (k >= 2000)))
+                 for k in range(0, len(ts), 50)]
+    state = node._noise['gaze', ('x', 'y')]
+    assert len(state['windows']) == 5
+    # the estimate is frozen once it has noise_windows windows (from the first 5 s)
+    np.testing.assert_allclose(estimates[-1], 0.2, rtol=0.15)
+    assert estimates[-1] == estimates[20]
+    # a gap in the time stamps starts a new recording
+    node._recording_noise('gaze', ['x', 'y'], ts[:50] + 100.0, xs[:50])
+    assert len(node._noise['gaze', ('x', 'y')]['windows']) == 0
@@ -0,0 +1,53 @@
+import numpy as np
+import pytest
+
+
+def _packet(engine, n_samples=(5000, 3000)):
+    """A packet with one gaze chunk per entry of n_samples."""
+    from custom_neuropype.benchmarks import generators as gen
+    chunks = {}
+    for k, n in enumerate(n_samples):
+        _, chans = gen.pupil_gaze(n, seed=k)
+        chans['gaze_point_3d_z'][::97] *= -1    # some gaze behind the camera
+        names = list(chans)
+        chunks['gaze%d' % k] = gen.signal_packet(np.stack([chans[c] for c in names]), names,
+                                                 srate=200.0).chunks['analogsignals']
+    return engine.Packet(chunks)
+
+
+def _angles(engine, pkt):
+    out = []
+    for name in sorted(pkt.chunks):
+        blk = pkt.chunks[name].block
+        names = list(blk.axes[blk.axes.index(engine.space)].names)
+        out.append(np.asarray(blk.data)[[names.index('gaze_ang_deg_x'), names.index('gaze_ang_deg_y')]])
+    return out
+
+
+@pytest.mark.parametrize('use_3d_gaze', [True, False])
+def test_threaded_blocks_match_single_thread(engine, use_3d_gaze):
+    from custom_neuropype import PupilToAngle, executors
+    if not use_3d_gaze:
+        pytest.importorskip('cv2')
+    executors.set_cpu_budget(4)
+    try:
+        single = PupilToAngle(use_3d_gaze=use_3d_gaze, num_threads=1)
+        single.data = _packet(engine)
+        threaded = PupilToAngle(use_3d_gaze=use_3d_gaze, num_threads=4, block_size=512)
+        threaded.data = _packet(engine)
+    finally:
+        executors.set_cpu_budget()
+    for a, b in zip(_angles(engine, single.data), _angles(engine, threaded.data)):
+        assert a.shape[1] in (5000, 3000) and np.all(np.isfinite(a))
+        np.testing.assert_array_equal(a, b)
+
+
+def test_gaze_straight_ahead(engine):
+    from custom_neuropype import PupilToAngle
+    from custom_neuropype.benchmarks import generators as gen
+    # straight ahead, and straight ahead but reported behind the camera
+    data = np.array([[0.0, 0.0], [0.0, 0.0], [500.0, -500.0]])
+    node = PupilToAngle(use_3d_gaze=True)
+    node.data = engine.Packet({'gaze': gen.signal_packet(data, ['gaze_point_3d_' + c for c in 'xyz'],
+                                                         srate=200.0).chunks['analogsignals']})
+    np.testing.assert_allclose(_angles(engine, node.data)[0], 90.0)
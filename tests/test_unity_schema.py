@@ -0,0 +1,43 @@
+import numpy as np
+
+
+def _session(n_trials, seed, offset=0.0):
+    from custom_neuropype.benchmarks import generators as gen
+    times, strings = gen.unity_marker_strings(n_trials, seed=seed)
+    return np.asarray(times) + offset, list(strings)
+
+
+def test_trial_markers(engine):
+    from custom_neuropype import unity_schema
+    schema = unity_schema.compile_schema()
+    assert unity_schema.compile_schema() is schema
+    times, strings = _session(3, seed=1)
+    cols = schema.decode(strings)
+    out_times, rec = schema.build(times, cols, schema.trial_index(cols))
+    assert np.all(np.diff(out_times) >= 0)
+    for trial in range(3):
+        markers = list(rec['Marker'][rec['UnityTrialIndex'] == trial])
+        assert markers[:6] == ['Intertrial', 'Fixate', 'Cue', 'Delay', 'Target', 'Go']
+        assert markers[-2:] == ['Response', 'Feedback']
+
+
+def test_concatenated_files(engine):
+    """The trial index restarts in each file; the trials must stay apart."""
+    from custom_neuropype import unity_schema
+    schema = unity_schema.compile_schema()
+    sessions = [_session(4, seed=1), _session(4, seed=2, offset=100.0), _session(4, seed=3, offset=200.0)]
+    times = np.concatenate([t for t, _ in sessions])
+    cols = schema.decode([s for _, strings in sessions for s in strings])
+    ev_tr = schema.trial_index(cols)
+    assert np.all(np.diff(ev_tr) >= 0)
+    assert len(np.unique(ev_tr)) == 12
+    # each trial lies within one file and starts with its first ObjectInfo event
+    file_of = np.searchsorted([100.0, 200.0], times)
+    for tr in np.unique(ev_tr):
+        assert len(np.unique(file_of[ev_tr == tr])) == 1
+    starts = np.flatnonzero(np.diff(file_of)) + 1
+    assert np.all(ev_tr[starts] == ev_tr[starts + 1])
+
+    out_times, rec = schema.build(times, cols, ev_tr)
+    assert np.sum(rec['Marker'] == 'Go') == 12
+    assert np.sum(rec['Marker'] == 'Feedback') == 12
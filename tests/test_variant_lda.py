@@ -0,0 +1,34 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('sklearn')
+
+
+@pytest.mark.parametrize('solver', ['eigen', 'lsqr', 'svd'])
+@pytest.mark.parametrize('class_weights', [None, {0: 0.2, 1: 0.5, 2: 0.3}])
+def test_activation_patterns_are_data_covariance_times_weights(engine, solver, class_weights):
+    import custom_neuropype as cn
+    from custom_neuropype.benchmarks import generators as gen
+    X, y = gen.epoched_tensor(150, 6, 5, n_classes=3)
+    node = cn.VariantLDA(solver=solver, class_weights=class_weights, smoothing_window=1)
+    node.data = gen.epoch_packet(X.copy(), y)
+    model = next(iter(node.M.values()))
+    expected = np.stack([np.cov(X[:, t].T, bias=True) @ m.coef_.T
+                         for t, m in enumerate(model['models'])], axis=1).transpose(2, 1, 0)
+    assert model['activation_patterns'].shape == (3, 6, 5)
+    np.testing.assert_allclose(model['activation_patterns'], expected, rtol=1e-8, atol=1e-10)
+    np.testing.assert_allclose(model['patterns'], expected, rtol=1e-8, atol=1e-10)
+
+
+def test_model_cache_key_covers_axis_values(engine, tmp_path):
+    import custom_neuropype as cn
+    from custom_neuropype.benchmarks import generators as gen
+    X, y = gen.epoched_tensor(60, 4, 3)
+    node = cn.VariantLDA(cache_dir=str(tmp_path))
+    pkt = gen.epoch_packet(X, y)
+    chunk = pkt.chunks['eeg']
+    key = node._cache_file(chunk, y)
+    assert node._cache_file(gen.epoch_packet(X, y).chunks['eeg'], y) == key
+    # same data, other time points
+    chunk.block.axes[1].times = chunk.block.axes[1].times + 1.0
+    assert node._cache_file(chunk, y) != key
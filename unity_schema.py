@@ -0,0 +1,524 @@
+"""Declarative trial-phase schemas for parsing Unity task markers.
+
+A schema describes a task variant: the trial phase codes of its TrialState
+events, how the per-trial fields of the output table are derived from the
+trial's final TrialState, and which event marks each output marker. It is
+compiled once (compile_schema) into lookup tables and event selectors that are
+evaluated for all trials at once; events that no selector can match are
+dropped right after decoding. A schema is a plain dict (so it can also be
+loaded from JSON, in which case numeric map keys may be strings) with the
+entries below; see SACCADE_TASK for a complete example.
+
+    phases          {phase code: phase name} of TrialState.trialPhaseIndex
+    trial_end_phase name of the last phase of a trial; trials without it are
+                    skipped, and the first ObjectInfo event after it starts the
+                    next trial
+    detail_phase    name of the phase whose (first) TrialState holds the
+                    per-trial details (default: trial_end_phase)
+    aliases         {key: replacement} for misspelled event keys
+    fields          list of the output fields, in order, each a dict with
+                      name      field name
+                      type      'str', 'int', 'float' or 'bool'
+                      property  list of ValueProperty names (optional)
+                      marker    true for the field that holds the marker name
+                      state     TrialState key (or list of keys) to read
+                      map       {value (or list of values): output value}
+                      latency   [marker A, marker B]: time of B minus time of A
+                    fields without a source are left empty (NaN)
+    markers         list of the output markers of a trial, in order, each a
+                    dict with
+                      marker    name of the marker
+                      when      conditions: {'phase': name} (the trial has
+                                this phase) and/or {'unless': {field: [values]}}
+                      at        list of selectors; the first one that matches
+                                an event of the trial gives the marker's time
+
+A selector picks the first (or, with 'pick': 'last', the last) event of a
+trial that matches all of its conditions:
+
+    event           'TrialState', 'ObjectInfo' or 'Input'
+    phase           (TrialState) the phase of the event
+    identity        (ObjectInfo) the _identity of the object
+    visible         (ObjectInfo) the _isVisible flag of the object
+    exclude_class   (Input) list of selectedObjectClass values to skip
+    from_phase      the event is at or after the first TrialState of this phase
+    before_phase    the event is before the first TrialState of this phase
+
+If a bounding phase does not occur in the trial, the selector does not match.
+"""
+
+import json
+import operator
+import functools
+import threading
+
+import numpy as np
+
+
+# --- the saccade task of the Michael Saccade VR study (revisions after Sept 10) ---
+
+_POSITIONS = {-1: 'Unknown', 0: 'Left', 1: 'Right', 2: 'NoGo'}
+_RESPONSE_TYPES = {0: 'None', 1: 'Prosaccade', 2: 'Antisaccade', 3: 'CuedSaccade', 4: 'NoGoProsaccade',
+                   5: 'NoGoAntisaccade'}
+
+"""
+Input event markers:
+    TrialState:
+        condition (int): See ConditionType
+        isCorrect (bool)
+        modifier (int): See ModifierType
+        trialIndex (uint)
+        response: See ResponseType
+        cuedPositionIndex: See _POSITIONS
+        targetPositionIndex: See _POSITIONS
+        targetObjectIndex (int): 0
+        selectedObjectIndex (int): in -1, 0
+        selectedPositionIndex: in -1, 0, 1
+        targetColorIndex: -1
+        trialPhaseIndex: see phases
+    Input: An event whenever a user input is registered (e.g., gaze collides with object)
+        trialIndex (int)
+        selectedObjectClass (str): in 'Background', 'Fixation', 'Target', 'Wall'
+        info (key-value pair): 'Selected: <selected object name>'
+    ObjectInfo:
+        _isVisible (bool)
+        _identity (string)
+        _position (x,y,z)
+        _pointingTo (x,y,z)
+    CameraRecenter: (bool) Camera height and yaw recentered on user
+
+There are many more events than we need, including events for positioning invisible targets and changing
+their colour.
+For each trial, we want to keep any events where the stimulus changed or where the user saw something.
+Each row will also have other data that describe the whole trial, so when we select individual events
+later, we still have all of the info we need to know what kind of trial it was.
+Note that the ObjectInfo events occur before their associated TrialState event, so the most accurate
+timestamps will come from ObjectInfo, not TrialState.
+
+Trial lifecycle:
+- ObjectInfo event when target is placed but still invisible
+- TrialState event with trialPhaseIndex 1 to indicate intertrial
+- Input event (>=1) to indicate subject is selecting CentralFixation / CentralWall.
+- TrialState with trialPhaseIndex = 2 to indicate Fixate phase.
+- Last Input event must be CentralFixation to proceed.
+- ObjectInfo to show the cue. (_isVisible: True)
+- TrialState with trialPhaseIndex=3 to indicate cue phase.
+- ObjectInfo shows colour change of cue to indicate Prosaccade/Antisaccade trial.
+<Additional ObjectInfo to show target in Cued trials>
+- TrialState with trialPhaseIndex=4 for the Delay (memory) period.
+- TrialState event with trialPhaseIndex 5 to indicate this is the target phase (map memory to saccade plan)
+<CHECK>- ObjectInfo with CentralFixation set to _isVisible False. This is the imperative go cue.
+- TrialState with trialPhaseIndex 6 to indicate the Go phase. TODO: Check if the time is same as above.
+- (Optional) Input event after fixation disappears because we are now selecting CentralWall behind fixation.
+- (if countermanding) ObjectInfo when fixation reappears. Start of countermanding.
+- (if countermanding) Input when fixation goes back on to central
+- TrialState with trialPhaseIndex 7 to indicate beginning of countermanding phase, whether or not stim given
+- ObjectInfo when CentralFixation disappears again
+- TrialState with trialPhaseIndex 8 to indicate beginning of Response phase
+- Input to indicate hitting target (or non-target, or opposite wall in antisaccade)
+- ObjectInfo to clear out CentralFixation
+- TrialState with trialPhaseIndex 8 again, but this time the isCorrect has changed.
+- TrialState with trialPhaseIndex 9 to indicate feedback phase.
+The next ObjectInfo event indicates the start of the next trial
+"""
+SACCADE_TASK = {
+    'phases': {1: 'Intertrial', 2: 'Fixate', 3: 'Cue', 4: 'Delay', 5: 'Target',
+               6: 'Go', 7: 'Countermand', 8: 'Response', 9: 'Feedback', -1: 'UserInput'},
+    'trial_end_phase': 'Feedback',
+    'aliases': {'CameraRecenter:': 'CameraRecenter', 'Input:': 'Input'},
+    'fields': [
+        {'name': 'UnityTrialIndex', 'type': 'int', 'property': ['INTEGER', 'NONNEGATIVE'],
+         'state': 'trialIndex'},
+        # Used to hold trial phase.
+        {'name': 'Marker', 'type': 'str', 'marker': True},
+        {'name': 'ModifierType', 'type': 'str', 'state': 'modifier',
+         'map': {0: 'None', 1: 'Cued', 2: 'MemoryGuided', 3: 'NoGo', 4: 'Catch'}},
+        {'name': 'ConditionType', 'type': 'str', 'state': 'condition',
+         'map': {0: 'None', 1: 'AttendShape', 2: 'AttendColour', 3: 'AttendNumber', 4: 'AttendDirection',
+                 5: 'AttendPosition', 6: 'AttendFixation'}},
+        # ResponseType 3 to 5 are added post data collection to expedite analysis: for cued
+        # (modifier 1) and NoGo trials, the response type is derived from the modifier.
+        {'name': 'ResponseType', 'type': 'str', 'state': ['modifier', 'response'],
+         'map': dict([((0, r), name) for r, name in _RESPONSE_TYPES.items()]
+                     + [((1, r), 'CuedSaccade') for r in _RESPONSE_TYPES]
+                     + [((m, r), 'NoGoProsaccade' if r == 1 else 'NoGoAntisaccade')
+                        for m in (2, 3, 4) for r in _RESPONSE_TYPES])},
+        {'name': 'CuedPosition', 'type': 'str', 'state': 'cuePositionIndex', 'map': _POSITIONS},
+        # TODO: Current experiment does not have a ObjectInfo event near time of cue.
+        {'name': 'CuedObject', 'type': 'str'},
+        {'name': 'TargetPosition', 'type': 'str', 'state': 'targetPositionIndex', 'map': _POSITIONS},
+        # TODO: Map to object name
+        {'name': 'TargetObjectIndex', 'type': 'int', 'property': ['INTEGER', 'CATEGORY'],
+         'state': 'targetObjectIndex'},
+        {'name': 'CountermandingDelay', 'type': 'float', 'latency': ['Go', 'Countermand']},
+        {'name': 'SelectedPosition', 'type': 'str', 'state': 'selectedPositionIndex', 'map': _POSITIONS},
+        {'name': 'SelectedObjectIndex', 'type': 'int', 'property': ['INTEGER', 'CATEGORY'],
+         'state': 'selectedObjectIndex'},
+        {'name': 'IsCorrect', 'type': 'bool', 'property': ['NONNEGATIVE'], 'state': 'isCorrect'},
+        # Without pupil data yet, the response is the first Input event of the response period.
+        {'name': 'ReactionTime', 'type': 'float', 'latency': ['Go', 'Response']},
+        # For the "TaskSwitch" experiment, tells if trial is Pro or Anti-saccade.
+        {'name': 'CueTypeIndex', 'type': 'str'},
+    ],
+    'markers': [
+        # ObjectInfo cue placed but hidden. Use phase transition.
+        {'marker': 'Intertrial', 'at': [{'event': 'TrialState', 'phase': 'Intertrial'}]},
+        # Fixation achieved. Use phase transition.
+        {'marker': 'Fixate', 'when': {'phase': 'Fixate'},
+         'at': [{'event': 'TrialState', 'phase': 'Fixate'}]},
+        # Cue presentation.
+        {'marker': 'Cue', 'when': {'phase': 'Cue'},
+         'at': [{'event': 'TrialState', 'phase': 'Cue'}]},
+        # Delay period: the cue disappears.
+        {'marker': 'Delay', 'when': {'phase': 'Delay'},
+         'at': [{'event': 'ObjectInfo', 'from_phase': 'Cue', 'before_phase': 'Delay'},
+                {'event': 'TrialState', 'phase': 'Delay'}]},
+        # Target presentation: the (last) target appears.
+        {'marker': 'Target', 'when': {'phase': 'Target'},
+         'at': [{'event': 'ObjectInfo', 'identity': 'Target', 'visible': True, 'pick': 'last'},
+                {'event': 'TrialState', 'phase': 'Target'}]},
+        # Imperative cue: the fixation point disappears.
+        {'marker': 'Go', 'when': {'phase': 'Go'},
+         'at': [{'event': 'ObjectInfo', 'identity': 'CentralFixation', 'visible': False},
+                {'event': 'TrialState', 'phase': 'Go'}]},
+        # (optional) Countermanding cue: the fixation point reappears before the response period.
+        {'marker': 'Countermand', 'when': {'phase': 'Countermand', 'unless': {'ResponseType': ['Prosaccade']}},
+         'at': [{'event': 'ObjectInfo', 'identity': 'CentralFixation', 'visible': True,
+                 'before_phase': 'Response', 'pick': 'last'},
+                {'event': 'TrialState', 'phase': 'Countermand'}]},
+        # Response: the first input of the response period that is not the fixation point.
+        {'marker': 'Response', 'when': {'phase': 'Response'},
+         'at': [{'event': 'Input', 'exclude_class': ['Fixation'], 'from_phase': 'Response'},
+                {'event': 'TrialState', 'phase': 'Response'}]},
+        # Feedback. Use phase transition.
+        {'marker': 'Feedback', 'at': [{'event': 'TrialState', 'phase': 'Feedback'}]},
+    ],
+}
+
+# built-in schemas, by name
+TASK_SCHEMAS = {'saccade': SACCADE_TASK}
+
+
+# --- compilation ---
+
+# event type codes
+_TRIAL_STATE, _OBJECT_INFO, _INPUT, _OTHER = 0, 1, 2, 3
+_EVENT_TYPES = {'TrialState': _TRIAL_STATE, 'ObjectInfo': _OBJECT_INFO, 'Input': _INPUT}
+_NO_PHASE = np.iinfo(np.int64).min
+
+
+def compile_schema(schema=None):
+    """Get the compiled form of a schema (default: SACCADE_TASK); compiled
+    schemas are cached by content."""
+    schema = SACCADE_TASK if schema is None else schema
+    if isinstance(schema, str):
+        # name of a JSON file
+        with open(schema) as f:
+            schema = json.load(f)
+    key = repr(schema)
+    with _compiled_lock:
+        if key not in _compiled:
+            if len(_compiled) >= 16:
+                _compiled.clear()
+            _compiled[key] = CompiledSchema(schema)
+        return _compiled[key]
+
+
+_compiled = {}
+_compiled_lock = threading.Lock()
+
+
+class _Lookup:
+    """Vectorized mapping of (tuples of) integer keys to values, through a
+    dense table; keys outside the table map to None."""
+
+    def __init__(self, mapping, n_keys):
+        keys = [self._key(k, n_keys) for k in mapping]
+        self.lo = np.min(keys, axis=0) if keys else np.zeros(n_keys, int)
+        shape = (np.max(keys, axis=0) - self.lo + 1) if keys else np.zeros(n_keys, int)
+        self.table = np.full(tuple(shape), None, dtype=object)
+        for key, value in zip(keys, mapping.values()):
+            self.table[tuple(np.asarray(key) - self.lo)] = value
+
+    @staticmethod
+    def _key(key, n_keys):
+        # JSON turns tuple keys into strings such as '(0, 1)' or '[0, 1]'
+        if isinstance(key, str):
+            key = [int(k) for k in key.strip('()[] ').split(',')]
+        key = np.atleast_1d(np.asarray(key, dtype=int))
+        if len(key) != n_keys:
+            raise ValueError("Map key %s does not have %d values." % (key, n_keys))
+        return key
+
+    def __call__(self, columns):
+        ix = [np.asarray(col, dtype=int) - lo for col, lo in zip(columns, self.lo)]
+        valid = np.ones(len(ix[0]), bool)
+        for k, col in enumerate(ix):
+            valid &= (col >= 0) & (col < self.table.shape[k])
+        out = np.full(len(valid), None, dtype=object)
+        out[valid] = self.table[tuple(col[valid] for col in ix)]
+        return out
+
+
+class CompiledSchema:
+    """A schema compiled into lookup tables and event selectors."""
+
+    def __init__(self, schema):
+        self.schema = schema
+        self.phase_codes = {name: int(code) for code, name in schema['phases'].items()}
+        self.end_phase = schema['trial_end_phase']
+        self.detail_phase = schema.get('detail_phase', self.end_phase)
+        self.aliases = schema.get('aliases', {})
+
+        # output fields
+        self.fields = schema['fields']
+        self.lookups = {}
+        for field in self.fields:
+            if 'map' in field:
+                keys = field['state'] if isinstance(field['state'], list) else [field['state']]
+                self.lookups[field['name']] = _Lookup(field['map'], len(keys))
+
+        # marker rules
+        self.markers = schema['markers']
+        self.marker_names = np.array([m['marker'] for m in self.markers], dtype=object)
+        selectors = [sel for m in self.markers for sel in m['at']]
+        self.identities = sorted({sel['identity'] for sel in selectors if 'identity' in sel})
+        self.input_classes = sorted({c for sel in selectors for c in sel.get('exclude_class', ())})
+
+    # --- field types ---
+
+    def record_dtype(self):
+        """Record dtype of the output table (with ValueProperty titles)."""
+        from neuropype.engine import ValueProperty
+        defaults = {'str': ['STRING', 'CATEGORY'], 'int': ['INTEGER'], 'float': ['UNKNOWN'],
+                    'bool': ['NONNEGATIVE']}
+        types = {'str': object, 'int': int, 'float': float, 'bool': bool}
+        dtype = []
+        for field in self.fields:
+            props = [getattr(ValueProperty, p) for p in field.get('property', defaults[field['type']])]
+            dtype.append(((functools.reduce(operator.add, props), field['name']), types[field['type']]))
+        return dtype
+
+    # --- parsing ---
+
+    def decode(self, strings, positions=False):
+        """Decode the JSON marker strings into event columns. With positions,
+        the geometry of the ObjectInfo events is also collected (see
+        object_tracks)."""
+        strings = list(strings)
+        try:
+            # decoding all markers at once is much faster than one by one
+            events = json.loads('[' + ','.join(strings) + ']')
+        except ValueError:
+            events = [json.loads(s) for s in strings]
+        n = len(events)
+        ev_type = np.full(n, _OTHER, dtype=np.int8)
+        phase = np.full(n, _NO_PHASE, dtype=np.int64)
+        trial = np.zeros(n, dtype=np.int64)
+        identity = np.full(n, -1, dtype=np.int16)
+        visible = np.zeros(n, dtype=bool)
+        input_class = np.full(n, -1, dtype=np.int16)
+        states = {}
+        id_codes = {name: k for k, name in enumerate(self.identities)}
+        class_codes = {name: k for k, name in enumerate(self.input_classes)}
+        # ObjectInfo events: event index, identity code, position + pointingTo + visibility
+        obj_rows, obj_ids, obj_geom, obj_codes = [], [], [], {}
+        aliases = self.aliases
+        for ix, ev in enumerate(events):
+            # Fix some mistakes in the json encoding in Unity
+            for alias in aliases:
+                if alias in ev:
+                    ev = {aliases[alias]: ev[alias]}
+            key = next(iter(ev), None)
+            code = _EVENT_TYPES.get(key, _OTHER)
+            ev_type[ix] = code
+            body = ev[key] if code != _OTHER else None
+            if code == _TRIAL_STATE:
+                phase[ix] = body['trialPhaseIndex']
+                trial[ix] = body['trialIndex']
+                states[ix] = body
+            elif code == _OBJECT_INFO:
+                identity[ix] = id_codes.get(body['_identity'], -1)
+                visible[ix] = body['_isVisible']
+                if positions:
+                    obj_rows.append(ix)
+                    obj_ids.append(obj_codes.setdefault(body['_identity'], len(obj_codes)))
+                    obj_geom.append(_xyz(body.get('_position')) + _xyz(body.get('_pointingTo'))
+                                    + [body['_isVisible']])
+            elif code == _INPUT:
+                input_class[ix] = class_codes.get(body.get('selectedObjectClass'), -1)
+        cols = {'type': ev_type, 'phase': phase, 'trial': trial, 'identity': identity,
+                'visible': visible, 'input_class': input_class, 'states': states}
+        if positions:
+            cols['objects'] = (np.array(obj_rows, dtype=np.int64), np.array(obj_ids, dtype=np.int64),
+                               np.array(obj_geom, dtype=np.float32).reshape(-1, len(OBJECT_CHANNELS)),
+                               list(obj_codes))
+        return cols
+
+    def trial_index(self, cols):
+        """Trial index of each event, even the ObjectInfo and Input events."""
+        ev_type, phase, trial = cols['type'], cols['phase'], cols['trial']
+        n = len(ev_type)
+        is_ts = ev_type == _TRIAL_STATE
+        is_obj = ev_type == _OBJECT_INFO
+        # the last TrialState at or before each event sets the trial index and phase
+        last_ts = np.maximum.accumulate(np.where(is_ts, np.arange(n), -1)) if n else np.zeros(0, int)
+        has_ts = last_ts >= 0
+        base_trial = np.where(has_ts, trial[np.maximum(last_ts, 0)], 0)
+        end_phase = self.phase_codes[self.end_phase]
+        base_phase = np.where(has_ts, phase[np.maximum(last_ts, 0)], end_phase)
+        # The first ObjectInfo event after the last phase is the start of a new trial.
+        obj_count = np.cumsum(is_obj)
+        obj_since = obj_count - np.where(has_ts, obj_count[np.maximum(last_ts, 0)], 0)
+        starts_next = (base_phase == end_phase) & (obj_since > 0) & ~is_ts
+        ev_tr = base_trial + starts_next
+
+        # ev_tr wraps where the next of several concatenated files begins; the
+        # trials of each file are numbered on from those of the files before
+        # it (the ObjectInfo events that start its first trial stay with it).
+        for switch in np.flatnonzero(np.diff(ev_tr) < 0) + 1:
+            ev_tr[switch:] += ev_tr[switch - 1] - ev_tr[switch] + (not starts_next[switch - 1])
+        return ev_tr
+
+    def build(self, times, cols, ev_tr):
+        """Build the output table; returns (times, record array)."""
+        times = np.asarray(times, dtype=float)
+        trial_ids, trial_of = np.unique(ev_tr, return_inverse=True)
+        n_trials = len(trial_ids)
+
+        # Drop the events that no selector can match (by event type and
+        # attributes); the TrialState events delimit the phases.
+        static = [[self._static_mask(sel, cols) for sel in rule['at']] for rule in self.markers]
+        keep = functools.reduce(np.logical_or, [m for masks in static for m in masks],
+                                cols['type'] == _TRIAL_STATE)
+        kept = np.flatnonzero(keep)
+        ev = {'type': cols['type'][kept], 'phase': cols['phase'][kept],
+              'pos': kept, 'trial': trial_of.ravel()[kept]}
+
+        # first TrialState of each phase in each trial
+        phase_first = {}
+        for name, code in self.phase_codes.items():
+            sel = (ev['type'] == _TRIAL_STATE) & (ev['phase'] == code)
+            phase_first[name] = self._first_per_trial(ev['pos'][sel], ev['trial'][sel], n_trials)
+        valid = phase_first[self.end_phase] >= 0
+        detail_ts = phase_first[self.detail_phase]
+        valid &= detail_ts >= 0
+
+        # per-trial fields from the detail TrialState
+        states = [cols['states'][ix] for ix in detail_ts[valid]]
+        values = {}
+        for field in self.fields:
+            name = field['name']
+            if 'state' in field:
+                keys = field['state'] if isinstance(field['state'], list) else [field['state']]
+                raw = [np.array([s[k] for s in states]) for k in keys]
+                values[name] = self.lookups[name](raw) if name in self.lookups else raw[0]
+
+        # markers of each trial
+        marker_ix = np.full((int(np.sum(valid)), len(self.markers)), -1)
+        for m, rule in enumerate(self.markers):
+            when = rule.get('when', {})
+            cond = np.ones(marker_ix.shape[0], bool)
+            if 'phase' in when:
+                cond &= phase_first[when['phase']][valid] >= 0
+            for name, excluded in when.get('unless', {}).items():
+                cond &= ~np.isin(values[name], excluded)
+            for sel, mask in zip(rule['at'], static[m]):
+                ix = self._select(sel, mask[kept], ev, phase_first, n_trials)[valid]
+                fill = cond & (marker_ix[:, m] < 0) & (ix >= 0)
+                marker_ix[fill, m] = ix[fill]
+        marker_times = np.where(marker_ix >= 0, times[np.maximum(marker_ix, 0)], np.nan)
+
+        # one row per marker, trial by trial
+        row_tr, row_m = np.nonzero(marker_ix >= 0)
+        out = np.recarray(len(row_tr), dtype=self.record_dtype())
+        marker_col = {m['marker']: k for k, m in enumerate(self.markers)}
+        for field in self.fields:
+            name = field['name']
+            if field.get('marker'):
+                col = self.marker_names[row_m]
+            elif name in values:
+                col = values[name][row_tr] if len(states) else np.zeros(0, dtype=out.dtype[name])
+            elif 'latency' in field:
+                start, stop = (marker_col[k] for k in field['latency'])
+                col = (marker_times[:, stop] - marker_times[:, start])[row_tr]
+            else:
+                col = np.nan
+            out[name] = col
+        return marker_times[row_tr, row_m], out
+
+    def _static_mask(self, sel, cols):
+        """Mask of the events whose type and attributes match a selector."""
+        mask = cols['type'] == _EVENT_TYPES[sel['event']]
+        if 'phase' in sel:
+            mask &= cols['phase'] == self.phase_codes[sel['phase']]
+        if 'identity' in sel:
+            mask &= cols['identity'] == self.identities.index(sel['identity'])
+        if 'visible' in sel:
+            mask &= cols['visible'] == bool(sel['visible'])
+        for cls in sel.get('exclude_class', ()):
+            mask &= cols['input_class'] != self.input_classes.index(cls)
+        return mask
+
+    def _select(self, sel, mask, ev, phase_first, n_trials):
+        """Event index matched by a selector in each trial (-1 if none),
+        given the mask of the (kept) events that match its attributes."""
+        if sel['event'] == 'TrialState' and set(sel) <= {'event', 'phase'}:
+            return phase_first[sel['phase']]
+        pos, trials = ev['pos'][mask], ev['trial'][mask]
+        if 'from_phase' in sel:
+            lo = phase_first[sel['from_phase']][trials]
+            ok = (lo >= 0) & (pos >= lo)
+            pos, trials = pos[ok], trials[ok]
+        if 'before_phase' in sel:
+            hi = phase_first[sel['before_phase']][trials]
+            ok = (hi >= 0) & (pos < hi)
+            pos, trials = pos[ok], trials[ok]
+        return self._first_per_trial(pos, trials, n_trials, last=sel.get('pick', 'first') == 'last')
+
+    @staticmethod
+    def _first_per_trial(pos, trials, n_trials, last=False):
+        """First (or last) of the sorted event indices pos in each trial."""
+        out = np.full(n_trials, -1)
+        if last:
+            pos, trials = pos[::-1], trials[::-1]
+        uniq, first = np.unique(trials, return_index=True)
+        out[uniq] = pos[first]
+        return out
+
+
+# --- object geometry ---
+
+# channels of the object tracks
+OBJECT_CHANNELS = ['position_x', 'position_y', 'position_z', 'pointing_x', 'pointing_y', 'pointing_z', 'visible']
+
+
+def _xyz(vec):
+    # Unity serializes vectors as {"x": .., "y": .., "z": ..}; also accept lists
+    if vec is None:
+        return [np.nan] * 3
+    if isinstance(vec, dict):
+        return [vec.get('x', np.nan), vec.get('y', np.nan), vec.get('z', np.nan)]
+    return list(vec)
+
+
+def object_tracks(times, cols):
+    """Positions and pointing vectors of the scene objects over time, from
+    event columns decoded with positions=True.
+
+    Returns:
+        (identities, data, obj_times): the sorted object identities, and a
+        float32 array of shape (identities, OBJECT_CHANNELS, obj_times) that
+        holds, at the time of each ObjectInfo event, the last reported state of
+        every object (NaN before its first report).
+    """
+    rows, ids, geom, names = cols['objects']
+    order = np.argsort(names, kind='stable') if names else np.zeros(0, int)
+    data = np.full((len(names), geom.shape[1], len(rows)), np.nan, dtype=np.float32)
+    steps = np.arange(len(rows))
+    for k, code in enumerate(order):
+        # index of the last report of the object at each step
+        last = np.maximum.accumulate(np.where(ids == code, steps, -1)) if len(rows) else steps
+        seen = last >= 0
+        data[k][:, seen] = geom[last[seen]].T
+    return [names[c] for c in order], data, np.asarray(times, dtype=float)[rows]